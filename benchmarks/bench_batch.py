@@ -0,0 +1,130 @@
+"""compares installing packages with one whl.py process each vs whl.py --manifest
+
+Run from the root of the repository:
+
+  $ PYTHONPATH=third_party/py:. python benchmarks/bench_batch.py --packages 100
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from tests.wheels import make_wheel
+
+WHL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "whl.py")
+
+
+def _make_wheelhouse(directory, packages, modules):
+    wheelhouse = os.path.join(directory, "wheelhouse")
+    os.makedirs(wheelhouse)
+    names = ["pkg%d" % i for i in range(packages)]
+    for i, name in enumerate(names):
+        files = {"%s/__init__.py" % name: ""}
+        for m in range(modules):
+            files["%s/mod%d.py" % (name, m)] = "X = %d\n" % m * 50
+        make_wheel(
+            wheelhouse,
+            name,
+            "1.0",
+            files=files,
+            requires_dist=[names[(i + 1) % packages]],
+        )
+    constraint = os.path.join(directory, "requirements.txt")
+    with open(constraint, "w") as f:
+        f.write("".join("%s==1.0\n" % name for name in names))
+    return wheelhouse, constraint, names
+
+
+def _per_package(directory, wheelhouse, constraint, names):
+    for name in names:
+        target = os.path.join(directory, "single", name)
+        os.makedirs(target)
+        subprocess.check_call(
+            [
+                sys.executable,
+                WHL,
+                "--package",
+                name,
+                "--version",
+                "1.0",
+                "--directory",
+                target,
+                "--requirements",
+                "@pip",
+                "--constraint",
+                constraint,
+                "--no-index",
+                "--find-links",
+                wheelhouse,
+            ]
+        )
+
+
+def _batch(directory, wheelhouse, constraint, names, jobs):
+    manifest = os.path.join(directory, "manifest.json")
+    with open(manifest, "w") as f:
+        json.dump(
+            {
+                "requirements": "@pip",
+                "constraint": constraint,
+                "packages": [
+                    {
+                        "package": name,
+                        "version": "1.0",
+                        "directory": os.path.join(directory, "batch", name),
+                    }
+                    for name in names
+                ],
+            },
+            f,
+        )
+    subprocess.check_call(
+        [
+            sys.executable,
+            WHL,
+            "--manifest",
+            manifest,
+            "--jobs",
+            str(jobs),
+            "--no-index",
+            "--find-links",
+            wheelhouse,
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=100)
+    parser.add_argument("--modules", type=int, default=20)
+    parser.add_argument("--jobs", type=int, default=8)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        wheelhouse, constraint, names = _make_wheelhouse(
+            directory, args.packages, args.modules
+        )
+
+        start = time.time()
+        _per_package(directory, wheelhouse, constraint, names)
+        single = time.time() - start
+
+        start = time.time()
+        _batch(directory, wheelhouse, constraint, names, args.jobs)
+        batch = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+    print("packages:     %d" % args.packages)
+    print("per package:  %.2fs (%.1fms/package)" % (single, 1000 * single / len(names)))
+    print("batch:        %.2fs (%.1fms/package)" % (batch, 1000 * batch / len(names)))
+    print("speedup:      %.1fx" % (single / batch))
+
+
+if __name__ == "__main__":
+    main()
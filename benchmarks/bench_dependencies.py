@@ -0,0 +1,88 @@
+"""compares per extra whl.dependencies calls with a single whl.dependency_map
+
+Uses the wheels of tests/test_whl.py, run from the root of the repository:
+
+  $ TEST_SRCDIR=<runfiles> PYTHONPATH=third_party/py:src:. \
+      python benchmarks/bench_dependencies.py
+"""
+import argparse
+import glob
+import os
+import re
+import time
+
+import pkginfo
+from pip._vendor import pkg_resources
+
+from src import whl
+
+_EXTRA_RE = re.compile(r"extra\s*==\s*['\"]([^'\"]+)")
+
+
+def _legacy_dependencies(pkg, extra=None):
+    # whl.dependencies before dependency_map, parses and evaluates per call
+    ret = set()
+    for dist in pkg.requires_dist:
+        requirement = pkg_resources.Requirement.parse(dist)
+        name = requirement.name.replace("_", "-")
+        if extra:
+            if not requirement.marker or requirement.marker.evaluate({"extra": None}):
+                continue
+        if requirement.marker:
+            if not requirement.marker.evaluate({"extra": extra}):
+                continue
+        if requirement.extras:
+            ret = ret | set(
+                ["{}[{}]".format(name, dist_extra) for dist_extra in requirement.extras]
+            )
+        else:
+            ret.add(name)
+    return sorted(list(ret))
+
+
+def _legacy(pkg, extras):
+    return {extra: _legacy_dependencies(pkg, extra) for extra in [None] + extras}
+
+
+def _single_pass(pkg, extras):
+    return whl.dependency_map(pkg, extras)
+
+
+def _time(func, wheels, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        for pkg in wheels:
+            func(pkg, pkg.provides_extras)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    paths = sorted(
+        glob.glob(os.path.join(os.environ["TEST_SRCDIR"], "*_whl", "file", "*.whl"))
+    )
+    wheels = [pkginfo.Wheel(path) for path in paths]
+    for pkg in wheels:
+        # old wheels don't declare Provides-Extra, take them from the markers
+        pkg.provides_extras = sorted(
+            set(pkg.provides_extras)
+            | set(e for d in pkg.requires_dist for e in _EXTRA_RE.findall(d))
+        )
+        assert _legacy(pkg, pkg.provides_extras) == _single_pass(
+            pkg, pkg.provides_extras
+        ), pkg.filename
+
+    legacy = _time(_legacy, wheels, args.iterations)
+    single = _time(_single_pass, wheels, args.iterations)
+    calls = args.iterations * len(wheels)
+    print("wheels:       %d" % len(wheels))
+    print("per extra:    %.2fs (%.1fus/wheel)" % (legacy, 1e6 * legacy / calls))
+    print("single pass:  %.2fs (%.1fus/wheel)" % (single, 1e6 * single / calls))
+    print("speedup:      %.1fx" % (legacy / single))
+
+
+if __name__ == "__main__":
+    main()
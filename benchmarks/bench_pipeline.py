@@ -0,0 +1,368 @@
+"""measures the import and fetch pipeline offline against a synthetic wheelhouse
+
+Generates a wheelhouse of packages with modules, nested namespace packages,
+extras, entry points and native looking .so payloads, and runs the pipeline of
+a pip_import with batch set against it, from the wheelhouse as --find-links or
+from its simple index:
+
+  index:       index.py, with --index only
+  piptool:     piptool.py with --dependency-graph and --manifest
+  fetch_cold:  whl.py --manifest with an empty wheel store
+  fetch_warm:  whl.py --manifest into new directories, from the wheel store
+
+Every step reports its wall time, the peak RSS of its process and the files it
+created, and the totals of the phases of its traces, see src/tracing.py. Run
+from the root of the repository:
+
+  $ PYTHONPATH=third_party/py:. python benchmarks/bench_pipeline.py \
+      --packages 200 --save /tmp/baseline.json
+  $ PYTHONPATH=third_party/py:. python benchmarks/bench_pipeline.py \
+      --packages 200 --baseline /tmp/baseline.json
+
+With --baseline, it exits with 1 if a step or a phase got slower than the
+baseline by more than --tolerance.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from tests.wheels import make_wheel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# phases shorter than this are too noisy to compare with the baseline
+_MIN_SECONDS = 0.05
+
+
+def _native_tag():
+    from pip._vendor.packaging import tags
+
+    return str(next(iter(tags.sys_tags())))
+
+
+def _make_wheelhouse(directory, args):
+    """Writes the wheels and the lockfile of the benchmark.
+
+    Package i depends on package i + 1, packages with extras add a dependency
+    on package i + 2 for the extra fast, and the lockfile asks for it.
+    """
+    wheelhouse = os.path.join(directory, "wheelhouse")
+    os.makedirs(wheelhouse)
+    rng = random.Random(args.packages)
+    native_tag = _native_tag()
+    namespace = "/".join("ns%d" % level for level in range(args.namespace_depth))
+    names = ["pkg%d" % i for i in range(args.packages)]
+    requirements = []
+    for i, name in enumerate(names):
+        root = "%s/%s" % (namespace, name) if namespace else name
+        files = {"%s/__init__.py" % root: "def main():\n    pass\n"}
+        for m in range(args.modules):
+            files["%s/mod%d.py" % (root, m)] = "X = %d\n" % m * (args.module_bytes // 8)
+        tag = "py3-none-any"
+        if args.native_every and i % args.native_every == 0:
+            so = "%s/_speedups.%s.so" % (root, sys.implementation.cache_tag)
+            files[so] = rng.randbytes(args.native_bytes)
+            tag = native_tag
+        requires_dist = [names[(i + 1) % len(names)]] if len(names) > 1 else []
+        extras = args.extras_every and i % args.extras_every == 0
+        if extras:
+            requires_dist.append('%s; extra == "fast"' % names[(i + 2) % len(names)])
+        module = root.replace("/", ".")
+        make_wheel(
+            wheelhouse,
+            name,
+            "1.0",
+            files=files,
+            requires_dist=requires_dist,
+            tag=tag,
+            dist_info_files={
+                "entry_points.txt": "[console_scripts]\n%s = %s:main\n"
+                % (name, module),
+                "top_level.txt": root.split("/")[0] + "\n",
+            },
+        )
+        requirements.append("%s%s==1.0\n" % (name, "[fast]" if extras else ""))
+    lockfile = os.path.join(directory, "requirements.txt")
+    with open(lockfile, "w") as f:
+        f.write("".join(requirements))
+    return wheelhouse, lockfile
+
+
+def _count_files(directory):
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def _run(name, command, output, trace_dir):
+    """Runs a step of the pipeline.
+
+    Returns:
+        dict: wall seconds, peak RSS, files created in output and the totals
+            of the phases traced by the step
+    """
+    before = _count_files(output)
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "third_party", "py"))
+    # offline, pip only sees the wheelhouse
+    for variable in ("PIP_INDEX_URL", "PIP_EXTRA_INDEX_URL", "PIP_FIND_LINKS"):
+        env.pop(variable, None)
+    start = time.time()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE)
+    stdout = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    phases = {}
+    for path in glob.glob(os.path.join(trace_dir, "*.summary.json")):
+        with open(path) as f:
+            for phase, totals in json.load(f)["phases"].items():
+                total = phases.setdefault(phase, {"seconds": 0.0, "count": 0})
+                total["seconds"] = round(total["seconds"] + totals["seconds"], 3)
+                total["count"] += totals["count"]
+    return {
+        "step": name,
+        "seconds": round(seconds, 3),
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "files": _count_files(output) - before,
+        "phases": phases,
+        "stdout": stdout.decode().strip(),
+    }
+
+
+def _pipeline(directory, wheelhouse, lockfile, args):
+    output = os.path.join(directory, "output")
+    os.makedirs(output)
+    cache_dir = os.path.join(directory, "cache")
+    traces = os.path.join(directory, "traces")
+    steps = []
+
+    pip_args = ["--no-index", "--find-links", wheelhouse]
+    if args.index:
+        step = _run(
+            "index",
+            [
+                sys.executable,
+                os.path.join(SRC, "index.py"),
+                "--wheelhouse",
+                wheelhouse,
+                "--output",
+                os.path.join(output, "simple"),
+            ],
+            output,
+            os.path.join(traces, "index"),
+        )
+        steps.append(step)
+        pip_args = ["--index-url", step["stdout"]]
+
+    repo = os.path.join(output, "pip")
+    os.makedirs(repo)
+    manifest = os.path.join(repo, "manifest.json")
+    steps.append(
+        _run(
+            "piptool",
+            [
+                sys.executable,
+                os.path.join(SRC, "piptool.py"),
+                "--name=pip",
+                "--input=%s" % lockfile,
+                "--output=%s" % os.path.join(repo, "requirements.bzl"),
+                "--repo-prefix=pypi",
+                "--timeout=1200",
+                "--quiet=True",
+                "--manifest=%s" % manifest,
+                "--dependency-graph",
+                "--trace-dir=%s" % os.path.join(traces, "piptool"),
+            ]
+            + pip_args,
+            output,
+            os.path.join(traces, "piptool"),
+        )
+    )
+
+    for step in ("fetch_cold", "fetch_warm"):
+        if step == "fetch_warm":
+            # new package directories, the wheels and trees come from the store
+            shutil.move(
+                os.path.join(repo, "packages"), os.path.join(output, "cold_packages")
+            )
+        steps.append(
+            _run(
+                step,
+                [
+                    sys.executable,
+                    os.path.join(SRC, "whl.py"),
+                    "--manifest",
+                    manifest,
+                    "--jobs",
+                    str(args.jobs),
+                    "--cache-dir",
+                    cache_dir,
+                    "--trace-dir",
+                    os.path.join(traces, step),
+                ]
+                + pip_args,
+                output,
+                os.path.join(traces, step),
+            )
+        )
+    return steps
+
+
+def _regressions(steps, baseline, tolerance):
+    """Lists the steps and phases slower than in the baseline."""
+    previous = {step["step"]: step for step in baseline["steps"]}
+    regressions = []
+    for step in steps:
+        old = previous.get(step["step"])
+        if old is None:
+            continue
+        pairs = [(step["step"], old["seconds"], step["seconds"])]
+        for phase, totals in step["phases"].items():
+            if phase in old["phases"]:
+                pairs.append(
+                    (
+                        "%s/%s" % (step["step"], phase),
+                        old["phases"][phase]["seconds"],
+                        totals["seconds"],
+                    )
+                )
+        for name, old_seconds, seconds in pairs:
+            if seconds > _MIN_SECONDS and seconds > old_seconds * (1 + tolerance):
+                regressions.append((name, old_seconds, seconds))
+    return regressions
+
+
+def _report(steps, baseline):
+    previous = {step["step"]: step for step in (baseline or {}).get("steps", [])}
+
+    def compare(seconds, old_seconds):
+        if old_seconds is None:
+            return ""
+        return " (%+.0f%%)" % (100 * (seconds - old_seconds) / max(old_seconds, 1e-3))
+
+    print("%-24s %10s %10s %8s" % ("step/phase", "seconds", "rss MB", "files"))
+    for step in steps:
+        old = previous.get(step["step"], {})
+        print(
+            "%-24s %9.2fs %10.1f %8d%s"
+            % (
+                step["step"],
+                step["seconds"],
+                step["peak_rss_mb"],
+                step["files"],
+                compare(step["seconds"], old.get("seconds")),
+            )
+        )
+        old_phases = old.get("phases", {})
+        for phase, totals in sorted(
+            step["phases"].items(), key=lambda p: -p[1]["seconds"]
+        ):
+            print(
+                "  %-22s %9.2fs %10s %8s%s"
+                % (
+                    phase,
+                    totals["seconds"],
+                    "",
+                    "x%d" % totals["count"],
+                    compare(
+                        totals["seconds"],
+                        old_phases.get(phase, {}).get("seconds"),
+                    ),
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=100)
+    parser.add_argument("--modules", type=int, default=20)
+    parser.add_argument("--module-bytes", type=int, default=400)
+    parser.add_argument(
+        "--namespace-depth",
+        type=int,
+        default=2,
+        help="Packages live in namespace packages this deep, e.g. ns0.ns1.pkg3.",
+    )
+    parser.add_argument(
+        "--extras-every",
+        type=int,
+        default=5,
+        help="Every n-th package has an extra, 0 for none.",
+    )
+    parser.add_argument(
+        "--native-every",
+        type=int,
+        default=10,
+        help="Every n-th package is a platform wheel with a .so, 0 for none.",
+    )
+    parser.add_argument("--native-bytes", type=int, default=1 << 20)
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Index the wheelhouse and install from the index instead of "
+        + "--find-links.",
+    )
+    parser.add_argument("--save", help="Write the results to this file.")
+    parser.add_argument("--baseline", help="Compare with the results of --save.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep and print the work directory."
+    )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        wheelhouse, lockfile = _make_wheelhouse(directory, args)
+        steps = _pipeline(directory, wheelhouse, lockfile, args)
+    finally:
+        if args.keep:
+            print("work directory: %s" % directory)
+        else:
+            shutil.rmtree(directory)
+
+    for step in steps:
+        del step["stdout"]
+    results = {
+        "config": {
+            name: value
+            for name, value in sorted(vars(args).items())
+            if name not in ("save", "baseline", "tolerance", "keep")
+        },
+        "python": "%d.%d" % sys.version_info[:2],
+        "steps": steps,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != results["config"]:
+            print("warning: the baseline was run with %s" % baseline["config"])
+    _report(steps, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = _regressions(steps, baseline, args.tolerance)
+        for name, old_seconds, seconds in regressions:
+            print(
+                "regression: %s %.2fs -> %.2fs" % (name, old_seconds, seconds),
+                file=sys.stderr,
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
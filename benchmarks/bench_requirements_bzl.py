@@ -0,0 +1,221 @@
+"""measures the loading phase of a pip_import with thousands of packages
+
+Generates a synthetic lockfile, the files of its pip_import with piptool.py and
+with the previous generator, which checked every package with
+native.existing_rules() and kept the mapping in requirements.bzl and BUILD. For
+both it times evaluating the WORKSPACE, i.e. pip_install(), and loading a
+package that calls requirement() for every package. Run from the root of the
+repository:
+
+  $ PYTHONPATH=third_party/py:src python benchmarks/bench_requirements_bzl.py \
+      --packages 5000
+
+Without bazel on PATH only the generation is timed. Bazel 7 and later need
+--bazel-arg=--noenable_bzlmod --bazel-arg=--enable_workspace.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPTOOL = os.path.join(ROOT, "src", "piptool.py")
+
+# requirements.bzl as written before install.bzl and mapping.bzl
+_LEGACY_LIBRARY = """
+  if "{repo}" not in native.existing_rules():
+    whl_library(
+        name = "{repo}",
+        pkg = "{name}",
+        version = "1.0",
+        requirements_repo = "@pip_deps",
+        python_interpreter = "python3",
+        extras = [],
+        pip_args = pip_args,
+        timeout = 1200,
+        quiet = True,
+        overrides = {{}},
+        cache_dir = "",
+        cache_max_size = "10G",
+        prebuilt = "",
+        precompile = False,
+        zipped = False,
+        namespace_style = "pkgutil",
+    )"""
+
+_LEGACY_REQUIREMENTS_BZL = """\
+load("@com_github_ali5h_rules_pip//:defs.bzl", "whl_library")
+
+def pip_install(pip_args=[]):
+  {libraries}
+
+_requirements = {{
+  {mappings}
+}}
+
+all_requirements = _requirements.values()
+
+def requirement(name, target=None):
+  name_key = name.lower()
+  if name_key not in _requirements:
+    return name_key + "_not_found_in_requirements"
+  req = _requirements[name_key]
+  if target != None:
+    pkg, _, _ = req.partition("//")
+    req = pkg + target
+  return req
+"""
+
+_LEGACY_BUILD = """\
+[alias(name=name, actual=pkg,  visibility=["//visibility:public"]) for name, pkg in {{
+  {mappings}
+}}.items()]
+"""
+
+
+def _lockfile(directory, packages):
+    path = os.path.join(directory, "requirements.txt")
+    with open(path, "w") as f:
+        f.write("".join("pkg%d==1.0\n" % i for i in range(packages)))
+    return path
+
+
+def _generate(directory, lockfile):
+    os.makedirs(directory)
+    subprocess.check_call(
+        [
+            sys.executable,
+            PIPTOOL,
+            "--name=pip_deps",
+            "--input=%s" % lockfile,
+            "--output=%s" % os.path.join(directory, "requirements.bzl"),
+            "--repo-prefix=pypi",
+            "--timeout=1200",
+            "--quiet=True",
+        ]
+    )
+
+
+def _generate_legacy(directory, packages):
+    os.makedirs(directory)
+    repos = ["pypi__3__pkg%d_1_0" % i for i in range(packages)]
+    mappings = ",\n  ".join(
+        '"pkg%d": "@%s//:pkg"' % (i, repo) for i, repo in enumerate(repos)
+    )
+    libraries = "\n".join(
+        _LEGACY_LIBRARY.format(repo=repo, name="pkg%d" % i)
+        for i, repo in enumerate(repos)
+    )
+    with open(os.path.join(directory, "requirements.bzl"), "w") as f:
+        f.write(_LEGACY_REQUIREMENTS_BZL.format(libraries=libraries, mappings=mappings))
+    with open(os.path.join(directory, "BUILD"), "w") as f:
+        f.write(_LEGACY_BUILD.format(mappings=mappings))
+
+
+def _size(directory):
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for name in os.listdir(directory)
+        if name == "BUILD" or name.endswith(".bzl")
+    )
+
+
+def _workspace(directory, pip_repo, packages):
+    """Creates a workspace calling pip_install and requirement() on pip_repo."""
+    os.makedirs(directory)
+    with open(os.path.join(pip_repo, "WORKSPACE"), "w") as f:
+        f.write('workspace(name = "pip_deps")\n')
+    with open(os.path.join(directory, "WORKSPACE"), "w") as f:
+        f.write(
+            """\
+local_repository(name = "com_github_ali5h_rules_pip", path = "{root}")
+local_repository(name = "pip_deps", path = "{pip_repo}")
+
+load("@pip_deps//:requirements.bzl", "pip_install")
+
+pip_install()
+""".format(
+                root=ROOT, pip_repo=pip_repo
+            )
+        )
+    with open(os.path.join(directory, "BUILD"), "w") as f:
+        f.write(
+            """\
+load("@pip_deps//:requirements.bzl", "requirement")
+
+filegroup(
+    name = "all",
+    srcs = [requirement("pkg%d" % i) for i in range({packages})],
+)
+""".format(
+                packages=packages
+            )
+        )
+
+
+def _bazel(workspace, bazel, bazel_args, *command):
+    start = time.time()
+    subprocess.check_call(
+        [bazel] + list(command[:1]) + bazel_args + list(command[1:]),
+        cwd=workspace,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.time() - start
+
+
+def _loading(workspace, bazel, bazel_args):
+    """Times WORKSPACE evaluation and loading of the requirement() package."""
+    try:
+        # starts the server, not part of the measurement
+        _bazel(workspace, bazel, bazel_args, "info", "release")
+        workspace_time = _bazel(workspace, bazel, bazel_args, "query", "//external:*")
+        package_time = _bazel(workspace, bazel, bazel_args, "query", "//:all")
+    finally:
+        subprocess.call([bazel, "shutdown"], cwd=workspace)
+    return workspace_time, package_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=5000)
+    parser.add_argument("--bazel", default=shutil.which("bazel"))
+    parser.add_argument("--bazel-arg", action="append", default=[])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        lockfile = _lockfile(directory, args.packages)
+        start = time.time()
+        _generate(os.path.join(directory, "current"), lockfile)
+        generate_time = time.time() - start
+        _generate_legacy(os.path.join(directory, "legacy"), args.packages)
+
+        print("packages:           %d" % args.packages)
+        print("generation:         %.2fs" % generate_time)
+        for variant in ("legacy", "current"):
+            print(
+                "%-8s bzl+BUILD: %.1fMB"
+                % (variant, _size(os.path.join(directory, variant)) / 1e6)
+            )
+        if not args.bazel:
+            print("bazel not found, loading phase not measured")
+            return
+
+        for variant in ("legacy", "current"):
+            workspace = os.path.join(directory, "ws_" + variant)
+            _workspace(workspace, os.path.join(directory, variant), args.packages)
+            workspace_time, package_time = _loading(
+                workspace, args.bazel, args.bazel_arg
+            )
+            print("%-8s WORKSPACE: %.2fs" % (variant, workspace_time))
+            print("%-8s BUILD:     %.2fs" % (variant, package_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,53 @@
 
 pip_vendor_label = Label("@com_github_ali5h_rules_pip//:third_party/py/BUILD")
 
+# keep in sync with PREBUILT_BUILD_FILE in piptool.py
+_PREBUILT_BUILD_FILE = "BUILD.whl"
+
 def _execute(repository_ctx, arguments, quiet = False):
     pip_vendor = str(repository_ctx.path(pip_vendor_label).dirname)
     return repository_ctx.execute(arguments, environment = {
         "PYTHONPATH": pip_vendor,
     }, timeout = repository_ctx.attr.timeout, quiet = quiet)
 
+def _native_build_args(repository_ctx):
+    """Arguments of piptool.py and whl.py configuring sdist builds."""
+    args = []
+    if repository_ctx.attr.compiler_cache:
+        args += ["--compiler-cache", repository_ctx.attr.compiler_cache]
+    if repository_ctx.attr.build_jobs:
+        args += ["--build-jobs", str(repository_ctx.attr.build_jobs)]
+    if repository_ctx.attr.build_slots:
+        args += ["--build-slots", str(repository_ctx.attr.build_slots)]
+    for package, cost in repository_ctx.attr.build_costs.items():
+        args += ["--build-cost", "%s=%s" % (package, cost)]
+    return args
+
+def _wheelhouse_pip_args(pip_args, wheelhouse):
+    """Drops the pip arguments the index of the wheelhouse replaces.
+
+    pip ignores the index with --no-index, and would still list the whole
+    wheelhouse with a --find-links of it.
+    """
+    wheelhouse = wheelhouse.rstrip("/")
+    result = []
+    skip = False
+    for i, arg in enumerate(pip_args):
+        if skip:
+            skip = False
+            continue
+        name, sep, value = arg.partition("=")
+        if arg == "--no-index":
+            continue
+        if arg in ("-f", "--find-links") and i + 1 < len(pip_args):
+            if pip_args[i + 1].rstrip("/") == wheelhouse:
+                skip = True
+                continue
+        if sep and name == "--find-links" and value.rstrip("/") == wheelhouse:
+            continue
+        result.append(arg)
+    return result
+
 def _pip_import_impl(repository_ctx):
     """Core implementation of pip_import."""
 
@@ -18,24 +59,49 @@ def _pip_import_impl(repository_ctx):
     repository_ctx.file("BUILD", "")
     reqs = repository_ctx.read(repository_ctx.attr.requirements)
 
-    # make a copy for compile
-    repository_ctx.file("requirements.txt", content = reqs, executable = False)
+    pip_args = repository_ctx.attr.pip_args
+    pip_index_args = []
+    if repository_ctx.attr.wheelhouse:
+        index_args = ["--output", repository_ctx.path("simple")]
+        if repository_ctx.attr.cache_dir:
+            index_args = ["--cache-dir", repository_ctx.attr.cache_dir]
+        result = _execute(repository_ctx, [
+            python_interpreter,
+            repository_ctx.path(repository_ctx.attr._index_script),
+            "--wheelhouse",
+            repository_ctx.attr.wheelhouse,
+        ] + index_args, quiet = True)
+        if result.return_code:
+            fail("index failed: %s (%s)" % (result.stdout, result.stderr))
+        pip_index_args = ["--index-url", result.stdout.strip()]
+
+        pip_args = _wheelhouse_pip_args(pip_args, repository_ctx.attr.wheelhouse)
+
     if repository_ctx.attr.compile:
+        repository_ctx.file("requirements.in", content = reqs, executable = False)
+        resolution_args = []
+        if repository_ctx.attr.cache_dir:
+            resolution_args = ["--resolution-cache", repository_ctx.attr.cache_dir]
         result = _execute(repository_ctx, [
             python_interpreter,
             repository_ctx.path(repository_ctx.attr._compiler),
+        ] + resolution_args + pip_index_args + [
             "--quiet",
             "--allow-unsafe",
             "--no-emit-trusted-host",
             "--build-isolation",
             "--no-emit-find-links",
             "--no-header",
-            "--no-index",
+            "--no-emit-index-url",
             "--no-annotate",
+            "--output-file",
             repository_ctx.path("requirements.txt"),
+            repository_ctx.path("requirements.in"),
         ], quiet = repository_ctx.attr.quiet)
         if result.return_code:
             fail("pip_compile failed: %s (%s)" % (result.stdout, result.stderr))
+    else:
+        repository_ctx.file("requirements.txt", content = reqs, executable = False)
 
     args = [
         python_interpreter,
@@ -57,10 +123,68 @@ def _pip_import_impl(repository_ctx):
     for label, pipdep in repository_ctx.attr.overrides.items():
         args += ["--override=%s=%s" % (label, pipdep)]
 
+    cache_args = []
+    if repository_ctx.attr.cache_dir:
+        cache_args = [
+            "--cache-dir",
+            repository_ctx.attr.cache_dir,
+            "--cache-max-size",
+            repository_ctx.attr.cache_max_size,
+        ]
+    args += cache_args
+    trace_args = []
+    if repository_ctx.attr.trace_dir:
+        trace_args = ["--trace-dir", repository_ctx.attr.trace_dir]
+    args += trace_args
+    if repository_ctx.attr.index_proxy:
+        args += ["--index-proxy"]
+
+    if repository_ctx.attr.batch:
+        args += ["--manifest", repository_ctx.path("manifest.json")]
+    if repository_ctx.attr.precompile:
+        args += ["--precompile"]
+    if repository_ctx.attr.zipped:
+        args += ["--zipped"]
+    for package in repository_ctx.attr.zip_exclude:
+        args += ["--zip-exclude", package]
+    args += ["--namespace-style", repository_ctx.attr.namespace_style]
+    args += _native_build_args(repository_ctx)
+    args += pip_index_args
+    if repository_ctx.attr.resolve_urls:
+        args += ["--resolve-urls"]
+    if repository_ctx.attr.dependency_graph:
+        args += ["--dependency-graph"]
+    if repository_ctx.attr.share_wheels:
+        args += ["--share-wheels"]
+    if (repository_ctx.attr.resolve_urls or repository_ctx.attr.dependency_graph or
+        repository_ctx.attr.share_wheels):
+        args += pip_args
+
     result = _execute(repository_ctx, args, quiet = repository_ctx.attr.quiet)
     if result.return_code:
         fail("pip_import failed: %s (%s)" % (result.stdout, result.stderr))
 
+    if repository_ctx.attr.batch:
+        # arguments of whl.py, the pip arguments follow them
+        whl_args = ["--namespace-style", repository_ctx.attr.namespace_style]
+        whl_args += _native_build_args(repository_ctx)
+        if repository_ctx.attr.precompile:
+            whl_args += ["--precompile"]
+        if repository_ctx.attr.index_proxy:
+            whl_args += ["--index-proxy"]
+        if "--timeout" not in pip_args:
+            pip_args = pip_args + ["--timeout", str(repository_ctx.attr.timeout)]
+        result = _execute(repository_ctx, [
+            python_interpreter,
+            repository_ctx.path(repository_ctx.attr._whl_script),
+            "--manifest",
+            repository_ctx.path("manifest.json"),
+            "--jobs",
+            str(repository_ctx.attr.batch_jobs),
+        ] + cache_args + trace_args + whl_args + pip_index_args + pip_args, quiet = repository_ctx.attr.quiet)
+        if result.return_code:
+            fail("pip_import failed: %s (%s)" % (result.stdout, result.stderr))
+
 pip_import = repository_rule(
     attrs = {
         "requirements": attr.label(
@@ -79,9 +203,13 @@ If the label is specified it will overwrite the python_interpreter attribute.
         "repo_prefix": attr.string(default = "pypi", doc = """
 The prefix for the bazel repository name.
 """),
-        "compile": attr.bool(
-            default = False,
-        ),
+        "compile": attr.bool(default = False, doc = """
+Resolve requirements with pip-compile at fetch time. With cache_dir the
+resolution is cached, keyed by the requirements, the interpreter and the local
+find-links, and the previous resolution is reused for unchanged requirements.
+Resolutions against remote indexes, pip's default index included, are cached
+for a day.
+"""),
         "overrides": attr.label_keyed_string_dict(doc = """
 Specify to replace certain pip dependencies with bazel dependencies.
 
@@ -96,12 +224,131 @@ pip_import(
 This replaces "protobuf" with the bazel version even for indirect dependencies on it.
 """),
         "timeout": attr.int(default = 1200, doc = "Timeout for pip actions"),
+        "cache_dir": attr.string(doc = """
+Directory of a content-addressed store shared by all whl_library fetches.
+Downloaded or built wheels and the unpacked repositories are kept there, so
+re-fetching a package only links files, and resolutions of compile. Caching is
+disabled if empty.
+"""),
+        "cache_max_size": attr.string(default = "10G", doc = """
+Least recently used entries are evicted when the store grows beyond this size.
+Fetches check the size of the store at most every ten minutes.
+"""),
+        "batch": attr.bool(default = False, doc = """
+Install all packages while fetching pip_import, in a single process. whl_library
+rules then only link the installed packages. pip_args of pip_install are not used
+for these packages, set pip_args here instead.
+"""),
+        "batch_jobs": attr.int(default = 8, doc = """
+Packages installed in parallel by batch. Unpacking wheels and generating BUILD
+files run in parallel, pip runs one download or sdist build at a time.
+"""),
+        "pip_args": attr.string_list(default = [], doc = "pip arguments used by batch."),
+        "precompile": attr.bool(default = False, doc = """
+Byte-compile the packages at fetch time into hash based pycs (PEP 552) for
+python_interpreter, and ship them in the data of the generated targets.
+"""),
+        "zipped": attr.bool(default = False, doc = """
+Pack the pure python packages of each whl_library into a single zip that is
+imported with zipimport. Native extensions, packages with data files and
+namespace packages stay extracted.
+"""),
+        "zip_exclude": attr.string_list(default = [], doc = """
+Packages that are never zipped, e.g. because they read files relative to
+__file__.
+"""),
+        "namespace_style": attr.string(default = "pkgutil", values = ["pkgutil", "pep420"], doc = """
+How namespace packages are made importable. pkgutil adds pkgutil style
+__init__.py files to the namespace packages found from namespace_packages.txt,
+top_level.txt and RECORD, pep420 leaves them as implicit namespace packages.
+"""),
+        "resolve_urls": attr.bool(default = False, doc = """
+Resolve the wheel of every requirement to a url and sha256 at import time,
+with pip_args and the wheelhouse index. whl_library then downloads the wheel
+with bazel, through the repository cache and --distdir, instead of with pip.
+Only wheels whose sha256 is listed in the requirements file, given by the index
+or computable from a local file are used, other packages are installed by pip.
+"""),
+        "dependency_graph": attr.bool(default = False, doc = """
+Read the dependencies of every requirement at import time, from wheels in the
+find-links of pip_args, the wheelhouse or cache_dir, or from the metadata files
+of the index (PEP 658). Every whl_library then refers to all the repositories
+it transitively needs, so bazel fetches them at once instead of level by
+level, and mapping.bzl gets the dependencies dict and transitive_requirements.
+Packages without available metadata find their dependencies when fetched.
+"""),
+        "compiler_cache": attr.string(doc = """
+Launcher the compilers of sdist builds are wrapped with, e.g. ccache or
+sccache. Its cache is kept in cache_dir unless CCACHE_DIR or SCCACHE_DIR are
+set, and ccache gets the temporary directory as CCACHE_BASEDIR so builds in
+pip's random build directories hit. Ignored if it is not on PATH.
+"""),
+        "build_jobs": attr.int(default = 0, doc = """
+Number of parallel compile jobs of sdist builds: build_ext --parallel through
+DIST_EXTRA_CONFIG, MAKEFLAGS and the job variables of cmake, numpy, grpcio and
+pytorch style builds. 0 keeps the defaults of every build.
+"""),
+        "build_slots": attr.int(default = 0, doc = """
+Size of a token pool shared by the sdist builds of all whl_library fetches,
+and build_wheels runs, of the machine. A build waits until it gets build_jobs
+tokens, or its build_costs, so concurrent fetches do not oversubscribe the
+cpus or the memory. Set it to about the number of cpus, 0 does not limit
+builds.
+"""),
+        "build_costs": attr.string_dict(doc = """
+Tokens the build of a package takes instead of build_jobs, e.g.
+{"grpcio": "8"} for builds needing a lot of memory.
+"""),
+        "trace_dir": attr.string(doc = """
+Absolute directory the import and every whl_library fetch write a trace of
+their phases to: downloads, sdist builds, installs, store hits and BUILD
+generation, with their bytes and file counts. Merge them into one timeline,
+and list the slowest packages, with src/tracing.py.
+"""),
+        "index_proxy": attr.bool(default = False, doc = """
+Talk to the http indexes of pip_args through a local caching proxy, started on
+demand by the first fetch and shared by the others until it is idle for ten
+minutes. It pools keep-alive connections to the indexes, caches their pages
+and revalidates them, and keeps the files whose sha256 the index lists in
+cache_dir, or in the temporary directory of the machine. pip's default index
+is proxied unless pip_args name one.
+"""),
+        "share_wheels": attr.bool(default = False, doc = """
+Install pure python wheels, and abi3 wheels, into repositories named after the
+package and version only, e.g. @pypi__3__six_1_16_0, which every pip_import
+pinning the same version shares whatever its python version. The repository
+of the package then only adds the dependencies of this pip_import. The wheels
+are found at import time with pip_args and the wheelhouse index, packages
+without a wheel keep a repository per python version. Shared repositories are
+never precompiled, and the first pip_install defining one sets its zipped and
+namespace_style.
+"""),
+        "wheelhouse": attr.string(doc = """
+Directory of wheels to index into a PEP 503 simple index. The index is passed
+as --index-url to pip in front of pip_args, so pip reads one page per package
+instead of listing the whole directory. --no-index and the --find-links of the
+wheelhouse are dropped from pip_args, --no-index also from the pip_args of
+pip_install. It is kept in cache_dir if set and
+refreshed incrementally when wheels are added.
+"""),
         "_script": attr.label(
             executable = True,
             default = Label("@com_github_ali5h_rules_pip//src:piptool.py"),
             allow_single_file = True,
             cfg = "host",
         ),
+        "_whl_script": attr.label(
+            executable = True,
+            default = Label("@com_github_ali5h_rules_pip//src:whl.py"),
+            allow_single_file = True,
+            cfg = "host",
+        ),
+        "_index_script": attr.label(
+            executable = True,
+            default = Label("@com_github_ali5h_rules_pip//src:index.py"),
+            allow_single_file = True,
+            cfg = "host",
+        ),
         "_compiler": attr.label(
             executable = True,
             default = Label("@com_github_ali5h_rules_pip//src:compile.py"),
@@ -116,13 +363,59 @@ This replaces "protobuf" with the bazel version even for indirect dependencies o
     implementation = _pip_import_impl,
 )
 
+def _link_prebuilt(repository_ctx):
+    """Links a package installed by pip_import with batch set."""
+    requirements = repository_ctx.path(
+        Label("%s//:requirements.bzl" % repository_ctx.attr.requirements_repo),
+    )
+    packages = requirements.dirname.get_child("packages")
+    prebuilt = packages.get_child(repository_ctx.attr.prebuilt)
+    for child in prebuilt.readdir():
+        name = child.basename
+        if name == _PREBUILT_BUILD_FILE:
+            name = "BUILD"
+        repository_ctx.symlink(child, name)
+
+def _wrap_shared(repository_ctx, python_interpreter):
+    """Adds the dependencies of the pip_import to a shared repository."""
+    shared_repo = repository_ctx.attr.shared_repo
+    shared = repository_ctx.path(Label("%s//:BUILD" % shared_repo)).dirname
+    args = [
+        python_interpreter,
+        repository_ctx.path(repository_ctx.attr._script),
+        "--requirements",
+        repository_ctx.attr.requirements_repo,
+        "--directory",
+        repository_ctx.path("."),
+        "--shared-repo",
+        shared_repo,
+        "--shared-directory",
+        shared,
+    ]
+    args += ["--extras=%s" % extra for extra in repository_ctx.attr.extras]
+    for label, pipdep in repository_ctx.attr.overrides.items():
+        args += ["--override=%s=%s" % (label, pipdep)]
+    if repository_ctx.attr.dependencies:
+        args += ["--dependencies", json.encode(repository_ctx.attr.dependencies)]
+    result = _execute(repository_ctx, args, quiet = repository_ctx.attr.quiet)
+    if result.return_code:
+        fail("whl_library failed: %s (%s)" % (result.stdout, result.stderr))
+
 def _whl_impl(repository_ctx):
     """Core implementation of whl_library."""
 
+    if repository_ctx.attr.prebuilt:
+        _link_prebuilt(repository_ctx)
+        return
+
     python_interpreter = repository_ctx.attr.python_interpreter
     if repository_ctx.attr.python_runtime:
         python_interpreter = repository_ctx.path(repository_ctx.attr.python_runtime)
 
+    if repository_ctx.attr.shared_repo:
+        _wrap_shared(repository_ctx, python_interpreter)
+        return
+
     pip_args = repository_ctx.attr.pip_args
     if "--timeout" not in repository_ctx.attr.pip_args:
         pip_args = repository_ctx.attr.pip_args + ["--timeout", str(repository_ctx.attr.timeout)]
@@ -141,6 +434,25 @@ def _whl_impl(repository_ctx):
         "--package",
         repository_ctx.attr.pkg,
     ]
+    if repository_ctx.attr.version:
+        args += ["--version", repository_ctx.attr.version]
+    if repository_ctx.attr.cache_dir:
+        args += [
+            "--cache-dir",
+            repository_ctx.attr.cache_dir,
+            "--cache-max-size",
+            repository_ctx.attr.cache_max_size,
+        ]
+    if repository_ctx.attr.precompile:
+        args += ["--precompile"]
+    if repository_ctx.attr.zipped:
+        args += ["--zipped"]
+    args += ["--namespace-style", repository_ctx.attr.namespace_style]
+    args += _native_build_args(repository_ctx)
+    if repository_ctx.attr.trace_dir:
+        args += ["--trace-dir", repository_ctx.attr.trace_dir]
+    if repository_ctx.attr.index_proxy:
+        args += ["--index-proxy"]
     if repository_ctx.attr.extras:
         args += [
             "--extras=%s" % extra
@@ -149,6 +461,20 @@ def _whl_impl(repository_ctx):
     for label, pipdep in repository_ctx.attr.overrides.items():
         args += ["--override=%s=%s" % (label, pipdep)]
 
+    if repository_ctx.attr.dependencies:
+        args += ["--dependencies", json.encode(repository_ctx.attr.dependencies)]
+    if repository_ctx.attr.shared:
+        args += ["--shared"]
+
+    if repository_ctx.attr.url:
+        wheel = repository_ctx.path("_wheel/" + repository_ctx.attr.filename)
+        repository_ctx.download(
+            url = repository_ctx.attr.url,
+            output = wheel,
+            sha256 = repository_ctx.attr.sha256,
+        )
+        args += ["--wheel", wheel]
+
     args += pip_args
 
     result = _execute(repository_ctx, args, quiet = repository_ctx.attr.quiet)
@@ -158,6 +484,7 @@ def _whl_impl(repository_ctx):
 whl_library = repository_rule(
     attrs = {
         "pkg": attr.string(),
+        "version": attr.string(),
         "requirements_repo": attr.string(),
         "extras": attr.string_list(),
         "python_interpreter": attr.string(default = "python", doc = """
@@ -171,6 +498,32 @@ If the label is specified it will overwrite the python_interpreter attribute.
         "pip_args": attr.string_list(default = []),
         "timeout": attr.int(default = 1200, doc = "Timeout for pip actions"),
         "overrides": attr.label_keyed_string_dict(),
+        "cache_dir": attr.string(),
+        "cache_max_size": attr.string(default = "10G"),
+        "prebuilt": attr.string(doc = "Package directory of a pip_import with batch set."),
+        "precompile": attr.bool(default = False, doc = "Ship hash based pycs of the package."),
+        "zipped": attr.bool(default = False, doc = "Pack pure python packages into a zip."),
+        "namespace_style": attr.string(default = "pkgutil", values = ["pkgutil", "pep420"]),
+        "compiler_cache": attr.string(doc = "Launcher wrapping the compilers of sdist builds."),
+        "build_jobs": attr.int(default = 0, doc = "Parallel compile jobs of sdist builds."),
+        "build_slots": attr.int(default = 0, doc = "Tokens of the pool of sdist builds."),
+        "build_costs": attr.string_dict(doc = "Tokens the build of a package takes."),
+        "trace_dir": attr.string(doc = "Directory the fetch writes a trace of its phases to."),
+        "index_proxy": attr.bool(default = False, doc = "Download through the local index proxy."),
+        "url": attr.string(doc = "Url of the wheel, downloaded by bazel instead of pip."),
+        "filename": attr.string(doc = "File name of the wheel at url."),
+        "sha256": attr.string(doc = "Expected sha256 of the wheel at url."),
+        "shared": attr.bool(default = False, doc = """
+Shared by the pip_imports of all python versions, no dependencies are added.
+"""),
+        "shared_repo": attr.string(doc = """
+Shared repository of the package, e.g. @pypi__3__six_1_16_0. Only targets
+adding the dependencies to the shared targets are generated.
+"""),
+        "dependencies": attr.string_list_dict(doc = """
+Requirements of the package, key "", and of its extras, resolved by pip_import.
+Read from the wheel if empty.
+"""),
         "_script": attr.label(
             executable = True,
             default = Label("@com_github_ali5h_rules_pip//src:whl.py"),
@@ -193,12 +546,22 @@ def py_pytest_test(
             "-p",
             "no:cacheprovider",
         ],
+        shard_durations = None,
+        profile = None,
         **kwargs):
     """A macro that runs pytest tests by using a test runner.
 
+    With shard_count set, every shard runs its share of the tests. The results
+    are written as JUnit XML to XML_OUTPUT_FILE.
+
     Args:
         name: A unique name for this rule.
         pytest_args: a list of arguments passed to pytest
+        shard_durations: json file mapping test ids to seconds, e.g. merged
+            from the pytest_durations.json outputs of earlier runs, used to
+            balance the shards
+        profile: "session" or "test" to run the whole session or every test
+            under cProfile, the profiles are written to the undeclared outputs
         **kwargs: are passed to py_test, with srcs and deps attrs modified
     """
 
@@ -208,6 +571,12 @@ def py_pytest_test(
     deps = kwargs.pop("deps", []) + ["@com_github_ali5h_rules_pip//src:pytest_helper"]
     srcs = kwargs.pop("srcs", []) + ["@com_github_ali5h_rules_pip//src:pytest_helper"]
     args = kwargs.pop("args", []) + pytest_args
+    data = kwargs.pop("data", [])
+    if shard_durations:
+        data = data + [shard_durations]
+        args = args + ["--shard-durations=$(rootpath %s)" % shard_durations]
+    if profile:
+        args = args + ["--rules-pip-profile=%s" % profile]
 
     # failsafe, pytest won't work otw.
     for src in srcs:
@@ -221,5 +590,6 @@ def py_pytest_test(
         main = "pytest_helper.py",
         deps = deps,
         args = args,
+        data = data,
         **kwargs
     )
@@ -0,0 +1,186 @@
+"""builds the missing wheels of a compiled requirements file into a wheelhouse
+
+Every pinned requirement without a compatible wheel in the wheelhouse or in the
+--find-links directories is downloaded, or built from its sdist, in a pool of
+processes with the reproducible build environment of whl.py. whl_library then
+unpacks the wheels directly when the wheelhouse is passed as --find-links, so
+sdists are built once per interpreter instead of in every first fetch.
+"""
+import argparse
+import concurrent.futures
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import jobserver
+import piptool
+import whl
+
+
+def missing_wheels(requirements, wheelhouse, pip_args):
+    """Finds the pinned requirements that have no compatible wheel.
+
+    Args:
+        requirements: path to a compiled requirements file
+        wheelhouse: directory of built wheels
+        pip_args: extra pip args, their --find-links directories are searched too
+    Returns:
+        list: (name, version) of the packages to build, sorted by name
+    """
+    search_dirs = [wheelhouse] + whl._option_values(pip_args, "--find-links", "-f")
+    supported = whl.supported_tags(pip_args)
+    missing = {}
+    for name, version, _ in piptool.parse_pinned_requirements(requirements):
+        key = whl._canonical_name(name)
+        if key in missing:
+            continue
+        if whl.find_wheel(name, version, search_dirs, supported) is None:
+            missing[key] = (name, version)
+    return [missing[key] for key in sorted(missing)]
+
+
+def build_wheel(name, version, wheelhouse, pip_args):
+    """Downloads or builds the wheel of a pinned package into the wheelhouse.
+
+    Args:
+        name: package name
+        version: pinned version
+        wheelhouse: destination directory
+        pip_args: extra pip args sent to pip
+    Returns:
+        tuple: path to the wheel in the wheelhouse, seconds spent building it
+            or None if it was downloaded
+    """
+    tmp = tempfile.mkdtemp()
+    build_times = {}
+    try:
+        requirement = "%s==%s" % (name, version)
+        wheel = whl.download_wheel(requirement, tmp, pip_args, build_times)
+        target = os.path.join(wheelhouse, os.path.basename(wheel))
+        # concurrent builders and readers of the wheelhouse never see a
+        # partial wheel
+        fd, partial = tempfile.mkstemp(dir=wheelhouse, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(wheel, partial)
+        os.replace(partial, target)
+        return target, build_times.get(requirement)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def build_wheels(packages, wheelhouse, pip_args, jobs, build_times=None):
+    """Builds wheels in parallel, one pip process per package.
+
+    Args:
+        packages: list of (name, version)
+        wheelhouse: destination directory
+        pip_args: extra pip args sent to pip
+        jobs: number of parallel builds
+        build_times: dict the seconds spent building each wheel from its sdist
+            are recorded in, by package name
+    Returns:
+        tuple: map from package name to wheel path, map from package name to
+            the error of the failed builds
+    """
+    built = {}
+    failed = {}
+    if not packages:
+        return built, failed
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(build_wheel, name, version, wheelhouse, pip_args): name
+            for name, version in packages
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                built[name], seconds = future.result()
+                if seconds is not None and build_times is not None:
+                    build_times[name] = seconds
+            except Exception as e:
+                failed[name] = e
+    return built, failed
+
+
+def main():
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(
+        description="Build the missing wheels of a requirements file into a "
+        "wheelhouse, other arguments are passed to pip."
+    )
+    parser.add_argument(
+        "--requirements",
+        action="store",
+        required=True,
+        help="The compiled requirements.txt file.",
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        action="store",
+        required=True,
+        help="Directory to write the wheels to.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of wheels built in parallel.",
+    )
+    parser.add_argument(
+        "--compiler-cache",
+        action="store",
+        help="Wrap the compilers with this launcher, e.g. ccache or sccache.",
+    )
+    parser.add_argument(
+        "--build-jobs",
+        type=int,
+        default=0,
+        help="Number of parallel compile jobs of every build.",
+    )
+    parser.add_argument(
+        "--build-slots",
+        type=int,
+        default=0,
+        help="Tokens of the pool shared with the builds of whl_library "
+        + "fetches, 0 only limits the builds with --jobs.",
+    )
+    parser.add_argument(
+        "--build-cost",
+        action="append",
+        default=[],
+        help="Tokens the build of a package takes, e.g. grpcio=8.",
+    )
+    args, pip_args = parser.parse_known_args()
+
+    # inherited by the workers and the build backends they run
+    whl.configure_reproducible_wheels()
+    whl.configure_native_builds(args.compiler_cache, args.build_jobs)
+    if args.build_slots:
+        jobserver.configure(
+            jobserver.default_directory(),
+            args.build_slots,
+            jobserver.parse_costs(args.build_cost),
+            max(1, args.build_jobs),
+        )
+
+    wheelhouse = os.path.abspath(os.path.expanduser(args.wheelhouse))
+    if not os.path.isdir(wheelhouse):
+        os.makedirs(wheelhouse)
+    packages = missing_wheels(args.requirements, wheelhouse, pip_args)
+    build_times = {}
+    built, failed = build_wheels(packages, wheelhouse, pip_args, args.jobs, build_times)
+    for name in sorted(built):
+        print(built[name])
+    # slowest builds first, the candidates for a prebuilt wheel
+    for name, seconds in sorted(build_times.items(), key=lambda item: -item[1]):
+        print("built %s in %.1fs" % (name, seconds), file=sys.stderr)
+    for name in sorted(failed):
+        logging.error("building %s failed: %s", name, failed[name])
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,337 @@
+"""pip-compile with a cache of resolved requirements
+
+With --resolution-cache the output of pip-compile is kept in the store, keyed
+by the content of the input files, the interpreter, the pip-compile options and
+the listing of local find-links and indexes. The content of remote indexes is
+not known, resolutions against them, pip's default index included, are also
+keyed by a time bucket of --resolution-ttl seconds, so new releases are picked
+up once it expires. A hit writes the cached output without running the
+resolver. On a miss the previous output written to the same
+file is restored first, pip-compile keeps its pins and only re-resolves the
+requirements that changed and their dependencies.
+"""
+import argparse
+import hashlib
 import logging
+import os
+import shlex
+import shutil
+import tempfile
+import time
 
 from piptools.scripts import compile
 
-if __name__ == "__main__":
+import store
+
+# bump to invalidate every cached resolution
+CACHE_VERSION = 1
+
+# seconds a resolution against a remote index is reused
+DEFAULT_TTL = 24 * 60 * 60
+# pip's default index
+DEFAULT_INDEX = "https://pypi.org/simple"
+
+_SEEDS = "seeds"
+
+# options that do not change the resolution
+_UNKEYED_OPTIONS = frozenset(
+    ["src_files", "output_file", "cache_dir", "verbose", "quiet", "dry_run", "rebuild"]
+)
+
+_INCLUDE_OPTIONS = ("-r", "--requirement", "-c", "--constraint")
+_TRUE_VALUES = ("1", "true", "yes", "on")
+_LOCATION_OPTIONS = ("-i", "--index-url", "--extra-index-url", "-f", "--find-links")
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _included_files(path):
+    """Finds the files included by a requirements file with -r and -c."""
+    included = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split("#", 1)[0].split()
+            if not parts:
+                continue
+            for option in _INCLUDE_OPTIONS:
+                if parts[0] == option and len(parts) == 2:
+                    included.append(parts[1])
+                elif parts[0].startswith(option + "="):
+                    included.append(parts[0][len(option) + 1 :])
+    return [os.path.join(os.path.dirname(path), p) for p in included]
+
+
+def input_digests(src_files):
+    """Hashes the input files and the files they include.
+
+    Args:
+        src_files: paths of the requirements files passed to pip-compile
+    Returns:
+        dict: map from path to sha256 of the content
+    """
+    digests = {}
+    pending = list(src_files)
+    while pending:
+        path = os.path.normpath(pending.pop())
+        if path in digests or not os.path.isfile(path):
+            continue
+        digests[path] = _file_digest(path)
+        if os.path.basename(path) not in compile.METADATA_FILENAMES:
+            pending.extend(_included_files(path))
+    return digests
+
+
+def _local_path(location):
+    if location.startswith("file://"):
+        return location[len("file://") :]
+    if "://" in location:
+        return None
+    return location
+
+
+def location_listing(location):
+    """Describes the content of a find-links or index location.
+
+    Args:
+        location: path or url
+    Returns:
+        list: name and size of the files of a local directory, the location
+            itself for remote indexes whose content is not known
+    """
+    path = _local_path(location)
+    if path is None or not os.path.isdir(path):
+        return [location]
+    listing = []
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            listing.append(
+                [os.path.relpath(file_path, path), os.path.getsize(file_path)]
+            )
+    return sorted(listing)
+
+
+def _locations(params, environ):
+    """Lists the find-links and indexes of a pip-compile invocation.
+
+    Args:
+        params: parsed pip-compile options
+        environ: environment variables
+    Returns:
+        list: paths and urls, pip's default index if no other index is set
+    """
+    locations = list(params["find_links"]) + list(params["extra_index_url"])
+    if params["index_url"]:
+        locations.append(params["index_url"])
+    pip_args = shlex.split(params["pip_args_str"] or "")
+    for i, arg in enumerate(pip_args):
+        name, sep, value = arg.partition("=")
+        if name in _LOCATION_OPTIONS:
+            locations.append(value if sep else "".join(pip_args[i + 1 : i + 2]))
+    for var in ("PIP_INDEX_URL", "PIP_EXTRA_INDEX_URL", "PIP_FIND_LINKS"):
+        locations.extend(environ.get(var, "").split())
+    no_index = "--no-index" in pip_args or (
+        environ.get("PIP_NO_INDEX", "").lower() in _TRUE_VALUES
+    )
+    index_url = (
+        params["index_url"]
+        or environ.get("PIP_INDEX_URL")
+        or any(arg.split("=")[0] in ("-i", "--index-url") for arg in pip_args)
+    )
+    if not no_index and not index_url:
+        locations.append(DEFAULT_INDEX)
+    return locations
+
+
+def _interpreter():
+    from pip._vendor.packaging.markers import default_environment
+    from pip._internal.utils.compatibility_tags import get_supported
+
+    return [default_environment(), str(get_supported()[0])]
+
+
+def resolution_key(params, environ=None, ttl=DEFAULT_TTL, now=None):
+    """Computes the cache key of a pip-compile invocation.
+
+    Args:
+        params: parsed pip-compile options
+        environ: environment variables, os.environ by default
+        ttl: seconds a resolution against a remote index is reused, 0 to not
+            cache them
+        now: current time, time.time() by default
+    Returns:
+        str: the key, None if the invocation can not be cached
+    """
+    environ = os.environ if environ is None else environ
+    src_files = params["src_files"]
+    if not src_files or "-" in src_files or params["dry_run"]:
+        return None
+    options = {k: v for k, v in params.items() if k not in _UNKEYED_OPTIONS}
+    locations = _locations(params, environ)
+    bucket = None
+    if any(_local_path(location) is None for location in locations):
+        # new releases on remote indexes are not part of the listings
+        if not ttl:
+            return None
+        bucket = int((time.time() if now is None else now) // ttl)
+    return store.digest(
+        bucket,
+        CACHE_VERSION,
+        _interpreter(),
+        options,
+        sorted(input_digests(src_files).values()),
+        {location: location_listing(location) for location in locations},
+        {
+            k: v
+            for k, v in environ.items()
+            if k.startswith("PIP_") or k == "CUSTOM_COMPILE_COMMAND"
+        },
+    )
+
+
+def output_path(params):
+    """Finds the file pip-compile writes to.
+
+    Args:
+        params: parsed pip-compile options
+    Returns:
+        str: absolute path of the output file
+    """
+    if params["output_file"] is not None:
+        return os.path.abspath(params["output_file"].name)
+    src_file = params["src_files"][0]
+    if os.path.basename(src_file) in compile.METADATA_FILENAMES:
+        return os.path.abspath(
+            os.path.join(
+                os.path.dirname(src_file), compile.DEFAULT_REQUIREMENTS_OUTPUT_FILE
+            )
+        )
+    return os.path.abspath(src_file.rsplit(".", 1)[0] + ".txt")
+
+
+def _seed_file(root, output):
+    name = hashlib.sha256(output.encode("utf-8")).hexdigest()
+    return os.path.join(root, _SEEDS, name)
+
+
+def _copy(src, dst):
+    """Copies src over dst atomically."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst))
+    os.close(fd)
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _lookup(root, key):
+    cached = store.lookup(root, "locks", key)
+    if cached is None:
+        return None
+    return os.path.join(cached, os.listdir(cached)[0])
+
+
+def _seed(root, output):
+    """Restores the previous output of pip-compile if it is missing."""
+    try:
+        with open(_seed_file(root, output)) as f:
+            key = f.read().strip()
+    except OSError:
+        return
+    cached = _lookup(root, key)
+    if cached is not None and not os.path.exists(output):
+        logging.info("seeding %s with the previous resolution", output)
+        _copy(cached, output)
+
+
+def _remember(root, output, key):
+    # stores a copy, the output is a hardlink to the entry otherwise
+    tmp = tempfile.mkdtemp()
+    try:
+        lock = os.path.join(tmp, os.path.basename(output))
+        shutil.copyfile(output, lock)
+        store.add(root, "locks", key, lock)
+    finally:
+        shutil.rmtree(tmp)
+    seed = _seed_file(root, output)
+    if not os.path.isdir(os.path.dirname(seed)):
+        os.makedirs(os.path.dirname(seed), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(seed))
+    with os.fdopen(fd, "w") as f:
+        f.write(key)
+    os.replace(tmp, seed)
+
+
+def _resolve(args):
+    try:
+        compile.cli(args, prog_name="pip-compile")
+    except SystemExit as e:
+        if e.code:
+            raise
+
+
+def cached_compile(root, args, ttl=DEFAULT_TTL):
+    """Runs pip-compile unless the resolution is cached.
+
+    Args:
+        root: store directory
+        args: pip-compile arguments
+        ttl: seconds a resolution against a remote index is reused, see
+            resolution_key
+    """
+    try:
+        params = compile.cli.make_context("pip-compile", list(args)).params
+    except Exception:
+        # let pip-compile report the usage error
+        return _resolve(args)
+    key = resolution_key(params, ttl=ttl)
+    if key is None:
+        return _resolve(args)
+
+    output = output_path(params)
+    upgrade = params["upgrade"] or params["upgrade_packages"]
+    cached = None if upgrade else _lookup(root, key)
+    if cached is not None:
+        logging.info("using the cached resolution %s", key)
+        _copy(cached, output)
+        return
+    if not upgrade:
+        _seed(root, output)
+    _resolve(args)
+    _remember(root, output, key)
+
+
+def main(argv=None):
     logging.basicConfig()
-    compile.cli()
+    parser = argparse.ArgumentParser(
+        description="pip-compile with a resolution cache, "
+        "other arguments are passed to pip-compile.",
+        add_help=False,
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--resolution-cache",
+        action="store",
+        help="Store directory to cache resolved requirements in. Resolutions "
+        + "against local find-links and indexes are reused until their files "
+        + "change, those against remote indexes, pip's default index "
+        + "included, for --resolution-ttl seconds.",
+    )
+    parser.add_argument(
+        "--resolution-ttl",
+        type=int,
+        default=DEFAULT_TTL,
+        help="Seconds a resolution against a remote index is reused, 0 to "
+        + "always resolve against remote indexes.",
+    )
+    args, compile_args = parser.parse_known_args(argv)
+    if not args.resolution_cache:
+        return _resolve(compile_args)
+    cached_compile(
+        os.path.expanduser(args.resolution_cache), compile_args, args.resolution_ttl
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""times imports and attributes them to the whl_library repositories
+
+Enabled by setting RULES_PIP_IMPORTPROF, to 1 for writing the reports to
+TEST_UNDECLARED_OUTPUTS_DIR (or the working directory outside of tests), or to
+the directory to write them to. Two reports are written when the process exits:
+
+  importprof.json: self and cumulative import time per repository and module
+  importprof.folded: collapsed stacks, for flamegraph.pl or speedscope
+"""
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+ENV_VAR = "RULES_PIP_IMPORTPROF"
+
+# keep in sync with repository_name in piptool.py
+_REPOSITORY_RE = re.compile(r"^.*__\d+__\w+$")
+
+_STDLIB = "<stdlib>"
+_WORKSPACE = "<workspace>"
+
+
+def repository(path):
+    """Finds the whl_library repository a file belongs to.
+
+    Args:
+        path: path of a module, None for builtin modules
+    Returns:
+        str: repository name, <stdlib> or <workspace> for other modules
+    """
+    if not path or not os.path.isabs(path):
+        return _STDLIB
+    for segment in reversed(path.split(os.sep)):
+        if _REPOSITORY_RE.match(segment):
+            return segment
+    for prefix in (sys.base_prefix, sys.base_exec_prefix):
+        if path.startswith(prefix + os.sep) and "site-packages" not in path:
+            return _STDLIB
+    return _WORKSPACE
+
+
+class ImportTimer(object):
+    """Meta path finder that times the loaders of the modules it finds.
+
+    The finder never finds a module itself, it asks the finders after it and
+    patches exec_module of the loader instances they return. Loader types stay
+    unchanged, checks like isinstance(loader, SourceFileLoader) keep working.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # module name -> {"repository", "self", "cumulative", "importers"}
+        self.modules = {}
+        # collapsed stack -> self seconds
+        self.stacks = {}
+
+    def find_spec(self, fullname, path, target=None):
+        if getattr(self._local, "finding", False):
+            return None
+        self._local.finding = True
+        try:
+            spec = None
+            for finder in sys.meta_path[sys.meta_path.index(self) + 1 :]:
+                find_spec = getattr(finder, "find_spec", None)
+                spec = find_spec and find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+        finally:
+            self._local.finding = False
+        if spec is not None and spec.loader is not None:
+            self._patch(spec.loader)
+        return spec
+
+    def _patch(self, loader):
+        # loaders that are classes, like BuiltinImporter, are shared by every
+        # module and cheap, zipimporters are patched once for all their modules
+        if isinstance(loader, type) or "exec_module" in vars(loader):
+            return
+        exec_module = getattr(loader, "exec_module", None)
+        create_module = getattr(loader, "create_module", None)
+        if exec_module is None:
+            return
+
+        def timed_create_module(spec):
+            # extension modules are loaded by create_module
+            start = time.perf_counter()
+            try:
+                return create_module(spec)
+            finally:
+                self._local.created = time.perf_counter() - start
+
+        def timed_exec_module(module):
+            created = getattr(self._local, "created", 0.0)
+            self._local.created = 0.0
+            if not hasattr(self._local, "stack"):
+                self._local.stack = []
+            stack = self._local.stack
+            frame = {
+                "name": module.__name__,
+                "repository": repository(getattr(module, "__file__", None)),
+                "start": time.perf_counter() - created,
+                "children": 0.0,
+            }
+            stack.append(frame)
+            try:
+                exec_module(module)
+            finally:
+                stack.pop()
+                cumulative = time.perf_counter() - frame["start"]
+                if stack:
+                    stack[-1]["children"] += cumulative
+                self._record(stack, frame, cumulative)
+
+        if create_module is not None:
+            loader.create_module = timed_create_module
+        loader.exec_module = timed_exec_module
+
+    def _record(self, parents, frame, cumulative):
+        self_time = cumulative - frame["children"]
+        stack = ";".join(
+            "%s (%s)" % (f["name"], f["repository"]) for f in parents + [frame]
+        )
+        with self._lock:
+            entry = self.modules.setdefault(
+                frame["name"],
+                {
+                    "repository": frame["repository"],
+                    "self": 0.0,
+                    "cumulative": 0.0,
+                    "importers": set(),
+                },
+            )
+            entry["self"] += self_time
+            entry["cumulative"] += cumulative
+            entry["importers"].add(parents[-1]["repository"] if parents else None)
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + self_time
+
+    def report(self):
+        """Summarizes the recorded imports.
+
+        Returns:
+            dict: self and cumulative microseconds per repository and per
+                module. The cumulative time of a repository is the time spent
+                in imports of its modules from outside of it, including their
+                dependencies.
+        """
+        repositories = {}
+        modules = {}
+        with self._lock:
+            for name, entry in self.modules.items():
+                repo = entry["repository"]
+                self_us = int(entry["self"] * 1e6)
+                cumulative_us = int(entry["cumulative"] * 1e6)
+                modules[name] = {
+                    "repository": repo,
+                    "self_us": self_us,
+                    "cumulative_us": cumulative_us,
+                }
+                summary = repositories.setdefault(
+                    repo, {"self_us": 0, "cumulative_us": 0, "modules": 0}
+                )
+                summary["self_us"] += self_us
+                summary["modules"] += 1
+                if entry["importers"] - set([repo]):
+                    summary["cumulative_us"] += cumulative_us
+        return {"repositories": repositories, "modules": modules}
+
+    def folded(self):
+        """Returns the collapsed stacks, one 'frame;frame microseconds' per line."""
+        with self._lock:
+            return "".join(
+                "%s %d\n" % (stack, int(seconds * 1e6))
+                for stack, seconds in sorted(self.stacks.items())
+            )
+
+    def write(self, directory):
+        """Writes importprof.json and importprof.folded into directory."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "importprof.json"), "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        with open(os.path.join(directory, "importprof.folded"), "w") as f:
+            f.write(self.folded())
+
+
+def install():
+    """Starts timing imports.
+
+    Returns:
+        ImportTimer: the installed timer
+    """
+    for finder in sys.meta_path:
+        if isinstance(finder, ImportTimer):
+            return finder
+    timer = ImportTimer()
+    sys.meta_path.insert(0, timer)
+    return timer
+
+
+def uninstall(timer):
+    if timer in sys.meta_path:
+        sys.meta_path.remove(timer)
+
+
+def _output_dir(value):
+    if value != "1":
+        return value
+    return os.environ.get("TEST_UNDECLARED_OUTPUTS_DIR", os.getcwd())
+
+
+def maybe_install():
+    """Starts timing imports if RULES_PIP_IMPORTPROF is set.
+
+    The reports are written when the process exits.
+    """
+    value = os.environ.get(ENV_VAR)
+    if not value or value == "0":
+        return
+    timer = install()
+    atexit.register(timer.write, _output_dir(value))
@@ -0,0 +1,245 @@
+"""PEP 503 simple index of a local wheelhouse
+
+pip lists and parses every file of a --find-links directory for every package
+it installs. An index has one page per project instead, so a lookup reads a
+single small page. The index is refreshed incrementally: files are only hashed
+when they are new or changed, and only the pages of the projects whose files
+changed are rewritten.
+"""
+import argparse
+import hashlib
+import html
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+import store
+
+STATE_FILE = "index.json"
+
+_DISTRIBUTION_SUFFIXES = (".whl", ".tar.gz", ".zip", ".tar.bz2")
+_NORMALIZE_RE = re.compile(r"[-_.]+")
+
+_PAGE = """<!DOCTYPE html>
+<html>
+  <head>
+    <meta name="pypi:repository-version" content="1.0">
+    <title>{title}</title>
+  </head>
+  <body>
+{links}
+  </body>
+</html>
+"""
+
+
+def normalize(name):
+    """Normalizes a project name as in PEP 503."""
+    return _NORMALIZE_RE.sub("-", name).lower()
+
+
+def project_name(filename):
+    """Finds the project of a distribution file.
+
+    Args:
+        filename: name of a wheel or an sdist
+    Returns:
+        str: normalized project name, None for other files
+    """
+    if filename.endswith(".whl"):
+        return normalize(filename.split("-", 1)[0])
+    for suffix in _DISTRIBUTION_SUFFIXES:
+        if filename.endswith(suffix) and "-" in filename:
+            return normalize(filename[: -len(suffix)].rsplit("-", 1)[0])
+    return None
+
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _write(path, content):
+    """Replaces a file atomically, readers never see a partial page."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def _load_state(output):
+    try:
+        with open(os.path.join(output, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+
+def scan(wheelhouse, previous):
+    """Lists the distributions of a wheelhouse.
+
+    Args:
+        wheelhouse: directory of wheels and sdists
+        previous: result of an earlier scan, whose hashes are reused for files
+            of the same size and modification time
+    Returns:
+        dict: map from file name to its project, size, mtime and sha256
+    """
+    files = {}
+    for entry in os.scandir(wheelhouse):
+        project = project_name(entry.name)
+        if project is None or not entry.is_file():
+            continue
+        stat = entry.stat()
+        known = previous.get(entry.name)
+        if (
+            known
+            and known["size"] == stat.st_size
+            and known["mtime"] == stat.st_mtime_ns
+        ):
+            files[entry.name] = known
+            continue
+        files[entry.name] = {
+            "project": project,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": _sha256(entry.path),
+        }
+    return files
+
+
+def render_project(wheelhouse, project, files):
+    """Renders the page of a project.
+
+    Args:
+        wheelhouse: directory of the distributions
+        project: normalized project name
+        files: scanned files of the project
+    Returns:
+        str: html page linking the files with their hashes
+    """
+    links = []
+    for filename in sorted(files):
+        url = pathlib.Path(os.path.abspath(os.path.join(wheelhouse, filename)))
+        links.append(
+            '    <a href="{}#sha256={}">{}</a><br/>'.format(
+                html.escape(url.as_uri()),
+                files[filename]["sha256"],
+                html.escape(filename),
+            )
+        )
+    return _PAGE.format(title="Links for " + project, links="\n".join(links))
+
+
+def render_root(projects):
+    """Renders the root page listing the projects."""
+    links = [
+        '    <a href="{0}/">{0}</a><br/>'.format(html.escape(project))
+        for project in sorted(projects)
+    ]
+    return _PAGE.format(title="Simple index", links="\n".join(links))
+
+
+def _by_project(files):
+    projects = {}
+    for filename, info in files.items():
+        projects.setdefault(info["project"], {})[filename] = info
+    return projects
+
+
+def build_index(wheelhouse, output):
+    """Creates or refreshes the simple index of a wheelhouse.
+
+    Args:
+        wheelhouse: directory of wheels and sdists
+        output: directory of the index
+    Returns:
+        list: projects whose pages were written
+    """
+    wheelhouse = os.path.abspath(wheelhouse)
+    state = _load_state(output)
+    if state.get("wheelhouse") != wheelhouse:
+        state = {"files": {}}
+    files = scan(wheelhouse, state["files"])
+
+    old_projects = _by_project(state["files"])
+    new_projects = _by_project(files)
+    changed = []
+    for project in sorted(set(old_projects) | set(new_projects)):
+        page = os.path.join(output, project, "index.html")
+        if project not in new_projects:
+            if os.path.exists(page):
+                os.remove(page)
+                os.rmdir(os.path.dirname(page))
+            continue
+        if old_projects.get(project) == new_projects[project] and os.path.exists(page):
+            continue
+        _write(page, render_project(wheelhouse, project, new_projects[project]))
+        changed.append(project)
+
+    root = os.path.join(output, "index.html")
+    if set(old_projects) != set(new_projects) or not os.path.exists(root):
+        _write(root, render_root(new_projects))
+    # written last, an interrupted refresh is redone by the next one
+    _write(
+        os.path.join(output, STATE_FILE),
+        json.dumps({"wheelhouse": wheelhouse, "files": files}, sort_keys=True),
+    )
+    return changed
+
+
+def index_url(output):
+    """Returns the file:// url of an index, to pass to pip --index-url."""
+    return pathlib.Path(os.path.abspath(output)).as_uri() + "/"
+
+
+def main():
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(
+        description="Index a wheelhouse into a PEP 503 simple index "
+        "and print its url."
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        action="store",
+        required=True,
+        help="Directory of wheels and sdists to index.",
+    )
+    parser.add_argument(
+        "--output",
+        action="store",
+        help="Directory of the index.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        help="Keep the index in the wheel store instead of --output, "
+        "so it is refreshed incrementally across fetches.",
+    )
+    args = parser.parse_args()
+    if args.cache_dir:
+        wheelhouse = os.path.abspath(os.path.expanduser(args.wheelhouse))
+        output = os.path.join(
+            os.path.expanduser(args.cache_dir), "index", store.digest(wheelhouse)
+        )
+    elif args.output:
+        output = args.output
+    else:
+        parser.error("one of --output or --cache-dir is required")
+
+    changed = build_index(os.path.expanduser(args.wheelhouse), output)
+    logging.info("indexed %s, %d pages written", args.wheelhouse, len(changed))
+    print(index_url(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""machine wide token pool limiting the concurrent sdist builds
+
+Bazel fetches many whl_library repositories at once, and every sdist build runs
+a build backend and possibly a parallel compiler. A build holds tokens of a pool
+shared by all the processes of the user while it runs. Tokens are slot files
+locked with flock, so the tokens of a process that dies are released by the
+kernel. The directory of the slot files must belong to the user and not be
+writable by others, who could hold every slot. A build takes all its tokens at
+once or none of them, builds never wait while holding tokens, so they cannot
+deadlock.
+
+The pool is configured through environment variables, which whl.py and
+build_wheels.py set from their arguments and which their workers inherit.
+"""
+import contextlib
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # missing on windows, builds are not limited there
+    fcntl = None
+
+# directory of the slot files, the pool is disabled if unset
+DIRECTORY_ENV = "RULES_PIP_JOBSERVER"
+# number of tokens of the pool
+SLOTS_ENV = "RULES_PIP_JOBSERVER_SLOTS"
+# json map from package name to the tokens its build takes
+COSTS_ENV = "RULES_PIP_BUILD_COSTS"
+# tokens of the builds of packages without a cost
+DEFAULT_COST_ENV = "RULES_PIP_BUILD_DEFAULT_COST"
+
+_SLOT_FILE = "slot-%d"
+_POLL_SECONDS = 0.1
+
+
+def _canonical_name(name):
+    return name.lower().replace("_", "-").replace(".", "-")
+
+
+def default_directory():
+    """Directory of the pool shared by all the builds of the user."""
+    return os.path.join(tempfile.gettempdir(), "rules_pip_jobserver_%d" % os.getuid())
+
+
+def _check_private(directory):
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o022:
+        # other users could hold every slot and stall the builds
+        raise RuntimeError("build slot directory %s is not private" % directory)
+
+
+def configure(directory, slots, costs=None, default_cost=1):
+    """Enables the pool for this process and the processes it starts.
+
+    Args:
+        directory: directory of the slot files, shared by all the processes
+            of the user, see default_directory
+        slots: number of tokens of the pool, e.g. the number of cpus
+        costs: map from package name to the tokens its build takes, e.g. more
+            for packages whose builds need a lot of memory
+        default_cost: tokens of the other builds, e.g. their compile jobs
+    """
+    os.environ[DIRECTORY_ENV] = directory
+    os.environ[SLOTS_ENV] = str(slots)
+    os.environ[COSTS_ENV] = json.dumps(
+        {_canonical_name(name): cost for name, cost in (costs or {}).items()},
+        sort_keys=True,
+    )
+    os.environ[DEFAULT_COST_ENV] = str(default_cost)
+
+
+def parse_costs(values):
+    """Parses name=tokens arguments into a map from package name to tokens."""
+    costs = {}
+    for value in values:
+        name, _, cost = value.rpartition("=")
+        if not name:
+            raise ValueError("expected name=tokens, got %s" % value)
+        costs[name] = int(cost)
+    return costs
+
+
+def build_cost(package):
+    """Tokens the build of a package takes, from the environment."""
+    costs = json.loads(os.environ.get(COSTS_ENV) or "{}")
+    default = int(os.environ.get(DEFAULT_COST_ENV) or 1)
+    return costs.get(_canonical_name(package), default)
+
+
+def _try_lock(directory, slots, count):
+    """Locks count free slots, or none of them.
+
+    Returns:
+        list: open slot files, empty if there were not enough free slots
+    """
+    held = []
+    # random order spreads the processes over the slots
+    for slot in random.sample(range(slots), slots):
+        f = open(os.path.join(directory, _SLOT_FILE % slot), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            continue
+        held.append(f)
+        if len(held) == count:
+            return held
+    _release(held)
+    return []
+
+
+def _release(held):
+    for f in held:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+@contextlib.contextmanager
+def tokens(directory, slots, count, poll=_POLL_SECONDS):
+    """Holds tokens of a pool while the block runs.
+
+    Args:
+        directory: directory of the slot files
+        slots: number of tokens of the pool
+        count: tokens to take, capped to the size of the pool
+        poll: seconds between attempts while the pool is busy
+    Yields:
+        int: number of tokens held
+    """
+    count = max(1, min(count, slots))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    _check_private(directory)
+    start = time.time()
+    held = _try_lock(directory, slots, count)
+    while not held:
+        time.sleep(poll * (1 + random.random()))
+        held = _try_lock(directory, slots, count)
+    waited = time.time() - start
+    if waited > 1:
+        logging.info("waited %.1fs for %d build tokens", waited, count)
+    try:
+        yield count
+    finally:
+        _release(held)
+
+
+@contextlib.contextmanager
+def build_slots(package):
+    """Holds the tokens of the build of a package, if the pool is configured.
+
+    Args:
+        package: package name, or a name==version requirement
+    Yields:
+        int: number of tokens held, 0 if builds are not limited
+    """
+    directory = os.environ.get(DIRECTORY_ENV)
+    if not directory or fcntl is None:
+        yield 0
+        return
+    name = package.split("==")[0].split("[")[0].strip()
+    with tokens(directory, int(os.environ[SLOTS_ENV]), build_cost(name)) as count:
+        yield count
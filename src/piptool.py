@@ -1,16 +1,65 @@
 import argparse
+import email.parser
+import glob
+import hashlib
+import json
 import logging
 import os
 import re
 import sys
+import types
+import zipfile
 from collections import OrderedDict
 
-from pip._internal.network.session import PipSession
-from pip._internal.req.constructors import install_req_from_parsed_requirement
-from pip._internal.req.req_file import parse_requirements
-
+import jobserver
+import proxy
+import store
+import tracing
 import whl
 
+# packages installed by pip_import keep their BUILD file under this name, so
+# they do not become packages of the pip_import repository
+PREBUILT_BUILD_FILE = "BUILD.whl"
+
+# the whl_library data of pip_install, generated next to requirements.bzl
+INSTALL_BZL = "install.bzl"
+
+# same as pip._internal.req.req_file.COMMENT_RE
+_COMMENT_RE = re.compile(r"(^|\s+)#.*$")
+# same as pip._internal.req.req_file.ENV_VAR_RE
+_ENV_VAR_RE = re.compile(r"(?P<var>\$\{(?P<name>[A-Z0-9_]+)\})")
+_HASH_RE = re.compile(r"\s+--hash[=\s]\s*\S+")
+_SHA256_RE = re.compile(r"--hash[=\s]\s*sha256:([0-9a-fA-F]+)")
+_OPTION_RE = re.compile(r"^(-{1,2}[\w-]*)[=\s]?(.*)$")
+_PINNED_RE = re.compile(
+    r"""^(?P<name>[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*
+    (?:\[(?P<extras>[A-Za-z0-9._,\s-]*)\])?\s*
+    ===?\s*(?P<version>[A-Za-z0-9._+!-]+)\s*
+    (?:;.*)?$""",
+    re.VERBOSE,
+)
+_NOT_PINNED = (
+    "Expected a pinned requirement, got {}, "
+    "either pre-compile the requirements, or set compile=True in pip_import"
+)
+_INCLUDE_OPTIONS = ("-r", "--requirement", "-c", "--constraint")
+# options of requirement files that do not affect the pinned requirements
+_GLOBAL_OPTIONS = (
+    "-i",
+    "--index-url",
+    "--extra-index-url",
+    "--no-index",
+    "-f",
+    "--find-links",
+    "--trusted-host",
+    "--no-binary",
+    "--only-binary",
+    "--prefer-binary",
+    "--pre",
+    "--require-hashes",
+    "--use-feature",
+)
+
 
 def clean_name(name):
     # Escape any illegal characters with underscore.
@@ -41,24 +90,119 @@ def is_pinned_requirement(req, editable):
     return (op == "==" or op == "===") and not version.endswith(".*")
 
 
+def _pinned_tuple(req, editable):
+    if not is_pinned_requirement(req, editable):
+        raise TypeError(_NOT_PINNED.format(req))
+
+    name = req.name
+    version = next(iter(req.specifier._specs))._spec[1]
+    extras = tuple(sorted(req.extras))
+    return name, version, extras
+
+
 def as_tuple(preq):
     """
     Pulls out the (name: str, version:str, extras:(str)) tuple from
     the pinned ParsedRequirement.
     """
-    req = install_req_from_parsed_requirement(preq)
-    if not is_pinned_requirement(req, preq.is_editable):
-        raise TypeError(
-            (
-                "Expected a pinned requirement, got {}, "
-                "either pre-compile the requirements, or set compile=True in pip_import"
-            ).format(req)
+    from pip._internal.req.constructors import install_req_from_parsed_requirement
+
+    return _pinned_tuple(install_req_from_parsed_requirement(preq), preq.is_editable)
+
+
+def _expand_env_var(match):
+    value = os.getenv(match.group("name"))
+    return match.group("var") if value is None else value
+
+
+def _logical_lines(path):
+    """Yields the lines of a requirements file the way pip preprocesses them."""
+    with open(path) as f:
+        joined = []
+        for line in f.read().splitlines():
+            if line.endswith("\\") and not _COMMENT_RE.match(line):
+                joined.append(line.strip("\\"))
+                continue
+            line = "".join(joined + [line])
+            joined = []
+            line = _COMMENT_RE.sub("", line).strip()
+            if line:
+                yield _ENV_VAR_RE.sub(_expand_env_var, line)
+        if joined:
+            line = _COMMENT_RE.sub("", "".join(joined)).strip()
+            if line:
+                yield _ENV_VAR_RE.sub(_expand_env_var, line)
+
+
+def _parse_line_with_pip(line):
+    """Handles a requirement line the fast parser does not understand."""
+    from pip._internal.req.constructors import install_req_from_line
+
+    if line.startswith(("-e", "--editable")):
+        raise TypeError(_NOT_PINNED.format(line))
+    return _pinned_tuple(install_req_from_line(line), False)
+
+
+def _sha256_hashes(line):
+    return tuple(_SHA256_RE.findall(line))
+
+
+def pinned_requirements(path):
+    """Parses a compiled requirements file without pip's requirement machinery.
+
+    Understands name[extras]==version lines with markers and --hash options,
+    comments, line continuations and -r/-c includes. Lines it cannot
+    classify are handed to pip.
+
+    Args:
+        path: path to requirement file
+    Yields:
+        tuple: (name, version, extras, sha256 hashes) of every pinned requirement
+    """
+    for line in _logical_lines(path):
+        if line.startswith("-"):
+            # the option ends at the first "=" or whitespace, values may hold both
+            option, value = _OPTION_RE.match(line).groups()
+            value = value.strip()
+            if option in _INCLUDE_OPTIONS:
+                if re.match(r"^\w+://", value):
+                    for preq in get_requirements(value):
+                        hashes = preq.options.get("hashes", {}) if preq.options else {}
+                        yield as_tuple(preq) + (tuple(hashes.get("sha256", ())),)
+                    continue
+                include = os.path.join(os.path.dirname(path), value)
+                for req in pinned_requirements(include):
+                    yield req
+                continue
+            if option in _GLOBAL_OPTIONS:
+                continue
+            yield _parse_line_with_pip(line) + (_sha256_hashes(line),)
+            continue
+
+        requirement = _HASH_RE.sub("", line)
+        match = _PINNED_RE.match(requirement)
+        if match is None:
+            yield _parse_line_with_pip(requirement) + (_sha256_hashes(line),)
+            continue
+        extras = match.group("extras") or ""
+        yield (
+            match.group("name"),
+            match.group("version"),
+            tuple(sorted(e.strip() for e in extras.split(",") if e.strip())),
+            _sha256_hashes(line),
         )
 
-    name = req.name
-    version = next(iter(req.specifier._specs))._spec[1]
-    extras = tuple(sorted(req.extras))
-    return name, version, extras
+
+def parse_pinned_requirements(path):
+    """Parses a compiled requirements file, see pinned_requirements.
+
+    Args:
+        path: path to requirement file
+    Yields:
+        tuple: (name, version, extras) of every pinned requirement
+    """
+    for name, version, extras, _ in pinned_requirements(path):
+        yield name, version, extras
 
 
 def repository_name(repo_prefix, name, version, python_version):
@@ -76,53 +220,393 @@ def repository_name(repo_prefix, name, version, python_version):
     return "{}{}".format(repo_prefix, clean_name(canonical))
 
 
+def merge_pins(reqs, repo_prefix, python_version):
+    """Merges the pins of a lockfile that land in the same repository.
+
+    A lockfile can pin a package more than once, through a constraints file
+    repeating its pins or overlapping -r includes, and Starlark rejects the
+    repeated keys in the _packages dict of install.bzl.
+
+    Args:
+        reqs: (name, version, extras, sha256 hashes) tuples, see
+            pinned_requirements
+        repo_prefix: prefix to attach to the repos
+        python_version: python major version
+    Returns:
+        list: sorted tuples, one per repository, with the extras and the
+            hashes of all the pins of the repository
+    """
+    merged = OrderedDict()
+    for name, version, extras, hashes in sorted(reqs):
+        key = repository_name(repo_prefix, name, version, python_version)
+        if key in merged:
+            name, version, known_extras, known_hashes = merged[key]
+            extras = tuple(sorted(set(known_extras) | set(extras)))
+            hashes = known_hashes + tuple(h for h in hashes if h not in known_hashes)
+        merged[key] = (name, version, extras, hashes)
+    return list(merged.values())
+
+
+def _bool(value):
+    return "True" if value else "False"
+
+
+def shared_repository_name(repo_prefix, name, version, filename):
+    """Returns the name of the repository shared by all python versions.
+
+    Pure python wheels are shared by all python 3 interpreters, abi3 wheels by
+    those resolving the same build, of the same python tag and platform.
+
+    Args:
+        repo_prefix: prefix to attach to the repo
+        name: package name
+        version: package version
+        filename: file name of the wheel of the package
+    Returns:
+        str: repo name, None if the wheel is specific to an interpreter
+    """
+    import installer.utils
+    from pip._vendor.packaging import tags
+
+    parsed = tags.parse_tag(installer.utils.parse_wheel_filename(filename).tag)
+    if all(t.abi == "none" and t.platform == "any" for t in parsed) and all(
+        t.interpreter.startswith("py") for t in parsed
+    ):
+        return repository_name(repo_prefix, name, version, "3")
+    if all(t.abi == "abi3" for t in parsed):
+        # interpreters can resolve different abi3 builds, e.g. cp36 and cp37
+        interpreters = "_".join(sorted(set(t.interpreter for t in parsed)))
+        platforms = "_".join(sorted(set(t.platform for t in parsed)))
+        return repository_name(repo_prefix, name, version, "3") + clean_name(
+            "__%s_abi3_%s" % (interpreters, platforms)
+        )
+    return None
+
+
 def whl_library(
     name,
+    version,
     extras,
     repo_name,
+    prebuilt,
+    zipped,
+    wheel=None,
+    dependencies=None,
+    shared=False,
+    shared_repo="",
+):
+    """Generate the whl_library attributes of a package.
+
+    Args:
+        name: package nane
+        version: pinned version of the package
+        extras: extras for this lib
+        repo_name: repo name used for this lib
+        prebuilt: directory of the package installed by pip_import, if any
+        zipped: pack the pure python packages into a single archive
+        wheel: (url, filename, sha256) of the wheel to download, see
+            resolve_wheel
+        dependencies: map from "" for the package and from its extras to the
+            requirements they need, None to let whl_library find them
+        shared: the repository is shared by pip_imports, see
+            shared_repository_name
+        shared_repo: the shared repository this one only wraps
+    Returns:
+      str: entry of the _packages dict of install.bzl
+    """
+    optional = ""
+    if wheel:
+        optional = ', "url": "{}", "filename": "{}", "sha256": "{}"'.format(*wheel)
+    if dependencies is not None:
+        optional += ', "dependencies": ' + json.dumps(dependencies, sort_keys=True)
+    if shared:
+        # pycs are specific to the interpreter of the pip_import
+        optional += ', "shared": True, "precompile": False'
+    if shared_repo:
+        optional += ', "shared_repo": "@{}"'.format(shared_repo)
+    return (
+        '"{repo_name}": {{"pkg": "{name}", "version": "{version}", '
+        '"extras": [{extras}], "prebuilt": "{prebuilt}", "zipped": {zipped}{optional}}},'
+    ).format(
+        name=name,
+        version=version,
+        repo_name=repo_name,
+        extras=", ".join(['"%s"' % extra for extra in extras]),
+        prebuilt=prebuilt,
+        zipped=_bool(zipped),
+        optional=optional,
+    )
+
+
+def whl_library_common(
     pip_repo_name,
     python_interpreter,
     timeout,
     quiet,
     req_to_overrides,
+    cache_dir,
+    cache_max_size,
+    precompile,
+    namespace_style,
+    compiler_cache="",
+    build_jobs=0,
+    build_slots=0,
+    build_costs=None,
+    trace_dir="",
+    index_proxy=False,
 ):
-    """Generate whl_library snippets for a package and its extras.
+    """Generate the whl_library attributes shared by all packages.
 
     Args:
-        name: package nane
-        extras: extras for this lib
-        repo_name: repo name used for this lib
         pip_repo_name: pip_import repo
         python_interpreter:
         timeout: timeout for pip actions
         quiet: makes command run in quiet mode
         req_to_overrides: map from requirement to replacement label
+        cache_dir: directory of the wheel store, empty to disable it
+        cache_max_size: size the wheel store is pruned to
+        precompile: ship hash based pycs in the data of the package
+        namespace_style: how namespace packages are made importable
+        compiler_cache: launcher wrapping the compilers of sdist builds
+        build_jobs: parallel compile jobs of sdist builds, 0 for the default
+        build_slots: tokens of the machine wide pool of sdist builds, 0 to
+            not limit them
+        build_costs: map from package name to the tokens its build takes
+        trace_dir: directory of the traces of the fetches, empty to not trace
+        index_proxy: download through the local caching proxy of the indexes
     Returns:
-      str: whl_library rule definition
+      str: the _common dict of install.bzl
     """
     # Indentation here matters
-    return """
-  if "{repo_name}" not in native.existing_rules():
-    whl_library(
-        name = "{repo_name}",
-        pkg = "{name}",
-        requirements_repo = "@{pip_repo_name}",
-        python_interpreter = "{python_interpreter}",
-        extras = [{extras}],
-        pip_args = pip_args,
-        timeout = {timeout},
-        quiet = {quiet},
-        overrides = {overrides},
-    )""".format(
-        name=name,
-        repo_name=repo_name,
+    return """{{
+    "requirements_repo": "@{pip_repo_name}",
+    "python_interpreter": "{python_interpreter}",
+    "timeout": {timeout},
+    "quiet": {quiet},
+    "overrides": {overrides},
+    "cache_dir": "{cache_dir}",
+    "cache_max_size": "{cache_max_size}",
+    "precompile": {precompile},
+    "namespace_style": "{namespace_style}",
+    "compiler_cache": "{compiler_cache}",
+    "build_jobs": {build_jobs},
+    "build_slots": {build_slots},
+    "build_costs": {build_costs},
+    "trace_dir": "{trace_dir}",
+    "index_proxy": {index_proxy},
+}}""".format(
         pip_repo_name=pip_repo_name,
         python_interpreter=python_interpreter.replace("\\", "/"),
-        extras=",".join(['"%s"' % extra for extra in extras]),
         timeout=timeout,
-        quiet=quiet,
-        overrides={label: req for req, label in req_to_overrides.items()},
+        quiet=_bool(quiet),
+        overrides=json.dumps(
+            {label: req for req, label in req_to_overrides.items()}, sort_keys=True
+        ),
+        cache_dir=cache_dir.replace("\\", "/"),
+        cache_max_size=cache_max_size,
+        precompile=_bool(precompile),
+        namespace_style=namespace_style,
+        compiler_cache=compiler_cache,
+        build_jobs=build_jobs,
+        build_slots=build_slots,
+        build_costs=json.dumps(
+            {name: str(cost) for name, cost in (build_costs or {}).items()},
+            sort_keys=True,
+        ),
+        trace_dir=trace_dir.replace("\\", "/"),
+        index_proxy=_bool(index_proxy),
+    )
+
+
+def wheel_finder(pip_args):
+    """Creates the pip finder that resolve_wheel looks up packages with.
+
+    Args:
+        pip_args: pip arguments with the index urls and find-links
+    Returns:
+        PackageFinder: the finder
+    """
+    command = whl.create_command("download")
+    options, _ = command.parse_args(
+        ["--isolated"] + whl._supported_pip_args("download", pip_args)
     )
+    return command._build_package_finder(options, command._build_session(options))
+
+
+def _link_sha256(link):
+    if link.hash_name == "sha256":
+        return link.hash.lower()
+    if link.scheme == "file" and os.path.isfile(link.file_path):
+        sha = hashlib.sha256()
+        with open(link.file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+    return None
+
+
+def resolve_wheel(finder, name, version, hashes, supported):
+    """Finds the wheel of a pinned requirement and its sha256.
+
+    Args:
+        finder: pip finder, see wheel_finder
+        name: package name
+        version: pinned version
+        hashes: sha256 hashes allowed by the requirements file, any if empty
+        supported: list of supported tags, best match first
+    Returns:
+        tuple: (url, filename, sha256) of the best compatible wheel, None if
+            there is none or its sha256 is not known without downloading it
+    """
+    import installer.utils
+    from pip._vendor.packaging import tags
+    from pip._vendor.packaging.version import Version
+
+    pinned = Version(version)
+    priorities = {tag: i for i, tag in enumerate(supported)}
+    best, best_priority = None, len(priorities)
+    for candidate in finder.find_all_candidates(name):
+        link = candidate.link
+        if not link.is_wheel or candidate.version != pinned:
+            continue
+        tag = installer.utils.parse_wheel_filename(link.filename).tag
+        priority = min(
+            [priorities.get(t, len(priorities)) for t in tags.parse_tag(tag)]
+        )
+        if priority >= best_priority:
+            continue
+        sha256 = _link_sha256(link)
+        if sha256 is None or (hashes and sha256 not in hashes):
+            continue
+        best = (link.url_without_fragment, link.filename, sha256)
+        best_priority = priority
+    return best
+
+
+def cached_wheel_dirs(cache_dir):
+    """Indexes the wheels kept in the wheel store by package name.
+
+    Args:
+        cache_dir: directory of the wheel store
+    Returns:
+        dict: map from canonical package name to the directories of its wheels
+    """
+    dirs = {}
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return dirs
+    for entry in store.entries(cache_dir):
+        if entry.get("kind") == "wheels" and entry.get("name"):
+            name = whl._canonical_name(entry["name"])
+            dirs.setdefault(name, []).append(os.path.join(entry["path"], "data"))
+    return dirs
+
+
+def _wheel_file_metadata(path):
+    with zipfile.ZipFile(path) as wheel:
+        for name in wheel.namelist():
+            parts = name.split("/")
+            if (
+                len(parts) == 2
+                and parts[0].endswith(".dist-info")
+                and parts[1] == "METADATA"
+            ):
+                return wheel.read(name).decode("utf-8")
+    return None
+
+
+def wheel_metadata(name, version, search_dirs, supported, wheel=None, session=None):
+    """Reads the core metadata of a pinned package without installing it.
+
+    Local wheels are opened directly, a remote wheel is not downloaded, only
+    the metadata file the index serves next to it (PEP 658).
+
+    Args:
+        name: package name
+        version: pinned version
+        search_dirs: directories with wheel files, e.g. --find-links dirs and
+            the wheels of the store
+        supported: list of supported tags, best match first
+        wheel: (url, filename, sha256) of the wheel, see resolve_wheel
+        session: pip session used to fetch the metadata of remote wheels
+    Returns:
+        str: content of the METADATA file, None if it is not available
+    """
+    from pip._internal.utils.urls import url_to_path
+
+    path = whl.find_wheel(name, version, search_dirs, supported)
+    if path is None and wheel and wheel[0].startswith("file:"):
+        path = url_to_path(wheel[0])
+    if path is not None:
+        return _wheel_file_metadata(path)
+    if wheel is None or session is None:
+        return None
+    try:
+        response = session.get(wheel[0] + ".metadata")
+    except Exception as e:
+        logging.debug("no metadata file for %s: %s", wheel[1], e)
+        return None
+    if response.status_code != 200:
+        return None
+    return response.text
+
+
+def requirement_dependencies(metadata, extras=None):
+    """Finds the dependencies of a package and of its extras from its metadata.
+
+    Args:
+        metadata: content of a METADATA file
+        extras: extras to find additional dependencies for
+    Returns:
+        dict: map from None, for the package itself, and from each extra to
+            the sorted list of lower case requirement names
+    """
+    message = email.parser.HeaderParser().parsestr(metadata)
+    pkg = types.SimpleNamespace(requires_dist=message.get_all("Requires-Dist") or [])
+    return {
+        extra: sorted(set(d.lower() for d in deps))
+        for extra, deps in whl.dependency_map(pkg, extras).items()
+    }
+
+
+def dependency_graph(dependencies):
+    """Turns the dependencies of packages into the edges between requirements.
+
+    Args:
+        dependencies: map from package name to its requirement_dependencies
+    Returns:
+        dict: map from lower case requirement, e.g. requests or
+            requests[socks], to the requirements it depends on. An extra
+            depends on its package too.
+    """
+    graph = {}
+    for name, deps in dependencies.items():
+        key = name.lower()
+        for extra, extra_deps in deps.items():
+            if extra is None:
+                graph[key] = extra_deps
+            else:
+                graph["%s[%s]" % (key, extra)] = sorted(set(extra_deps + [key]))
+    return graph
+
+
+def transitive_closure(graph, key):
+    """Lists the requirements a requirement depends on, directly or not.
+
+    Args:
+        graph: see dependency_graph
+        key: lower case requirement
+    Returns:
+        list: sorted requirements, without key itself
+    """
+    seen = set([key])
+    stack = [key]
+    while stack:
+        for dep in graph.get(stack.pop(), []):
+            if dep not in seen:
+                seen.add(dep)
+                stack.append(dep)
+    seen.discard(key)
+    return sorted(seen)
 
 
 def get_requirements(requirement):
@@ -133,6 +617,9 @@ def get_requirements(requirement):
     Returns:
         list[InstallRequirements]: list of InstallRequirement
     """
+    from pip._internal.network.session import PipSession
+    from pip._internal.req.req_file import parse_requirements
+
     session = PipSession()
     return parse_requirements(requirement, session=session)
 
@@ -181,17 +668,185 @@ def main():
         help="Specified to replace pip dependencies with bazel targets. Example: "
         + "--override=@com_google_protobuf//:protobuf_python=protobuf",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        default="",
+        help="Directory of the wheel store shared by all whl_library fetches.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        action="store",
+        default="10G",
+        help="The wheel store is pruned to this size.",
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store",
+        help="Write a manifest to install all packages at once with whl.py, "
+        + "whl_library rules then reuse the installed packages.",
+    )
+    parser.add_argument(
+        "--precompile",
+        action="store_true",
+        help="Make whl_library rules ship hash based pycs of the packages.",
+    )
+    parser.add_argument(
+        "--zipped",
+        action="store_true",
+        help="Make whl_library rules pack pure python packages into a zip.",
+    )
+    parser.add_argument(
+        "--zip-exclude",
+        action="append",
+        default=[],
+        help="Package that is never zipped, e.g. because it relies on __file__.",
+    )
+    parser.add_argument(
+        "--namespace-style",
+        choices=whl.NAMESPACE_STYLES,
+        default="pkgutil",
+        help="How whl_library rules make namespace packages importable.",
+    )
+    parser.add_argument(
+        "--compiler-cache",
+        action="store",
+        default="",
+        help="Make whl_library rules wrap the compilers of sdist builds with "
+        + "this launcher, e.g. ccache.",
+    )
+    parser.add_argument(
+        "--build-jobs",
+        type=int,
+        default=0,
+        help="Number of parallel compile jobs of the sdist builds of "
+        + "whl_library rules.",
+    )
+    parser.add_argument(
+        "--build-slots",
+        type=int,
+        default=0,
+        help="Make whl_library rules share a machine wide pool of this many "
+        + "tokens between their sdist builds.",
+    )
+    parser.add_argument(
+        "--build-cost",
+        action="append",
+        default=[],
+        help="Tokens the build of a package takes, e.g. grpcio=8.",
+    )
+    parser.add_argument(
+        "--index-url",
+        action="store",
+        default="",
+        help="Index prepended to the pip arguments of the whl_library rules, "
+        + "e.g. the simple index of a wheelhouse.",
+    )
+    parser.add_argument(
+        "--resolve-urls",
+        action="store_true",
+        help="Resolve the wheel of every requirement to a url and sha256 that "
+        + "whl_library downloads with bazel. Other arguments are passed to pip "
+        + "to find the wheels.",
+    )
+    parser.add_argument(
+        "--share-wheels",
+        action="store_true",
+        help="Install pure python and abi3 wheels into repositories shared by "
+        + "all python versions, the repository of the package only adds its "
+        + "dependencies. Other arguments are passed to pip to find the wheels.",
+    )
+    parser.add_argument(
+        "--dependency-graph",
+        action="store_true",
+        help="Read the dependencies of every requirement from local or cached "
+        + "wheels, or from the metadata files of the index (PEP 658), and write "
+        + "them into mapping.bzl and the whl_library rules. Other arguments "
+        + "are passed to pip to find the wheels.",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        action="store",
+        default="",
+        help="Write a trace of the phases of piptool.py and of every "
+        + "whl_library fetch to this directory, see tracing.py.",
+    )
+    parser.add_argument(
+        "--index-proxy",
+        action="store_true",
+        help="Talk to the indexes through the local caching proxy, and make "
+        + "whl_library rules download through it, see proxy.py.",
+    )
+    args, pip_args = parser.parse_known_args()
+    find_wheels = args.resolve_urls or args.dependency_graph or args.share_wheels
+    if pip_args and not find_wheels:
+        parser.error("unrecognized arguments: %s" % " ".join(pip_args))
+    tracing.start("piptool.py", args.name, args.trace_dir)
 
-    reqs = sorted(get_requirements(args.input), key=as_tuple)
+    python_version = "%d%d" % (sys.version_info[0], sys.version_info[1])
+    with tracing.span("parse_requirements") as trace:
+        reqs = merge_pins(
+            pinned_requirements(args.input), args.repo_prefix, python_version
+        )
+        trace["files"] = len(reqs)
     # args.overrides is label=req, we want {req: label}
     req_to_overrides = dict(tuple(reversed(rep.split("="))) for rep in args.override)
-    python_version = "%d%d" % (sys.version_info[0], sys.version_info[1])
     whl_targets = OrderedDict()
-    whl_libraries = []
-    for req in reqs:
-        name, version, extras = as_tuple(req)
+    # repository name -> entry of _packages
+    whl_libraries = OrderedDict()
+    manifest = []
+    zip_exclude = set(name.lower().replace("_", "-") for name in args.zip_exclude)
+    finder = supported = None
+    if find_wheels:
+        if args.index_url:
+            # pip would ignore the index of the wheelhouse
+            pip_args = [arg for arg in pip_args if arg != "--no-index"]
+            pip_args = ["--index-url", args.index_url] + pip_args
+        if args.index_proxy:
+            proxy.configure(args.cache_dir and os.path.expanduser(args.cache_dir))
+            pip_args = proxy.proxy_pip_args(pip_args)
+        finder = wheel_finder(pip_args)
+        supported = whl.supported_tags(pip_args)
+    wheels = {}
+    if finder and (args.dependency_graph or not args.manifest):
+        with tracing.span("resolve_wheels") as trace:
+            for name, version, extras, hashes in reqs:
+                if name not in req_to_overrides:
+                    wheels[name] = resolve_wheel(
+                        finder, name, version, hashes, supported
+                    )
+            trace["files"] = len(wheels)
+
+    find_links = whl._option_values(pip_args, "--find-links", "-f")
+    graph = {}
+    if args.dependency_graph:
+        cached = cached_wheel_dirs(os.path.expanduser(args.cache_dir))
+        dependencies = {}
+        for name, version, extras, _ in reqs:
+            if name in req_to_overrides:
+                continue
+            with tracing.span("read_metadata", package=name):
+                metadata = wheel_metadata(
+                    name,
+                    version,
+                    find_links + cached.get(whl._canonical_name(name), []),
+                    supported,
+                    wheels.get(name),
+                    finder._link_collector.session,
+                )
+            if metadata is None:
+                logging.warning(
+                    "no metadata for %s==%s, whl_library finds its dependencies",
+                    name,
+                    version,
+                )
+                continue
+            dependencies[name] = requirement_dependencies(metadata, extras)
+        graph = dependency_graph(dependencies)
+
+    for name, version, extras, hashes in reqs:
         repo_name = repository_name(args.repo_prefix, name, version, python_version)
+        zipped = args.zipped and name.lower().replace("_", "-") not in zip_exclude
         if name in req_to_overrides:
             # No whl_library is created, and no extras for overrides.
             whl_targets["%s" % name] = req_to_overrides[name]
@@ -201,44 +856,151 @@ def main():
             for extra in extras:
                 whl_targets["%s[%s]" % (name, extra)] = "@%s//:%s" % (repo_name, extra)
 
-            whl_libraries.append(
-                whl_library(
-                    name,
-                    extras,
-                    repo_name,
+            closures = None
+            key = name.lower()
+            if key in graph:
+                # the repository refers to all the repositories it needs, so
+                # bazel fetches them at once instead of level by level
+                closures = {"": transitive_closure(graph, key)}
+                for extra in extras:
+                    closures[extra] = [
+                        dep
+                        for dep in transitive_closure(graph, "%s[%s]" % (key, extra))
+                        if dep != key
+                    ]
+
+            prebuilt = ""
+            if args.manifest:
+                prebuilt = repo_name
+                manifest.append(
+                    {
+                        "package": name,
+                        "version": version,
+                        "directory": os.path.join(
+                            os.path.dirname(args.output), "packages", repo_name
+                        ),
+                        "extras": list(extras),
+                        "overrides": {
+                            label: req for req, label in req_to_overrides.items()
+                        },
+                        "zipped": zipped,
+                        "dependencies": closures,
+                    }
+                )
+
+            wheel = None
+            if args.resolve_urls and not prebuilt:
+                wheel = wheels.get(name)
+                if wheel and args.index_proxy:
+                    # bazel downloads from the index, the proxy is gone by then
+                    wheel = (proxy.upstream_url(wheel[0]),) + wheel[1:]
+                if wheel is None:
+                    logging.warning(
+                        "no wheel with a known sha256 for %s==%s, pip installs it",
+                        name,
+                        version,
+                    )
+            shared_repo = None
+            if args.share_wheels and not prebuilt:
+                filename = wheels[name][1] if wheels.get(name) else None
+                if filename is None:
+                    local = whl.find_wheel(name, version, find_links, supported)
+                    filename = local and os.path.basename(local)
+                if filename:
+                    shared_repo = shared_repository_name(
+                        args.repo_prefix, name, version, filename
+                    )
+            if shared_repo:
+                whl_libraries[shared_repo] = whl_library(
+                    name, version, (), shared_repo, "", zipped, wheel, shared=True
+                )
+                # the package repository only wraps the shared one
+                wheel = None
+            whl_libraries[repo_name] = whl_library(
+                name,
+                version,
+                extras,
+                repo_name,
+                prebuilt,
+                zipped,
+                wheel,
+                None if prebuilt else closures,
+                shared_repo=shared_repo,
+            )
+
+    directory = os.path.dirname(args.output)
+    with open(os.path.join(directory, INSTALL_BZL), "w") as _f:
+        _f.write(
+            """\
+# Install pip requirements.
+
+load("@com_github_ali5h_rules_pip//:defs.bzl", "whl_library")
+
+_index_args = {index_args}
+
+_common = {common}
+
+# repository name -> whl_library attributes of the package
+_packages = {{
+    {whl_libraries}
+}}
+
+def pip_install(pip_args=[]):
+  if _index_args:
+    # pip would ignore the index of the wheelhouse
+    pip_args = [arg for arg in pip_args if arg != "--no-index"]
+  pip_args = _index_args + pip_args
+  for name, attrs in _packages.items():
+    # existing_rule looks up one rule, existing_rules() would copy all of them
+    if native.existing_rule(name) == None:
+      kwargs = dict(_common)
+      kwargs.update(attrs)
+      whl_library(name = name, pip_args = pip_args, **kwargs)
+""".format(
+                index_args=json.dumps(
+                    ["--index-url", args.index_url] if args.index_url else []
+                ),
+                common=whl_library_common(
                     args.name,
                     sys.executable,
                     args.timeout,
                     args.quiet,
                     req_to_overrides,
-                )
+                    args.cache_dir,
+                    args.cache_max_size,
+                    args.precompile,
+                    args.namespace_style,
+                    args.compiler_cache,
+                    args.build_jobs,
+                    args.build_slots,
+                    jobserver.parse_costs(args.build_cost),
+                    args.trace_dir,
+                    args.index_proxy,
+                ),
+                whl_libraries="\n    ".join(whl_libraries.values()),
             )
+        )
 
     mappings = ",\n  ".join(
         '"%s": "%s"' % (name, target) for name, target in whl_targets.items()
     )
 
-    with open(args.output, "w") as _f:
+    with open(os.path.join(directory, whl.MAPPING_BZL), "w") as _f:
         _f.write(
             """\
-# Install pip requirements.
+# Mapping from requirements to targets, without the data of pip_install.
 
-load("@com_github_ali5h_rules_pip//:defs.bzl", "whl_library")
-
-def pip_install(pip_args=[]):
-  {whl_libraries}
-
-_requirements = {{
+requirements = {{
   {mappings}
 }}
 
-all_requirements = _requirements.values()
+all_requirements = requirements.values()
 
 def requirement(name, target=None):
   name_key = name.lower()
-  if name_key not in _requirements:
+  if name_key not in requirements:
     return name_key + "_not_found_in_requirements"
-  req = _requirements[name_key]
+  req = requirements[name_key]
   if target != None:
     pkg, _, _ = req.partition("//")
     req = pkg + target
@@ -247,21 +1009,88 @@ def requirement(name, target=None):
 def entry_point(name, entry_point=None):
   entry_point = entry_point or name
   return requirement(name, "//:{entry_point_prefix}" + entry_point)
+
+# requirement -> requirements it depends on, for the packages whose metadata
+# was read by pip_import with dependency_graph set
+dependencies = {{
+  {dependencies}
+}}
+
+# targets of a requirement and of everything it depends on
+def transitive_requirements(name):
+  keys = [name.lower()]
+  seen = {{keys[0]: True}}
+  queue = [keys[0]]
+  # starlark has no while loops, the queue holds each key of dependencies once
+  for i in range(len(dependencies) + 1):
+    if i == len(queue):
+      break
+    for dep in dependencies.get(queue[i], []):
+      if dep not in seen:
+        seen[dep] = True
+        keys.append(dep)
+        if dep in dependencies:
+          queue.append(dep)
+  return [requirement(key) for key in keys]
 """.format(
                 entry_point_prefix=whl.ENTRYPOINT_PREFIX,
-                whl_libraries="\n".join(whl_libraries),
                 mappings=mappings,
+                dependencies=",\n  ".join(
+                    "%s: %s" % (json.dumps(key), json.dumps(deps))
+                    for key, deps in sorted(graph.items())
+                ),
             )
         )
 
-    with open(os.path.join(os.path.dirname(args.output), "BUILD"), "w") as _f:
+    with open(args.output, "w") as _f:
+        _f.write(
+            """\
+# Install pip requirements.
+#
+# BUILD files should load requirement() and the other helpers from
+# {mapping_bzl}, loading them from this file also loads {install_bzl}.
+
+load("//:{install_bzl}", _pip_install = "pip_install")
+load(
+    "//:{mapping_bzl}",
+    _all_requirements = "all_requirements",
+    _entry_point = "entry_point",
+    _requirement = "requirement",
+    _transitive_requirements = "transitive_requirements",
+)
+
+pip_install = _pip_install
+all_requirements = _all_requirements
+requirement = _requirement
+entry_point = _entry_point
+transitive_requirements = _transitive_requirements
+""".format(
+                install_bzl=INSTALL_BZL,
+                mapping_bzl=whl.MAPPING_BZL,
+            )
+        )
+
+    if args.manifest:
+        with open(args.manifest, "w") as _f:
+            json.dump(
+                {
+                    "requirements": "@%s" % args.name,
+                    "constraint": args.input,
+                    "build_file": PREBUILT_BUILD_FILE,
+                    "packages": manifest,
+                },
+                _f,
+                indent=2,
+            )
+
+    with open(os.path.join(directory, "BUILD"), "w") as _f:
         _f.write(
             """# Generated BUILD file
-[alias(name=name, actual=pkg,  visibility=["//visibility:public"]) for name, pkg in {{
-  {mappings}
-}}.items()]
+load("//:{mapping_bzl}", "requirements")
+
+[alias(name=name, actual=pkg,  visibility=["//visibility:public"]) for name, pkg in requirements.items()]
 """.format(
-                mappings=mappings
+                mapping_bzl=whl.MAPPING_BZL
             )
         )
 
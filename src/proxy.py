@@ -0,0 +1,620 @@
+"""local caching proxy of package indexes
+
+Every whl_library fetch runs its own pip, with its own connections to the
+index, and no HTTP cache shared with the fetches running next to it. The proxy
+is started on demand by the first fetch and reused by the others, until it is
+idle for a while. It keeps pooled keep-alive connections to the upstream
+indexes, caches their project pages and revalidates them with ETag and
+Last-Modified, and keeps the files whose sha256 the index lists in the wheel
+store, under the key whl_library gives wheels downloaded by bazel.
+
+pip is pointed at the proxy by rewriting the index urls of its arguments:
+
+  https://pypi.org/simple/ -> http://127.0.0.1:<port>/index/<upstream>/
+
+and the links of the pages it serves:
+
+  https://files.example/demo-1.0-py3-none-any.whl#sha256=<sha256>
+      -> /files/<sha256>/<upstream>/demo-1.0-py3-none-any.whl#sha256=<sha256>
+
+where <upstream> is the urlsafe base64 of the upstream url. The proxy only
+answers requests addressed to 127.0.0.1:<port>, and only fetches the indexes
+registered by rewrite_pip_args and the files linked by their pages, it does
+not relay requests to other urls.
+
+The proxy is configured through environment variables, which whl.py and
+piptool.py set from their arguments.
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import html
+import http.client
+import http.server
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+import store
+
+try:
+    import fcntl
+except ImportError:
+    # missing on windows, pip talks to the indexes directly there
+    fcntl = None
+
+# directory of the state of the proxy, the proxy is disabled if unset
+DIRECTORY_ENV = "RULES_PIP_INDEX_PROXY"
+# wheel store the proxy keeps the files in
+CACHE_DIR_ENV = "RULES_PIP_INDEX_PROXY_CACHE_DIR"
+# pip's default index, proxied when pip_args do not name one
+DEFAULT_INDEX = "https://pypi.org/simple/"
+
+_STATE_FILE = "proxy.json"
+_LOCK_FILE = "proxy.lock"
+_UPSTREAMS_FILE = "upstreams.json"
+_PAGES_DIR = "pages"
+_INDEX_OPTIONS = ("-i", "--index-url", "--extra-index-url")
+_HREF_RE = re.compile(r'href="([^"]*)"')
+_START_SECONDS = 10
+_CHUNK = 1 << 20
+
+
+def configure(cache_dir=None):
+    """Enables the proxy for this process and the processes it starts.
+
+    Args:
+        cache_dir: wheel store the proxy keeps the files in, its state and
+            the pages are kept next to them. A directory of the user in the
+            temporary directory if not set.
+    """
+    cache_dir = cache_dir or os.path.join(
+        tempfile.gettempdir(), "rules_pip_proxy_%d" % os.getuid()
+    )
+    os.environ[DIRECTORY_ENV] = os.path.join(cache_dir, "proxy")
+    os.environ[CACHE_DIR_ENV] = cache_dir
+
+
+def _encode(url):
+    return base64.urlsafe_b64encode(url.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4)).decode("utf-8")
+
+
+def upstream_url(url):
+    """Maps a url of the proxy back to the upstream url, other urls are kept.
+
+    Args:
+        url: url of an index page or of a file, with or without the host
+    Returns:
+        str: the upstream url
+    """
+    parts = urlsplit(url).path.split("/")
+    if len(parts) >= 3 and parts[1] == "index":
+        return urljoin(_decode(parts[2]), "/".join(parts[3:]))
+    if len(parts) >= 5 and parts[1] == "files":
+        upstream = _decode(parts[3])
+        if parts[-1].endswith(".metadata"):
+            upstream += ".metadata"
+        return upstream
+    return url
+
+
+def _lock(directory):
+    """Opens the lock file of a directory, flock it to hold the lock."""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    for path in (directory, os.path.dirname(os.path.abspath(directory))):
+        info = os.stat(path)
+        if info.st_uid != os.getuid() or info.st_mode & 0o002:
+            # other users could point pip at a proxy of their own
+            raise RuntimeError("index proxy directory %s is not private" % path)
+    return open(os.path.join(directory, _LOCK_FILE), "a")
+
+
+def registered_upstreams(directory):
+    """Returns the upstream indexes the proxy of a directory may fetch."""
+    try:
+        with open(os.path.join(directory, _UPSTREAMS_FILE)) as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+
+def _register(directory, upstreams):
+    known = registered_upstreams(directory)
+    if upstreams <= known:
+        return
+    with _lock(directory) as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        upstreams |= registered_upstreams(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(sorted(upstreams), f)
+        os.replace(tmp, os.path.join(directory, _UPSTREAMS_FILE))
+
+
+def rewrite_pip_args(pip_args, port, directory):
+    """Points the http index urls of pip arguments at the proxy.
+
+    Args:
+        pip_args: pip arguments
+        port: port of the proxy
+        directory: directory of the state of the proxy, the upstream indexes
+            are registered in it, the proxy fetches no others
+    Returns:
+        list: rewritten arguments, with pip's default index proxied unless
+            there is an --index-url or --no-index
+    """
+    base = "http://127.0.0.1:%d/index/" % port
+    upstreams = set()
+
+    def proxied(url):
+        if not url.startswith(("http://", "https://")):
+            return url
+        upstream = url.rstrip("/") + "/"
+        upstreams.add(upstream)
+        return base + _encode(upstream) + "/"
+
+    result = []
+    has_index = False
+    args = iter(pip_args)
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if arg in _INDEX_OPTIONS:
+            value = next(args, "")
+            result += [arg, proxied(value)]
+        elif sep and name in _INDEX_OPTIONS:
+            result.append(name + "=" + proxied(value))
+        elif arg.startswith("-i") and arg != "-i":
+            # the short option with its value attached, -ihttps://...
+            name = "-i"
+            result.append(name + proxied(arg[len(name) :]))
+        else:
+            result.append(arg)
+        if name in ("-i", "--index-url", "--no-index"):
+            has_index = True
+    if not has_index:
+        result = ["--index-url", proxied(DEFAULT_INDEX)] + result
+    if upstreams:
+        _register(directory, upstreams)
+    return result
+
+
+def _read_state(directory):
+    try:
+        with open(os.path.join(directory, _STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(port):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+    try:
+        connection.request("GET", "/health")
+        return connection.getresponse().status == 200
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def ensure(directory, cache_dir, idle_timeout=600):
+    """Starts the proxy of a directory, unless it is running already.
+
+    Args:
+        directory: directory of the state of the proxy
+        cache_dir: wheel store the proxy keeps the files in
+        idle_timeout: seconds without requests after which a started proxy
+            exits
+    Returns:
+        int: port of the proxy
+    """
+    state = _read_state(directory)
+    if state and _alive(state["port"]):
+        return state["port"]
+    with _lock(directory) as lock:
+        # only one of the fetches starting at once starts the proxy
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = _read_state(directory)
+        if state and _alive(state["port"]):
+            return state["port"]
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(directory, _STATE_FILE))
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--directory",
+                directory,
+                "--cache-dir",
+                cache_dir,
+                "--idle-timeout",
+                str(idle_timeout),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            # outlives the fetch that started it
+            start_new_session=True,
+        )
+        deadline = time.time() + _START_SECONDS
+        while time.time() < deadline:
+            state = _read_state(directory)
+            if state and _alive(state["port"]):
+                return state["port"]
+            time.sleep(0.05)
+    raise RuntimeError("index proxy in %s did not start" % directory)
+
+
+def proxy_pip_args(pip_args):
+    """Points pip arguments at the proxy, if it is configured.
+
+    Args:
+        pip_args: pip arguments
+    Returns:
+        list: arguments pointing at the proxy, unchanged if the proxy is not
+            configured or can not run here
+    """
+    directory = os.environ.get(DIRECTORY_ENV)
+    if not directory or fcntl is None:
+        return pip_args
+    return rewrite_pip_args(
+        pip_args,
+        ensure(directory, os.environ.get(CACHE_DIR_ENV) or directory),
+        directory,
+    )
+
+
+class _Upstream(object):
+    """Pooled keep-alive connections to the upstream servers."""
+
+    def __init__(self):
+        # imported here, the helpers above run in every fetch
+        from pip._vendor import certifi, urllib3
+
+        self._urllib3 = urllib3
+        self._pool = urllib3.PoolManager(
+            num_pools=16,
+            maxsize=16,
+            block=False,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=certifi.where(),
+            retries=urllib3.Retry(total=3, backoff_factor=0.5, redirect=5),
+            timeout=urllib3.Timeout(connect=15, read=60),
+        )
+
+    def request(self, url, headers=None):
+        """Starts a GET request, the body is read from the response."""
+        headers = dict(headers or {})
+        parts = urlsplit(url)
+        if parts.username:
+            headers.update(
+                self._urllib3.make_headers(
+                    basic_auth="%s:%s" % (parts.username, parts.password or "")
+                )
+            )
+            url = parts._replace(
+                netloc=parts.hostname + (":%d" % parts.port if parts.port else "")
+            ).geturl()
+        return self._pool.request("GET", url, headers=headers, preload_content=False)
+
+
+class _PageCache(object):
+    """Index pages, revalidated with the upstream after max_age seconds."""
+
+    def __init__(self, directory, upstream, max_age):
+        self._directory = os.path.join(directory, _PAGES_DIR)
+        self._upstream = upstream
+        self._max_age = max_age
+        os.makedirs(self._directory, exist_ok=True)
+
+    def _path(self, url):
+        return os.path.join(self._directory, store.digest(url) + ".json")
+
+    def _load(self, url):
+        try:
+            with open(self._path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, url, page):
+        fd, tmp = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(page, f)
+        os.replace(tmp, self._path(url))
+
+    def get(self, url):
+        """Returns the cached or fetched page, None if it does not exist.
+
+        Returns:
+            dict: url after redirects, body, etag and last_modified
+        """
+        page = self._load(url)
+        if page and time.time() - page["fetched"] < self._max_age:
+            return page
+        headers = {"Accept": "text/html"}
+        if page and page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page and page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+        try:
+            response = self._upstream.request(url, headers)
+            body = response.read()
+            response.release_conn()
+        except Exception as e:
+            if page:
+                logging.warning("serving stale %s: %s", url, e)
+                return page
+            raise
+        if response.status == 304 and page:
+            page["fetched"] = time.time()
+        elif response.status == 200:
+            page = {
+                "url": urljoin(url, response.geturl() or ""),
+                "body": body.decode("utf-8", "replace"),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched": time.time(),
+            }
+        elif response.status == 404:
+            return None
+        elif page:
+            logging.warning("serving stale %s: status %d", url, response.status)
+            return page
+        else:
+            raise OSError("%s returned %d" % (url, response.status))
+        self._save(url, page)
+        return page
+
+
+def _rewrite_links(page, links):
+    """Points the links of an index page at the proxy.
+
+    Args:
+        page: page, see _PageCache.get
+        links: set the upstream urls of the links are added to
+    Returns:
+        str: body of the rewritten page
+    """
+
+    def rewrite(match):
+        url, _, fragment = urljoin(
+            page["url"], html.unescape(match.group(1))
+        ).partition("#")
+        sha256 = fragment[len("sha256=") :] if fragment.startswith("sha256=") else ""
+        links.add(url)
+        path = "/files/%s/%s/%s" % (
+            sha256 or "-",
+            _encode(url),
+            urlsplit(url).path.rsplit("/", 1)[-1],
+        )
+        return 'href="%s"' % html.escape(path + ("#" + fragment if fragment else ""))
+
+    return _HREF_RE.sub(rewrite, page["body"])
+
+
+def _wheel_info(filename):
+    """Store info of a file, like whl.py gives the wheels it stores."""
+    if not filename.endswith(".whl"):
+        return {"file": filename}
+    parts = filename[: -len(".whl")].split("-")
+    return {"name": parts[0], "version": parts[1], "tag": "-".join(parts[-3:])}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def do_GET(self):
+        self.server.touch()
+        parts = urlsplit(self.path).path.split("/")
+        try:
+            if self.headers.get("Host") != "127.0.0.1:%d" % self.server.port:
+                # requests of web pages through a rebound dns name
+                self._send(403, b"forbidden", "text/plain")
+            elif parts[1] == "health":
+                self._send(200, b"ok", "text/plain")
+            elif parts[1] == "index" and len(parts) >= 3:
+                self._page(_decode(parts[2]), "/".join(parts[3:]))
+            elif parts[1] == "files" and len(parts) >= 5:
+                self._file(parts[2], _decode(parts[3]), parts[-1])
+            else:
+                self._send(404, b"not found", "text/plain")
+        except Exception as e:
+            logging.exception("proxying %s failed", self.path)
+            self._send(502, str(e).encode("utf-8"), "text/plain")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _page(self, index, project):
+        url = urljoin(index, project)
+        if not url.startswith(index) or not self.server.registered(index):
+            self._send(403, b"index not registered", "text/plain")
+            return
+        page = self.server.pages.get(url)
+        if page is None:
+            self._send(404, b"not found", "text/plain")
+            return
+        body = _rewrite_links(page, self.server.links)
+        self._send(200, body.encode("utf-8"), "text/html")
+
+    def _send_file(self, path):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, _CHUNK)
+
+    def _file(self, sha256, url, filename):
+        linked = url in self.server.links
+        if filename.endswith(".metadata") and not url.endswith(".metadata"):
+            # PEP 658 metadata of the file, small, pip caches it itself
+            url, sha256 = url + ".metadata", "-"
+        key = store.digest("wheel", sha256)
+        cached = sha256 != "-" and store.lookup(self.server.cache_dir, "wheels", key)
+        if cached:
+            self._send_file(os.path.join(cached, os.listdir(cached)[0]))
+            return
+        if not linked:
+            self._send(403, b"not linked by an index page", "text/plain")
+            return
+
+        response = self.server.upstream.request(url)
+        if response.status != 200:
+            body = response.read()
+            response.release_conn()
+            self._send(response.status, body, "text/plain")
+            return
+        if sha256 == "-":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            length = response.headers.get("Content-Length")
+            if length:
+                self.send_header("Content-Length", length)
+            else:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            for chunk in response.stream(_CHUNK):
+                self.wfile.write(chunk)
+            response.release_conn()
+            return
+
+        tmp = tempfile.mkdtemp(dir=self.server.directory)
+        try:
+            path = os.path.join(tmp, filename)
+            digest = hashlib.sha256()
+            with open(path, "wb") as f:
+                for chunk in response.stream(_CHUNK):
+                    digest.update(chunk)
+                    f.write(chunk)
+            response.release_conn()
+            if digest.hexdigest() != sha256.lower():
+                self._send(502, b"sha256 mismatch", "text/plain")
+                return
+            cached = store.add(
+                self.server.cache_dir, "wheels", key, path, info=_wheel_info(filename)
+            )
+            self._send_file(os.path.join(cached, filename))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    """The proxy, listening on a free port of 127.0.0.1.
+
+    Args:
+        directory: directory of the state and the cached pages
+        cache_dir: wheel store of the cached files
+        max_age: seconds a page is served without revalidating it
+        port: port to listen on, 0 for a free one
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, cache_dir, max_age=60, port=0):
+        super(Server, self).__init__(("127.0.0.1", port), _Handler)
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.upstream = _Upstream()
+        self.pages = _PageCache(directory, self.upstream, max_age)
+        self.last_request = time.time()
+        self.port = self.server_address[1]
+        # upstream urls of the links of the pages served
+        self.links = set()
+        self._upstreams = set()
+
+    def registered(self, index):
+        """Returns whether an upstream index was registered by rewrite_pip_args."""
+        if index not in self._upstreams:
+            self._upstreams = registered_upstreams(self.directory)
+        return index in self._upstreams
+
+    def touch(self):
+        self.last_request = time.time()
+
+    def shutdown_when_idle(self, idle_timeout):
+        """Stops serving after idle_timeout seconds without requests."""
+        while time.time() - self.last_request < idle_timeout:
+            time.sleep(min(idle_timeout, 5))
+        self.shutdown()
+
+
+def main():
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(
+        description="Serve a caching proxy of the package indexes on 127.0.0.1."
+    )
+    parser.add_argument(
+        "--directory",
+        action="store",
+        required=True,
+        help="Directory of the state and the cached pages of the proxy.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        help="Wheel store the files are kept in, --directory if not set.",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        default=60,
+        help="Seconds an index page is served before it is revalidated.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=600,
+        help="Exit after this many seconds without requests, 0 to never exit.",
+    )
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+
+    directory = os.path.expanduser(args.directory)
+    os.makedirs(directory, exist_ok=True)
+    server = Server(
+        directory,
+        os.path.expanduser(args.cache_dir or directory),
+        args.max_age,
+        args.port,
+    )
+    state = {"pid": os.getpid(), "port": server.server_address[1]}
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, os.path.join(directory, _STATE_FILE))
+    if args.idle_timeout:
+        threading.Thread(
+            target=server.shutdown_when_idle, args=(args.idle_timeout,), daemon=True
+        ).start()
+    try:
+        server.serve_forever()
+    finally:
+        if _read_state(directory) == state:
+            os.remove(os.path.join(directory, _STATE_FILE))
+
+
+if __name__ == "__main__":
+    main()
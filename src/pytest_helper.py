@@ -1,11 +1,34 @@
+import os
 import sys
 
+import importprof
+
+# before pytest, so its imports are timed as well
+importprof.maybe_install()
+
 import pytest
+import pytest_profile
+import pytest_shard
+
+
+def _junitxml_args(args, environ):
+    # bazel reads the per test results from XML_OUTPUT_FILE
+    xml_output = environ.get("XML_OUTPUT_FILE")
+    if not xml_output or any(arg.startswith("--junitxml") for arg in args):
+        return []
+    return ["--junitxml=%s" % xml_output]
 
 
 def run(argv=None):
     args = sys.argv
-    return pytest.main(args)
+    args = args + _junitxml_args(args, os.environ)
+    plugins = [pytest_shard.from_environment()]
+    # only the tests with profile set get the option
+    if any(arg.startswith(pytest_profile.OPTION) for arg in args):
+        plugins.append(
+            pytest_profile.ProfilePlugin(os.environ.get("TEST_UNDECLARED_OUTPUTS_DIR"))
+        )
+    return pytest.main(args, plugins=plugins)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+"""pytest plugin profiling the session or every test with cProfile
+
+--rules-pip-profile=session writes pytest_session.prof,
+--rules-pip-profile=test writes one profile per test into a profiles directory. Both go to
+TEST_UNDECLARED_OUTPUTS_DIR, or the working directory outside of bazel, and
+can be read with pstats, snakeviz or gprof2dot.
+"""
+import cProfile
+import os
+import re
+
+MODES = ("session", "test")
+# namespaced, pytest-profiling registers --profile
+OPTION = "--rules-pip-profile"
+
+SESSION_PROFILE = "pytest_session.prof"
+TEST_PROFILES = "profiles"
+
+
+def profile_name(nodeid):
+    """File name of the profile of a test.
+
+    Args:
+        nodeid: pytest id of the test
+    Returns:
+        str: a file name made of the characters of the id that are safe in paths
+    """
+    return re.sub(r"[^\w.\-\[\]]+", "_", nodeid).strip("_") + ".prof"
+
+
+class ProfilePlugin(object):
+    """Runs the session or each test under cProfile."""
+
+    def __init__(self, outputs_dir=None):
+        self.outputs_dir = outputs_dir or os.getcwd()
+        self.mode = None
+        self.profiler = None
+
+    def pytest_addoption(self, parser):
+        parser.addoption(
+            OPTION,
+            choices=MODES,
+            help="Profile the whole session or every test with cProfile.",
+        )
+
+    def pytest_configure(self, config):
+        self.mode = config.getoption("rules_pip_profile")
+
+    def pytest_sessionstart(self, session):
+        if self.mode == "session":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        if self.mode == "session" and self.profiler:
+            self.profiler.disable()
+            self._dump(SESSION_PROFILE)
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        if self.mode == "test":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        # setup, call and teardown ran between logstart and logfinish
+        if self.mode == "test" and self.profiler:
+            self.profiler.disable()
+            self._dump(os.path.join(TEST_PROFILES, profile_name(nodeid)))
+            self.profiler = None
+
+    def _dump(self, name):
+        path = os.path.join(self.outputs_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.profiler.dump_stats(path)
@@ -0,0 +1,127 @@
+"""pytest plugin running the share of the tests of a bazel test shard
+
+Bazel sets TEST_TOTAL_SHARDS and TEST_SHARD_INDEX for targets with
+shard_count. Tests are split round robin in collection order, or with
+--shard-durations by their durations from an earlier run, longest first onto
+the least loaded shard. Every shard writes the durations of its tests to
+pytest_durations.json in TEST_UNDECLARED_OUTPUTS_DIR, merging them gives the
+durations file for the next runs.
+"""
+import json
+import os
+
+DURATIONS_FILE = "pytest_durations.json"
+
+# pytest.ExitCode.NO_TESTS_COLLECTED
+_NO_TESTS_COLLECTED = 5
+
+
+def partition(nodeids, index, total, durations=None):
+    """Selects the tests of a shard.
+
+    Args:
+        nodeids: ids of the collected tests, in collection order
+        index: index of the shard
+        total: number of shards
+        durations: map from test id to seconds, tests missing from it count
+            as the average of the others
+    Returns:
+        set: ids of the tests of the shard
+    """
+    if not durations:
+        return set(nodeid for i, nodeid in enumerate(nodeids) if i % total == index)
+
+    known = [durations[nodeid] for nodeid in nodeids if nodeid in durations]
+    default = sum(known) / len(known) if known else 1.0
+    loads = [0.0] * total
+    selected = set()
+    # longest processing time first, ties broken by id to stay deterministic
+    for nodeid in sorted(nodeids, key=lambda n: (-durations.get(n, default), n)):
+        shard = loads.index(min(loads))
+        loads[shard] += durations.get(nodeid, default)
+        if shard == index:
+            selected.add(nodeid)
+    return selected
+
+
+def load_durations(paths):
+    """Reads and merges duration files.
+
+    Args:
+        paths: json files mapping test ids to seconds
+    Returns:
+        dict: map from test id to seconds
+    """
+    durations = {}
+    for path in paths:
+        with open(path) as f:
+            durations.update(json.load(f))
+    return durations
+
+
+class ShardPlugin(object):
+    """Deselects the tests of the other shards and records durations."""
+
+    def __init__(self, index, total, status_file=None, outputs_dir=None):
+        self.index = index
+        self.total = total
+        self.status_file = status_file
+        self.outputs_dir = outputs_dir
+        self.durations = {}
+
+    def pytest_addoption(self, parser):
+        parser.addoption(
+            "--shard-durations",
+            action="append",
+            default=[],
+            help="json file mapping test ids to seconds, used to balance shards",
+        )
+
+    def pytest_configure(self, config):
+        if self.status_file:
+            # tells bazel that the test runner supports sharding
+            with open(self.status_file, "a"):
+                pass
+
+    def pytest_collection_modifyitems(self, session, config, items):
+        if self.total <= 1:
+            return
+        selected = partition(
+            [item.nodeid for item in items],
+            self.index,
+            self.total,
+            load_durations(config.getoption("shard_durations")),
+        )
+        deselected = [item for item in items if item.nodeid not in selected]
+        items[:] = [item for item in items if item.nodeid in selected]
+        config.hook.pytest_deselected(items=deselected)
+
+    def pytest_runtest_logreport(self, report):
+        self.durations[report.nodeid] = (
+            self.durations.get(report.nodeid, 0.0) + report.duration
+        )
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        if self.total > 1 and exitstatus == _NO_TESTS_COLLECTED:
+            # more shards than tests, an empty shard passes
+            session.exitstatus = 0
+        if self.outputs_dir and self.durations:
+            with open(os.path.join(self.outputs_dir, DURATIONS_FILE), "w") as f:
+                json.dump(self.durations, f, indent=2, sort_keys=True)
+
+
+def from_environment(environ=None):
+    """Creates the plugin for the shard bazel runs.
+
+    Args:
+        environ: environment variables, os.environ by default
+    Returns:
+        ShardPlugin: the plugin
+    """
+    environ = os.environ if environ is None else environ
+    return ShardPlugin(
+        int(environ.get("TEST_SHARD_INDEX", 0)),
+        int(environ.get("TEST_TOTAL_SHARDS", 1)),
+        status_file=environ.get("TEST_SHARD_STATUS_FILE"),
+        outputs_dir=environ.get("TEST_UNDECLARED_OUTPUTS_DIR"),
+    )
@@ -0,0 +1,300 @@
+"""content-addressed store for wheels, unpacked whl_library trees and locks"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+ENTRY_FILE = "entry.json"
+# touched by maybe_prune when it scans the store
+PRUNE_STAMP = "prune.stamp"
+KINDS = ("wheels", "trees", "locks")
+
+_SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+_PRUNE_INTERVAL_SECONDS = 600
+
+
+def digest(*parts):
+    """Computes a stable key from json serializable parts.
+
+    Args:
+        parts: values that identify an entry
+    Returns:
+        str: hex digest
+    """
+    blob = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def parse_size(size):
+    """Parses a human readable size like 500M or 10G.
+
+    Args:
+        size: size string, a plain number is taken as bytes
+    Returns:
+        int: size in bytes
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMGT]?)i?B?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("invalid size: %s" % size)
+    return int(match.group(1)) * _SIZE_SUFFIXES[match.group(2).upper()]
+
+
+def _entry_dir(root, kind, key):
+    return os.path.join(root, kind, key[:2], key)
+
+
+def _mkdtemp(root):
+    tmp_root = os.path.join(root, "tmp")
+    if not os.path.isdir(tmp_root):
+        os.makedirs(tmp_root, exist_ok=True)
+    return tempfile.mkdtemp(dir=tmp_root)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def materialize(src, dst):
+    """Recreates the tree at src under dst, hardlinking files when possible.
+
+    Args:
+        src: source directory
+        dst: destination directory, created if missing
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif name in filenames:
+                _link_or_copy(path, os.path.join(target, name))
+
+
+def _tree_size(directory):
+    size = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def lookup(root, kind, key):
+    """Finds an entry in the store and marks it as recently used.
+
+    Args:
+        root: store directory
+        kind: one of KINDS
+        key: entry key
+    Returns:
+        str: path to the entry payload, None if missing
+    """
+    entry = _entry_dir(root, kind, key)
+    try:
+        os.utime(os.path.join(entry, ENTRY_FILE), None)
+    except OSError:
+        return None
+    return os.path.join(entry, "data")
+
+
+def add(root, kind, key, src, info=None):
+    """Adds a file or a directory to the store.
+
+    Concurrent writers of the same key are safe, the first one wins.
+
+    Args:
+        root: store directory
+        kind: one of KINDS
+        key: entry key
+        src: file or directory to store
+        info: extra json serializable data kept with the entry
+    Returns:
+        str: path to the entry payload
+    """
+    tmp = _mkdtemp(root)
+    try:
+        data = os.path.join(tmp, "data")
+        if os.path.isdir(src):
+            materialize(src, data)
+        else:
+            os.makedirs(data)
+            _link_or_copy(src, os.path.join(data, os.path.basename(src)))
+        entry = dict(info or {}, kind=kind, key=key, size=_tree_size(data))
+        with open(os.path.join(tmp, ENTRY_FILE), "w") as f:
+            json.dump(entry, f, sort_keys=True)
+
+        entry_dir = _entry_dir(root, kind, key)
+        if not os.path.isdir(os.path.dirname(entry_dir)):
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        try:
+            os.rename(tmp, entry_dir)
+        except OSError:
+            if not os.path.exists(os.path.join(entry_dir, ENTRY_FILE)):
+                raise
+            # somebody else stored the same entry first
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+    return os.path.join(entry_dir, "data")
+
+
+def entries(root):
+    """Lists the entries of the store.
+
+    Args:
+        root: store directory
+    Returns:
+        list: entry dicts sorted from least to most recently used
+    """
+    result = []
+    for kind in KINDS:
+        for entry_file in _glob_entries(root, kind):
+            try:
+                with open(entry_file) as f:
+                    entry = json.load(f)
+                entry["last_used"] = os.stat(entry_file).st_mtime
+            except (OSError, ValueError):
+                continue
+            entry["path"] = os.path.dirname(entry_file)
+            result.append(entry)
+    return sorted(result, key=lambda e: e["last_used"])
+
+
+def _glob_entries(root, kind):
+    kind_dir = os.path.join(root, kind)
+    if not os.path.isdir(kind_dir):
+        return
+    for prefix in os.listdir(kind_dir):
+        prefix_dir = os.path.join(kind_dir, prefix)
+        for key in os.listdir(prefix_dir):
+            yield os.path.join(prefix_dir, key, ENTRY_FILE)
+
+
+def remove(root, entry):
+    """Removes an entry, renaming it first so readers never see half of it."""
+    trash = _mkdtemp(root)
+    try:
+        os.rename(entry["path"], os.path.join(trash, "entry"))
+    except OSError:
+        pass
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def prune(root, max_size):
+    """Evicts least recently used entries until the store fits in max_size.
+
+    Args:
+        root: store directory
+        max_size: maximum size in bytes
+    Returns:
+        list: removed entries
+    """
+    if not os.path.isdir(root):
+        return []
+    all_entries = entries(root)
+    total = sum(e.get("size", 0) for e in all_entries)
+    removed = []
+    for entry in all_entries:
+        if total <= max_size:
+            break
+        remove(root, entry)
+        total -= entry.get("size", 0)
+        removed.append(entry)
+    return removed
+
+
+def maybe_prune(root, max_size, interval=_PRUNE_INTERVAL_SECONDS):
+    """Prunes the store, unless a fetch did it less than interval seconds ago.
+
+    Every fetch calls it, scanning the whole store each time would cost more
+    than the fetch of a cached package.
+
+    Args:
+        root: store directory
+        max_size: maximum size in bytes
+        interval: seconds between two scans of the store
+    Returns:
+        list: removed entries
+    """
+    stamp = os.path.join(root, PRUNE_STAMP)
+    try:
+        if time.time() - os.stat(stamp).st_mtime < interval:
+            return []
+    except OSError:
+        pass
+    if not os.path.isdir(root):
+        return []
+    with open(stamp, "a"):
+        os.utime(stamp, None)
+    return prune(root, max_size)
+
+
+def _format_size(size):
+    for suffix in ("B", "K", "M", "G"):
+        if size < 1024:
+            return "%d%s" % (size, suffix)
+        size //= 1024
+    return "%dT" % size
+
+
+def main():
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(
+        description="Inspect and prune the rules_pip wheel store."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        required=True,
+        help="The store directory, same as cache_dir of pip_import.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("list", help="List entries, least recently used first.")
+    prune_parser = subparsers.add_parser("prune", help="Evict old entries.")
+    prune_parser.add_argument(
+        "--max-size", default="0", help="Size to shrink the store to, e.g. 10G."
+    )
+    args = parser.parse_args()
+    root = os.path.expanduser(args.cache_dir)
+
+    if args.command == "prune":
+        for entry in prune(root, parse_size(args.max_size)):
+            print("removed %s %s" % (entry["kind"], entry["key"]))
+        return
+
+    total = 0
+    for entry in entries(root):
+        total += entry.get("size", 0)
+        print(
+            "{kind:6} {name}=={version} {size:>6} {last_used} {key}{build}".format(
+                kind=entry["kind"],
+                name=entry.get("name"),
+                version=entry.get("version"),
+                size=_format_size(entry.get("size", 0)),
+                last_used=time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(entry["last_used"])
+                ),
+                key=entry["key"],
+                build=(
+                    " built in %ss" % entry["build_seconds"]
+                    if "build_seconds" in entry
+                    else ""
+                ),
+            )
+        )
+    print("total %s" % _format_size(total), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""phase tracing of piptool.py and whl.py
+
+A traced invocation writes two files into the trace directory when it exits:
+
+  <tool>-<label>-<pid>.trace.json: chrome trace events of its phases, with
+      byte and file counts, for chrome://tracing or https://ui.perfetto.dev
+  <tool>-<label>-<pid>.summary.json: total seconds, bytes and files per phase
+
+Tracing is enabled by --trace-dir or the RULES_PIP_TRACE_DIR environment
+variable. The traces of all the fetches of a build are merged into a single
+timeline, and the slowest packages are reported, with:
+
+  $ python src/tracing.py --trace-dir /tmp/traces --output /tmp/fetch.json
+"""
+import argparse
+import atexit
+import contextlib
+import glob
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+ENV_VAR = "RULES_PIP_TRACE_DIR"
+
+# span of the generation of one package repository, the unit of the report
+PACKAGE_SPAN = "generate"
+
+_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+_trace = None
+
+
+def _now_us():
+    # wall clock, so the traces of all processes share a timeline
+    return int(time.time() * 1e6)
+
+
+class Trace(object):
+    """Spans of one invocation of a tool."""
+
+    def __init__(self, tool, label):
+        self.tool = tool
+        self.label = label
+        self.pid = os.getpid()
+        self.start = _now_us()
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Records a complete event around the block.
+
+        Yields:
+            dict: args of the event, e.g. bytes and files, filled by the block
+        """
+        start = _now_us()
+        try:
+            yield args
+        finally:
+            event = {
+                "name": name,
+                "cat": self.tool,
+                "ph": "X",
+                "ts": start,
+                "dur": _now_us() - start,
+                "pid": self.pid,
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """Totals per phase.
+
+        Returns:
+            dict: tool, label, wall seconds and per phase the seconds, count,
+                bytes and files
+        """
+        phases = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            phase = phases.setdefault(
+                event["name"], {"seconds": 0.0, "count": 0, "bytes": 0, "files": 0}
+            )
+            phase["seconds"] += event["dur"] / 1e6
+            phase["count"] += 1
+            for counter in ("bytes", "files"):
+                phase[counter] += event["args"].get(counter, 0)
+        for phase in phases.values():
+            phase["seconds"] = round(phase["seconds"], 3)
+        return {
+            "tool": self.tool,
+            "label": self.label,
+            "seconds": round((_now_us() - self.start) / 1e6, 3),
+            "phases": phases,
+        }
+
+    def write(self, directory):
+        """Writes the trace and the summary.
+
+        Args:
+            directory: trace directory
+        Returns:
+            str: path to the trace file
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        base = os.path.join(
+            directory,
+            "%s-%s-%d" % (self.tool, _UNSAFE_RE.sub("_", self.label), self.pid),
+        )
+        process_name = {
+            "name": "process_name",
+            "ph": "M",
+            "pid": self.pid,
+            "args": {"name": "%s %s" % (self.tool, self.label)},
+        }
+        with self._lock:
+            events = [process_name] + list(self.events)
+        with open(base + ".trace.json", "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        with open(base + ".summary.json", "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        return base + ".trace.json"
+
+
+def start(tool, label, directory=None):
+    """Starts tracing this process, the trace is written when it exits.
+
+    Args:
+        tool: name of the tool, e.g. whl.py
+        label: what the invocation works on, e.g. the package name
+        directory: trace directory, RULES_PIP_TRACE_DIR if not set
+    Returns:
+        Trace: the trace, None if tracing is not enabled
+    """
+    global _trace
+    directory = directory or os.environ.get(ENV_VAR)
+    if not directory:
+        return None
+    _trace = Trace(tool, label)
+    atexit.register(_trace.write, os.path.abspath(os.path.expanduser(directory)))
+    return _trace
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """Traces a phase, if tracing is enabled.
+
+    Args:
+        name: name of the phase
+        **args: args of the event, e.g. the package
+    Yields:
+        dict: args of the event, counters like bytes and files can be added
+    """
+    if _trace is None:
+        yield args
+        return
+    with _trace.span(name, **args) as event_args:
+        yield event_args
+
+
+def load(directory):
+    """Loads the events of all the traces of a directory."""
+    events = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.trace.json"))):
+        try:
+            with open(path) as f:
+                events.extend(json.load(f)["traceEvents"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return events
+
+
+def slowest_packages(events, top):
+    """Finds the packages that took longest, and the phases they spent it in.
+
+    Phases are attributed to the package span of the same thread that
+    contains them.
+
+    Args:
+        events: trace events
+        top: number of packages to report
+    Returns:
+        list: (seconds, package, {phase: seconds}), slowest first
+    """
+    spans = [e for e in events if e.get("ph") == "X"]
+    packages = sorted(
+        (e for e in spans if e["name"] == PACKAGE_SPAN),
+        key=lambda e: -e["dur"],
+    )[:top]
+    result = []
+    for package in packages:
+        end = package["ts"] + package["dur"]
+        phases = {}
+        for e in spans:
+            if (
+                e is not package
+                and e["pid"] == package["pid"]
+                and e["tid"] == package["tid"]
+                and package["ts"] <= e["ts"]
+                and e["ts"] + e["dur"] <= end
+            ):
+                phases[e["name"]] = phases.get(e["name"], 0) + e["dur"] / 1e6
+        result.append(
+            (package["dur"] / 1e6, package["args"].get("package", "?"), phases)
+        )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the traces of piptool.py and whl.py into one "
+        "timeline and report the slowest packages."
+    )
+    parser.add_argument(
+        "--trace-dir",
+        action="store",
+        default=os.environ.get(ENV_VAR),
+        help="Directory of the traces.",
+    )
+    parser.add_argument(
+        "--output",
+        action="store",
+        help="Write the merged chrome trace to this file.",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of packages in the report.",
+    )
+    args = parser.parse_args()
+    if not args.trace_dir:
+        parser.error("--trace-dir is required")
+
+    events = load(args.trace_dir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print("wrote %d events to %s" % (len(events), args.output), file=sys.stderr)
+
+    for seconds, package, phases in slowest_packages(events, args.top):
+        breakdown = ", ".join(
+            "%s %.1fs" % (name, phase_seconds)
+            for name, phase_seconds in sorted(phases.items(), key=lambda p: -p[1])[:4]
+        )
+        print("%8.1fs %-30s %s" % (seconds, package, breakdown))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,77 @@
 """downloads and parses info of a pkg and generates a BUILD file for it"""
 import argparse
+import atexit
+import base64
+import concurrent.futures
+import csv
+import functools
 import glob
+import hashlib
+import importlib.util
+import json
 import logging
 import os
+import posixpath
+import py_compile
+import re
 import shutil
 import sys
+import sysconfig
+import tempfile
+import threading
+import time
+import zipfile
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
-from pip._internal.commands import create_command
-from pip._vendor import pkg_resources
+from pip._vendor.packaging import markers, tags
+from pip._vendor.packaging.requirements import Requirement
+from pip._vendor.packaging.version import InvalidVersion, Version
 
 import pkginfo
 import installer
+import installer.destinations
+import installer.exceptions
+import installer.records
+import installer.sources
+
+import jobserver
+import proxy
+import store
+import tracing
 
 ENTRYPOINT_PREFIX = "bin-"
 
+# archive with the pure python packages of a zipped whl_library
+ZIP_NAME = "site-packages.zip"
+
+NAMESPACE_STYLES = ("pkgutil", "pep420")
+
+# requirement() without the data of pip_install, written by piptool.py next to
+# requirements.bzl
+MAPPING_BZL = "mapping.bzl"
+
+# targets of a shared repository, read by the per-version wrappers
+SHARED_TARGETS = "shared_targets.json"
+
+# environment variables that change the output of wheel builds
+REPRODUCIBLE_ENV = ("CFLAGS", "SOURCE_DATE_EPOCH", "PYTHONHASHSEED")
+
+# number of parallel compile jobs read by the build systems of common sdists,
+# e.g. pytorch extensions, cmake, numpy and grpcio
+BUILD_JOBS_ENV = (
+    "MAX_JOBS",
+    "CMAKE_BUILD_PARALLEL_LEVEL",
+    "NPY_NUM_BUILD_JOBS",
+    "GRPC_PYTHON_BUILD_EXT_COMPILER_JOBS",
+)
+
+# pip is not thread safe, its commands run one at a time
+_SERIAL_LOCK = threading.RLock()
+
+# pip arguments that never change what gets installed
+_IGNORED_PIP_ARGS = ("--timeout", "--quiet", "-q", "--verbose", "-v")
+
 # https://github.com/dillon-giacoppo/rules_python_external/blob/master/tools/wheel_wrapper.py
 def configure_reproducible_wheels():
     """
@@ -42,100 +100,621 @@ def configure_reproducible_wheels():
         os.environ["PYTHONHASHSEED"] = "0"
 
 
+def configure_native_builds(compiler_cache=None, build_jobs=None, cache_dir=None):
+    """Speeds up compiling the native extensions of sdists.
+
+    Variables already set in the environment are kept.
+
+    Args:
+        compiler_cache: launcher the compilers are wrapped with, e.g. ccache
+            or sccache
+        build_jobs: number of parallel compile jobs of build_ext, make and
+            the build systems reading BUILD_JOBS_ENV
+        cache_dir: directory of the wheel store, the compiler cache is kept
+            in it unless configured otherwise
+    """
+    if compiler_cache:
+        launcher = shutil.which(compiler_cache)
+        if launcher is None:
+            logging.warning("%s not found, compiling without it", compiler_cache)
+        else:
+            for var, default in (("CC", "cc"), ("CXX", "c++")):
+                compiler = (
+                    os.environ.get(var) or sysconfig.get_config_var(var) or default
+                )
+                if os.path.basename(compiler.split()[0]) != os.path.basename(launcher):
+                    os.environ[var] = "%s %s" % (launcher, compiler)
+            # pip builds every sdist in a new temporary directory, ccache
+            # rewrites the paths under the base dir to relative ones so the
+            # builds still hit
+            os.environ.setdefault(
+                "CCACHE_BASEDIR", os.path.realpath(tempfile.gettempdir())
+            )
+            os.environ.setdefault("CCACHE_NOHASHDIR", "1")
+            os.environ.setdefault("CCACHE_COMPILERCHECK", "content")
+            if cache_dir:
+                os.environ.setdefault("CCACHE_DIR", os.path.join(cache_dir, "ccache"))
+                os.environ.setdefault("SCCACHE_DIR", os.path.join(cache_dir, "sccache"))
+
+    if build_jobs:
+        os.environ.setdefault("MAKEFLAGS", "-j%d" % build_jobs)
+        for var in BUILD_JOBS_ENV:
+            os.environ.setdefault(var, str(build_jobs))
+        if "DIST_EXTRA_CONFIG" not in os.environ:
+            # setuptools reads the options of build_ext from this file, it is
+            # private to this process, a file other users can write to would
+            # pass any option to every build
+            tmp = tempfile.mkdtemp(prefix="rules_pip_build_ext_")
+            atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+            config = os.path.join(tmp, "build_ext.cfg")
+            with open(config, "w") as f:
+                f.write("[build_ext]\nparallel = %d\n" % build_jobs)
+            os.environ["DIST_EXTRA_CONFIG"] = config
+
+
 def _create_nspkg_init(dirpath):
-    """Creates an init file to enable namespacing"""
+    """Creates an init file to enable namespacing, returns its path"""
     if not os.path.exists(dirpath):
         # Handle missing namespace packages by ignoring them
-        return
+        return None
     nspkg_init = os.path.join(dirpath, "__init__.py")
     with open(nspkg_init, "w") as nspkg:
         nspkg.write("__path__ = __import__('pkgutil').extend_path(__path__, __name__)")
+    return nspkg_init
+
+
+def _namespace_packages(directory, dist_info, files):
+    """Finds the namespace packages of an installed package.
+
+    Args:
+        directory: installation root
+        dist_info: path to the dist-info directory of the package
+        files: installed files, see installed_files
+    Returns:
+        set: paths of the namespace packages relative to directory
+    """
+    namespaces = set()
+    namespace_packages = os.path.join(dist_info, "namespace_packages.txt")
+    if os.path.exists(namespace_packages):
+        with open(namespace_packages) as nspkg:
+            for line in nspkg.readlines():
+                if line.strip():
+                    namespaces.add(line.strip().replace(".", "/"))
+
+    # PEP 420 -- Implicit Namespace Packages, directories above a module that
+    # are not in a regular package
+    names = top_level_names(directory, files) - set(["bin"])
+    inits = set(f for f in files if f.endswith("/__init__.py"))
+    for f in files:
+        if not f.endswith(_MODULE_SUFFIXES) or _import_name(f) not in names:
+            continue
+        parts = f.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            package = "/".join(parts[:i])
+            if package + "/__init__.py" in inits:
+                break
+            namespaces.add(package)
+    return namespaces
+
+
+def _fix_namespace_packages(directory, dist_info, namespace_style="pkgutil"):
+    """Makes the namespace packages of an installed package importable.
+
+    Args:
+        directory: installation root
+        dist_info: path to the dist-info directory of the package
+        namespace_style: one of NAMESPACE_STYLES, pkgutil adds pkgutil style
+            __init__.py files, pep420 leaves the namespace packages implicit
+    Returns:
+        list: paths of the created files
+    """
+    if namespace_style == "pep420":
+        return []
+    files = installed_files(directory)
+    created = [
+        _create_nspkg_init(os.path.join(directory, namespace))
+        for namespace in sorted(_namespace_packages(directory, dist_info, files))
+    ]
+    return [path for path in created if path]
+
+
+def create_command(name):
+    # importing pip._internal takes most of the startup time, cached trees do
+    # not need it
+    from pip._internal.commands import create_command
+
+    return create_command(name)
+
+
+def _run_pip(command, pip_args):
+    with _SERIAL_LOCK:
+        cmd = create_command(command)
+        status = cmd.main(pip_args)
+    if status:
+        raise RuntimeError("pip %s failed with status %s" % (command, status))
+
+
+def _supported_pip_args(command, pip_args):
+    """Drops arguments of pip install that another pip command does not accept.
+
+    Args:
+        command: pip command name
+        pip_args: arguments meant for pip install
+    Returns:
+        list: arguments accepted by the command
+    """
+    parser = create_command(command).parser
+    install_parser = create_command("install").parser
+    result = []
+    args = iter(pip_args)
+    for arg in args:
+        name = arg.split("=", 1)[0]
+        if not name.startswith("-") or parser.has_option(name):
+            result.append(arg)
+            continue
+        option = install_parser.get_option(name)
+        if option is not None and option.takes_value() and "=" not in arg:
+            next(args, None)
+    return result
+
+
+def _option_values(pip_args, *names):
+    """Values of a pip option, e.g. all --find-links directories."""
+    values = []
+    args = iter(pip_args)
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if name in names:
+            values.append(value if sep else next(args, ""))
+    return values
+
+
+def _canonical_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def supported_tags(pip_args):
+    """Wheel tags installable by the target interpreter, best match first.
+
+    Honors the --platform, --python-version, --implementation and --abi
+    arguments of pip.
+
+    Args:
+        pip_args: extra pip args sent to pip
+    Returns:
+        list: list of packaging.tags.Tag
+    """
+    from pip._internal.utils.compatibility_tags import get_supported
+
+    python_version = _option_values(pip_args, "--python-version")
+    implementation = _option_values(pip_args, "--implementation")
+    return get_supported(
+        version=python_version[-1].replace(".", "") if python_version else None,
+        platforms=_option_values(pip_args, "--platform") or None,
+        impl=implementation[-1] if implementation else None,
+        abis=_option_values(pip_args, "--abi") or None,
+    )
 
 
-def install_package(pkg, directory, pip_args):
-    """Downloads wheel for a package. Assumes python binary provided has
-    pip and wheel package installed.
+def find_wheel(pkg, version, search_dirs, supported):
+    """Finds the best compatible wheel of a pinned package in local directories.
+
+    Args:
+        pkg: package name
+        version: pinned version
+        search_dirs: directories with wheel files, e.g. --find-links dirs
+        supported: list of supported tags, best match first
+    Returns:
+        str: path to the wheel file, None if there is no compatible wheel
+    """
+    name = _canonical_name(pkg)
+    pinned = Version(version)
+    priorities = {tag: i for i, tag in enumerate(supported)}
+    best, best_priority = None, len(priorities)
+    for directory in search_dirs:
+        if directory.startswith("file:"):
+            directory = url2pathname(urlparse(directory).path)
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            if not filename.endswith(".whl"):
+                continue
+            try:
+                parsed = installer.utils.parse_wheel_filename(filename)
+                if _canonical_name(parsed.distribution) != name:
+                    continue
+                if Version(parsed.version) != pinned:
+                    continue
+            except (ValueError, InvalidVersion):
+                continue
+            priority = min(
+                [priorities.get(t, best_priority) for t in tags.parse_tag(parsed.tag)]
+            )
+            if priority < best_priority:
+                best = os.path.join(directory, filename)
+                best_priority = priority
+    return best
+
+
+def install_package(pkg, directory, pip_args, version=None, namespace_style="pkgutil"):
+    """Installs a package into directory.
+
+    A matching wheel in one of the --find-links directories is unpacked
+    directly, otherwise pip downloads the wheel or builds it from the sdist.
 
     Args:
         pkg: package name
         directory: destination directory to download the wheel file in
-        python: python binary path used to run pip command
         pip_args: extra pip args sent to pip
+        version: pinned version of the package, if known
+        namespace_style: see _fix_namespace_packages
+    Returns:
+        pkginfo.Wheel: metadata of the installed package
+    """
+    wheel = None
+    if version:
+        wheel = find_wheel(
+            pkg,
+            version,
+            _option_values(pip_args, "--find-links", "-f"),
+            supported_tags(pip_args),
+        )
+    if wheel:
+        return install_wheel(wheel, directory, namespace_style)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        return install_wheel(
+            download_wheel(pkg, tmp, pip_args), directory, namespace_style
+        )
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def download_wheel(pkg, directory, pip_args, build_times=None):
+    """Downloads the wheel of a package, building it if there is only an sdist.
+
+    Args:
+        pkg: package name
+        directory: destination directory for the wheel file
+        pip_args: extra pip args sent to pip
+        build_times: dict the seconds spent building the wheel are recorded
+            in, under pkg, if it was built
     Returns:
         str: path to the wheel file
     """
-    pip_args = [
+    common_args = [
         "--isolated",
         "--disable-pip-version-check",
-        "--target",
-        directory,
         "--no-deps",
-        "--ignore-requires-python",
         "--use-deprecated=legacy-resolver",
-        pkg,
-    ] + pip_args
-    cmd = create_command("install")
-    cmd.main(pip_args)
+    ]
+    pip_args = proxy.proxy_pip_args(pip_args)
+    with tracing.span("download", package=pkg) as trace:
+        _run_pip(
+            "download",
+            common_args
+            + ["--ignore-requires-python", "--dest", directory, pkg]
+            + _supported_pip_args("download", pip_args),
+        )
+        downloaded = os.path.join(directory, os.listdir(directory)[0])
+        trace["bytes"] = os.path.getsize(downloaded)
+    if downloaded.endswith(".whl"):
+        return downloaded
 
-    # need dist-info directory for pkg_resources to be able to find the packages
-    dist_info = glob.glob(os.path.join(directory, "*.dist-info"))[0]
-    # fix namespace packages by adding proper __init__.py files
-    namespace_packages = os.path.join(dist_info, "namespace_packages.txt")
-    if os.path.exists(namespace_packages):
-        with open(namespace_packages) as nspkg:
-            for line in nspkg.readlines():
-                namespace = line.strip().replace(".", os.sep)
-                if namespace:
-                    _create_nspkg_init(os.path.join(directory, namespace))
-
-    # PEP 420 -- Implicit Namespace Packages
-    if (sys.version_info[0], sys.version_info[1]) >= (3, 3):
-        for dirpath, dirnames, filenames in os.walk(directory):
-            # we are only interested in dirs with no init file
-            if "__init__.py" in filenames:
-                dirnames[:] = []
+    sdist = downloaded
+    wheel_dir = os.path.join(directory, "wheel")
+    with jobserver.build_slots(pkg), tracing.span("build_sdist", package=pkg):
+        start = time.time()
+        _run_pip(
+            "wheel",
+            common_args
+            + ["--wheel-dir", wheel_dir, sdist]
+            + _supported_pip_args("wheel", pip_args),
+        )
+        seconds = time.time() - start
+    logging.info("built %s in %.1fs", os.path.basename(sdist), seconds)
+    if build_times is not None:
+        build_times[pkg] = seconds
+    return glob.glob(os.path.join(wheel_dir, "*.whl"))[0]
+
+
+class _HashingReader(object):
+    """File object wrapper that hashes what is read through it."""
+
+    def __init__(self, stream, algorithm):
+        self._stream = stream
+        self._hash = hashlib.new(algorithm)
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def digest(self):
+        return base64.urlsafe_b64encode(self._hash.digest()).rstrip(b"=").decode()
+
+
+class VerifyingWheelFile(installer.sources.WheelFile):
+    """A wheel source that checks every file against its RECORD entry."""
+
+    def get_contents(self):
+        for record, stream in super(VerifyingWheelFile, self).get_contents():
+            path, hash_, size = record
+            if not hash_:
+                # RECORD itself has no hash
+                yield record, stream
                 continue
-            # remove bin and dist-info dirs
-            for ignored in ("bin", os.path.basename(dist_info)):
-                if ignored in dirnames:
-                    dirnames.remove(ignored)
-            _create_nspkg_init(dirpath)
+            algorithm, _, expected = hash_.partition("=")
+            reader = _HashingReader(stream, algorithm)
+            yield record, reader
+            # all of the stream has been written once we get here
+            reader.read()
+            if reader.digest() != expected or (size and int(size) != reader.size):
+                raise installer.exceptions.InvalidWheelSource(
+                    self, "{} does not match its RECORD entry".format(path)
+                )
+
+
+class _RootRelativeDestination(installer.destinations.SchemeDictionaryDestination):
+    """Writes RECORD paths relative to the installation root, like pip does."""
+
+    def finalize_installation(self, scheme, record_file_path, records):
+        root = self.scheme_dict[scheme]
+        records = [
+            (
+                record_scheme,
+                installer.records.RecordEntry(
+                    _relpath(
+                        os.path.join(self.scheme_dict[record_scheme], record.path),
+                        root,
+                    ),
+                    record.hash_,
+                    record.size,
+                ),
+            )
+            for record_scheme, record in records
+        ]
+        super(_RootRelativeDestination, self).finalize_installation(
+            scheme, record_file_path, records
+        )
+
+
+def _relpath(path, start):
+    return os.path.relpath(path, start).replace(os.sep, "/")
+
+
+def _record_line(directory, path):
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = base64.urlsafe_b64encode(hashlib.sha256(content).digest())
+    return "{},sha256={},{}\n".format(
+        _relpath(path, directory), digest.rstrip(b"=").decode(), len(content)
+    )
+
+
+def install_wheel(wheel, directory, namespace_style="pkgutil"):
+    """Unpacks a wheel file into directory, the same layout as pip --target.
+
+    Args:
+        wheel: path to the wheel file
+        directory: installation root
+        namespace_style: see _fix_namespace_packages
+    Returns:
+        pkginfo.Wheel: metadata of the installed package
+    """
+    parsed = installer.utils.parse_wheel_filename(os.path.basename(wheel))
+    destination = _RootRelativeDestination(
+        {
+            "purelib": directory,
+            "platlib": directory,
+            "headers": os.path.join(
+                directory, "include", "python", parsed.distribution
+            ),
+            "scripts": os.path.join(directory, "bin"),
+            "data": directory,
+        },
+        interpreter=sys.executable,
+        # entry points are run as the main of a py_binary, never as executables
+        script_kind="posix",
+    )
+    with tracing.span("install_wheel", bytes=os.path.getsize(wheel)) as trace:
+        with VerifyingWheelFile.open(wheel) as source:
+            installer.install(
+                source, destination, additional_metadata={"INSTALLER": b"rules_pip\n"}
+            )
+        trace["files"] = len(installed_files(directory))
+
+    dist_info = glob.glob(os.path.join(directory, "*.dist-info"))[0]
+    with tracing.span("namespace_packages") as trace:
+        created = _fix_namespace_packages(directory, dist_info, namespace_style)
+        trace["files"] = len(created)
+    # generated files are part of the installation, the same as pip does for
+    # compiled files
+    with open(os.path.join(dist_info, "RECORD"), "a") as record:
+        record.writelines(_record_line(directory, path) for path in created)
 
     return pkginfo.Wheel(dist_info)
 
 
-def dependencies(pkg, extra=None):
-    """Find dependencies of a wheel.
+def installed_files(directory):
+    """Lists the files of the package installed in directory.
 
     Args:
-        whl_path: path to wheel
-        extra: find additional dependencies for the extra instead
+        directory: installation root
     Returns:
-        list: list of dependencies
+        list: sorted paths relative to directory, as listed in RECORD
     """
-    ret = set()
+    dist_info = glob.glob(os.path.join(directory, "*.dist-info"))[0]
+    with open(os.path.join(dist_info, "RECORD"), newline="") as f:
+        return sorted(set(row[0] for row in csv.reader(f) if row))
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_requirement(requirement):
+    """Parses a Requires-Dist line, parsed requirements and markers are reused."""
+    return Requirement(requirement)
+
+
+def dependency_map(pkg, extras=None, environment=None):
+    """Find dependencies of a wheel and of its extras in one pass.
+
+    Args:
+        pkg: metadata of the package, e.g. pkginfo.Wheel
+        extras: extras to find additional dependencies for
+        environment: marker variables of the target environment, e.g.
+            {"python_version": "3.8", "sys_platform": "linux"}, the running
+            interpreter is used for missing ones
+    Returns:
+        dict: map from None, for the package itself, and from each extra to
+            the sorted list of dependencies
+    """
+    env = markers.default_environment()
+    env.update(environment or {})
+    # the package itself is evaluated without any extra
+    base_env = dict(env, extra="")
+    extra_envs = [(extra, dict(env, extra=extra)) for extra in extras or []]
+
+    result = {extra: set() for extra in [None] + list(extras or [])}
     for dist in pkg.requires_dist:
-        requirement = pkg_resources.Requirement.parse(dist)
+        requirement = _parse_requirement(dist)
         # we replace all underscores with dash, to make package names similiar in all cases
         name = requirement.name.replace("_", "-")
-        if extra:
+        if requirement.extras:
+            names = ["{}[{}]".format(name, e) for e in requirement.extras]
+        else:
+            names = [name]
+
+        marker = requirement.marker
+        if not marker or marker.evaluate(base_env):
+            result[None].update(names)
             # for extras we don't grab dependencies for the main pkg,
-            # those are already in the main plg rule
-            if not requirement.marker or requirement.marker.evaluate({"extra": None}):
-                continue
+            # those are already in the main pkg rule
+            continue
+        for extra, extra_env in extra_envs:
+            if marker.evaluate(extra_env):
+                result[extra].update(names)
 
-        if requirement.marker:
-            if not requirement.marker.evaluate({"extra": extra}):
-                continue
+    return {extra: sorted(deps) for extra, deps in result.items()}
 
-        if requirement.extras:
-            ret = ret | set(
-                ["{}[{}]".format(name, dist_extra) for dist_extra in requirement.extras]
-            )
-        else:
-            ret.add(name)
 
-    return sorted(list(ret))
+def dependencies(pkg, extra=None):
+    """Find dependencies of a wheel.
+
+    Args:
+        pkg: metadata of the package, e.g. pkginfo.Wheel
+        extra: find additional dependencies for the extra instead
+    Returns:
+        list: list of dependencies
+    """
+    return dependency_map(pkg, [extra] if extra else None)[extra]
+
+
+def _interpreter_tag():
+    """The most specific wheel tag supported by the running interpreter."""
+    return str(next(iter(tags.sys_tags())))
+
+
+def _cache_pip_args(pip_args):
+    """pip arguments that are part of the cache key."""
+    result = []
+    args = iter(pip_args)
+    for arg in args:
+        if arg in _IGNORED_PIP_ARGS:
+            if arg == "--timeout":
+                next(args, None)
+            continue
+        if arg.split("=", 1)[0] not in _IGNORED_PIP_ARGS:
+            result.append(arg)
+    return result
+
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _generator_digest():
+    """Digest of this script, trees generated by other versions are not reused."""
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _materialize(tree, directory):
+    try:
+        store.materialize(tree, directory)
+    except OSError as e:
+        # the entry was evicted while we were reading it
+        logging.warning("failed to reuse cached tree %s: %s", tree, e)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        return False
+    return True
+
+
+def _install_from_store(
+    cache_dir, key, pkg, version, directory, pip_args, namespace_style="pkgutil"
+):
+    """Installs a package from a wheel kept in the store.
+
+    The wheel is downloaded or built and added to the store first if missing.
+
+    Args:
+        cache_dir: store directory
+        key: store key of the wheel
+        pkg: package name
+        version: pinned version of the package
+        directory: installation root
+        pip_args: extra pip args sent to pip
+        namespace_style: see _fix_namespace_packages
+    Returns:
+        pkginfo.Wheel: metadata of the installed package
+    """
+    with tracing.span("store_lookup", kind="wheels") as trace:
+        cached = store.lookup(cache_dir, "wheels", key)
+        # another fetch can prune the entry between the lookup and the glob
+        wheels = glob.glob(os.path.join(cached, "*.whl")) if cached else []
+        trace["hit"] = bool(wheels)
+    if wheels:
+        return install_wheel(wheels[0], directory, namespace_style)
+
+    tmp = tempfile.mkdtemp()
+    build_times = {}
+    try:
+        wheel = find_wheel(
+            pkg,
+            version,
+            _option_values(pip_args, "--find-links", "-f"),
+            supported_tags(pip_args),
+        ) or download_wheel(pkg, tmp, pip_args, build_times)
+        parsed = installer.utils.parse_wheel_filename(os.path.basename(wheel))
+        info = {
+            "name": parsed.distribution,
+            "version": parsed.version,
+            "tag": parsed.tag,
+        }
+        if pkg in build_times:
+            info["build_seconds"] = round(build_times[pkg], 1)
+        with tracing.span("store_add", bytes=os.path.getsize(wheel)):
+            store.add(cache_dir, "wheels", key, wheel, info=info)
+        return install_wheel(wheel, directory, namespace_style)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
 
 
 def _cleanup(directory, pattern):
@@ -143,30 +722,92 @@ def _cleanup(directory, pattern):
         shutil.rmtree(p)
 
 
-def _get_numpy_headers(directory):
-    """Generate cc_library rule for numpy headers.
+_HEADER_SUFFIXES = (".h", ".hh", ".hpp", ".hxx", ".cuh", ".inl")
+
+
+def header_includes(files):
+    """Finds the C/C++ headers of a package and where to include them from.
+
+    Only the installed files are looked at, nothing is imported. Headers are
+    included from every directory named include they are in, which covers
+    the get_include() locations of numpy, pybind11, pyarrow and torch, and
+    from include/python for the headers scheme of the wheel. Packages
+    without such a directory get the repository root.
 
     Args:
-        directory: path to numpy package installation root
+        files: installed files, see installed_files
     Returns:
-        str: a cc_library rule
+        tuple: sorted headers and include directories, both relative to the
+            installation root
     """
-    sys.path.insert(0, directory)
-    import numpy
+    headers = sorted(f for f in files if f.endswith(_HEADER_SUFFIXES))
+    includes = set()
+    for header in headers:
+        parts = header.split("/")
+        for i, part in enumerate(parts[:-1]):
+            if part == "include":
+                includes.add("/".join(parts[: i + 1]))
+        if header.startswith("include/python/"):
+            includes.add("include/python")
+    if headers and not includes:
+        includes.add(".")
+    return headers, sorted(includes)
+
 
-    include_dir = os.path.relpath(numpy.get_include(), directory)
-    sys.path.pop(0)
+def _cc_headers(headers, includes):
+    """Renders the cc_library of the headers of a package."""
     return """
 cc_library(
     name = "headers",
-    hdrs = glob(["{include_dir}/**/*.h"]),
-    includes = ["{include_dir}"],
+    hdrs = {hdrs},
+    includes = {includes},
 )
 """.format(
-        include_dir=include_dir
+        hdrs=_starlark_list([json.dumps(h) for h in headers]),
+        includes=_starlark_list([json.dumps(i) for i in includes]),
     )
 
 
+_ENTRY_POINT_TEMPLATE = """\
+import sys
+
+import importprof
+
+importprof.maybe_install()
+
+from {module} import {name}
+
+if __name__ == "__main__":
+    sys.exit({attribute}())
+"""
+
+
+def write_entry_point(directory, script, module, attribute):
+    """Writes the main of the py_binary of a console script.
+
+    The main can time its imports with importprof.
+
+    Args:
+        directory: installation root
+        script: name of the console script
+        module: module of the entry point
+        attribute: function of the entry point, may be dotted
+    Returns:
+        str: path of the main relative to directory
+    """
+    main = "bin/{}{}.py".format(ENTRYPOINT_PREFIX, script)
+    path = os.path.join(directory, main)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(
+            _ENTRY_POINT_TEMPLATE.format(
+                module=module, name=attribute.split(".")[0], attribute=attribute
+            )
+        )
+    return main
+
+
 def get_entry_points(directory):
     dist_info = glob.glob(os.path.join(directory, "*.dist-info"))[0]
     entry_points_path = os.path.join(dist_info, "entry_points.txt")
@@ -182,144 +823,930 @@ def get_entry_points(directory):
         return entry_points_mapping
 
 
-def main():
-    logging.basicConfig()
-    parser = argparse.ArgumentParser(
-        description="Create py_library rule for a WHL file."
-    )
-    parser.add_argument(
-        "--package", action="store", help=("The package name. This is passed to pip.")
-    )
-    parser.add_argument(
-        "--requirements",
-        action="store",
-        help="The pip_import from which to draw dependencies.",
+def precompile(directory, files):
+    """Byte-compiles python files into hash based pycs, see PEP 552.
+
+    The pycs are checked against their source on import instead of relying on
+    timestamps, so they are reproducible and never stale. They are written
+    for the interpreter running this script and added to RECORD.
+
+    Args:
+        directory: installation root
+        files: python files to compile, relative to directory
+    Returns:
+        list: paths of the written pycs, relative to directory
+    """
+    compiled = []
+    for f in files:
+        source = os.path.join(directory, f)
+        cfile = importlib.util.cache_from_source(source)
+        try:
+            py_compile.compile(
+                source,
+                cfile=cfile,
+                # keeps the installation directory out of the pyc
+                dfile=f,
+                doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+            )
+        except py_compile.PyCompileError as e:
+            # e.g. python 2 only modules, importing them fails anyway
+            logging.debug("skipped compiling %s: %s", f, e.msg)
+            continue
+        compiled.append(cfile)
+
+    dist_info = glob.glob(os.path.join(directory, "*.dist-info"))[0]
+    with open(os.path.join(dist_info, "RECORD"), "a") as record:
+        record.writelines(_record_line(directory, path) for path in compiled)
+    return [_relpath(path, directory) for path in compiled]
+
+
+# files that can not be referenced from the generated BUILD file
+_UNLABELED_FILE_RE = re.compile(r"\s")
+# a requirement of a lockfile: name, extras, and the rest of the line
+_CONSTRAINT_RE = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?(.*)$")
+_ROOT_FILES = ("BUILD", "BUILD.bazel", "WORKSPACE", "WORKSPACE.bazel")
+_MODULE_SUFFIXES = (".py", ".so", ".pyd")
+
+
+def _label_files(files, keep_pyc=False):
+    """Drops the files the generated BUILD file can not list."""
+    # a BUILD file inside the package starts a new bazel package, glob never
+    # crossed into those either
+    subpackages = tuple(
+        os.path.dirname(f) + "/"
+        for f in files
+        if "/" in f and os.path.basename(f) in ("BUILD", "BUILD.bazel")
     )
-    parser.add_argument(
-        "--directory",
-        action="store",
-        default=".",
-        help="The directory into which to expand things.",
+    return [
+        f
+        for f in files
+        if f not in _ROOT_FILES
+        and not _UNLABELED_FILE_RE.search(f)
+        and (keep_pyc or not f.endswith(".pyc"))
+        and not (subpackages and f.startswith(subpackages))
+    ]
+
+
+def _import_name(path):
+    """Name of the top-level module or package a file belongs to, if any."""
+    top, sep, rest = path.partition("/")
+    if top == "__pycache__":
+        # pyc of a top-level module
+        top, sep = rest, ""
+    if not sep:
+        if not top.endswith(_MODULE_SUFFIXES + (".pyc",)):
+            return None
+        # six.py or _cffi_backend.cpython-38-x86_64-linux-gnu.so
+        top = top.split(".")[0]
+    return top if top.isidentifier() else None
+
+
+def top_level_names(directory, files):
+    """Finds the top-level import names of the package installed in directory.
+
+    Args:
+        directory: installation root
+        files: installed files, see installed_files
+    Returns:
+        set: names from top_level.txt, or guessed from the files without it
+    """
+    found = set(
+        _import_name(f)
+        for f in files
+        if f.endswith(_MODULE_SUFFIXES) and _import_name(f)
     )
-    parser.add_argument(
-        "--constraint",
-        help="path to requirement file used for pip constraints",
-        required=True,
+    dist_info = glob.glob(os.path.join(directory, "*.dist-info"))[0]
+    top_level = os.path.join(dist_info, "top_level.txt")
+    if not os.path.exists(top_level):
+        return found
+    with open(top_level) as f:
+        return found & set(line.strip() for line in f)
+
+
+def import_targets(files, names):
+    """Splits files into one target per top-level import package.
+
+    Every directory in a top-level package gets its own target as well, e.g.
+    botocore.data, with the files of the directory and the modules directly
+    in the top-level package.
+
+    Args:
+        files: installed files, see installed_files
+        names: top-level import names to generate targets for
+    Returns:
+        dict: map from target name to a (files, directory targets) tuple
+    """
+    grouped = {}
+    for f in files:
+        grouped.setdefault(_import_name(f), []).append(f)
+
+    targets = {}
+    for name in sorted(names):
+        slices = {}
+        rest = []
+        for f in grouped.get(name, []):
+            parts = f.split("/")
+            if len(parts) > 2 and parts[1] != "__pycache__":
+                slices.setdefault(".".join(parts[:2]), []).append(f)
+            else:
+                rest.append(f)
+        direct = [f for f in rest if "/" in f]
+        for sub, sub_files in sorted(slices.items()):
+            targets[sub] = (sorted(direct + sub_files), [])
+        if rest or slices:
+            targets[name] = (rest, sorted(slices))
+    return targets
+
+
+def _zippable(path):
+    return path.endswith((".py", ".pyc", ".pyi")) or path.endswith("/py.typed")
+
+
+def _is_namespace_root(directory, name):
+    init = os.path.join(directory, name, "__init__.py")
+    if not os.path.exists(init):
+        # PEP 420
+        return True
+    with open(init) as f:
+        content = f.read()
+    # pkgutil.extend_path only scans directories, other portions of the
+    # namespace would never see a zipped one
+    return "extend_path" in content or "declare_namespace" in content
+
+
+def _zip_arcname(path):
+    """Path of a file in the archive, pycs move next to their source."""
+    dirname, basename = posixpath.split(path)
+    if posixpath.basename(dirname) != "__pycache__":
+        return path
+    # zipimport only finds legacy pyc locations, e.g. pkg/mod.pyc
+    return posixpath.join(posixpath.dirname(dirname), basename.split(".")[0] + ".pyc")
+
+
+def zip_packages(directory, files, names):
+    """Moves the pure python top-level packages into ZIP_NAME.
+
+    Packages with native extensions or data files and namespace package
+    roots stay extracted, they can not be imported from a zip.
+
+    Args:
+        directory: installation root
+        files: installed files, see installed_files
+        names: top-level import names that may be zipped
+    Returns:
+        tuple: set of zipped names and the list of files left extracted, which
+            includes ZIP_NAME if anything was zipped
+    """
+    grouped = {}
+    for f in files:
+        grouped.setdefault(_import_name(f), []).append(f)
+    zipped = set(
+        name
+        for name in names
+        if grouped.get(name)
+        and all(_zippable(f) for f in grouped[name])
+        and not (
+            os.path.isdir(os.path.join(directory, name))
+            and _is_namespace_root(directory, name)
+        )
     )
-    parser.add_argument(
-        "--extras",
-        action="append",
-        help="The set of extras for which to generate library targets.",
+    if not zipped:
+        return zipped, files
+
+    moved = sorted(f for name in zipped for f in grouped[name])
+    with zipfile.ZipFile(os.path.join(directory, ZIP_NAME), "w") as archive:
+        for f in moved:
+            # fixed timestamps and permissions keep the archive reproducible
+            info = zipfile.ZipInfo(_zip_arcname(f), date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            with open(os.path.join(directory, f), "rb") as src:
+                archive.writestr(info, src.read())
+    for name in zipped:
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    for f in moved:
+        if os.path.exists(os.path.join(directory, f)):
+            os.remove(os.path.join(directory, f))
+
+    moved = set(moved)
+    return zipped, [f for f in files if f not in moved] + [ZIP_NAME]
+
+
+def _starlark_list(expressions, indent=4):
+    if not expressions:
+        return "[]"
+    return "[\n{}{}]".format(
+        "".join(" " * (indent + 4) + e + ",\n" for e in expressions), " " * indent
     )
-    parser.add_argument(
-        "--override",
-        action="append",
-        default=[],
-        help="Specified to replace pip dependencies with bazel targets. Example: "
-        + "--override=@com_google_protobuf//:protobuf_python=protobuf",
+
+
+def _py_library(name, files, deps, extra_data=()):
+    """Renders a py_library with explicit srcs and data.
+
+    Args:
+        name: target name
+        files: installed files of the target
+        deps: dependencies, as starlark expressions
+        extra_data: more data of the target, as starlark expressions
+    Returns:
+        str: a py_library rule
+    """
+    srcs = [json.dumps(f) for f in files if f.endswith(".py")]
+    data = [json.dumps(f) for f in files if not f.endswith(".py")]
+    imports = ['"."'] + ([json.dumps(ZIP_NAME)] if ZIP_NAME in files else [])
+    return """
+py_library(
+    name = "{name}",
+    srcs = {srcs},
+    data = {data},
+    # This makes this directory a top-level in the python import
+    # search path for anything that depends on this.
+    imports = [{imports}],
+    deps = {deps},
+)
+""".format(
+        name=name,
+        imports=", ".join(imports),
+        srcs=_starlark_list(srcs),
+        data=_starlark_list(data + list(extra_data)),
+        deps=_starlark_list(deps),
     )
 
-    args, pip_args = parser.parse_known_args()
 
-    pip_args += ["-c", args.constraint]
+def _load_requirement(requirements):
+    return '\nload("{}//:{}", "requirement")'.format(requirements, MAPPING_BZL)
 
-    configure_reproducible_wheels()
 
-    pkg = install_package(args.package, args.directory, pip_args)
-    extras_list = [
-        """
+def _requirement_deps(names, overrides):
+    """Renders the dependencies on requirements as starlark expressions."""
+    return [
+        json.dumps(overrides[d]) if d in overrides else 'requirement("%s")' % d
+        for d in names
+    ]
+
+
+def _extra_library(extra, deps):
+    """Renders the py_library of an extra, deps are starlark expressions."""
+    return """
 py_library(
     name = "{extra}",
     deps = [
         ":pkg",{deps}
     ],
 )""".format(
-            extra=extra,
-            deps=",".join(['requirement("%s")' % d for d in dependencies(pkg, extra)]),
-        )
-        for extra in args.extras or []
-    ]
+        extra=extra, deps=",".join(deps)
+    )
 
-    entry_point_list = [
-        """
-genrule(
-    name = "{entrypoint_prefix}copy_{script}",
-    srcs = ["bin/{script}"],
-    outs = ["bin/{entrypoint_prefix}{script}.py"],
-    cmd = "cp $(SRCS) $(OUTS)",
-)
 
+def _entry_point_binary(script, main):
+    """Renders the py_binary of a console script, main is a label."""
+    return """
 py_binary(
     name = "{entrypoint_prefix}{script}",
-    srcs = ["bin/{entrypoint_prefix}{script}.py"],
-    main = "bin/{entrypoint_prefix}{script}.py",
+    srcs = ["{main}"],
+    main = "{main}",
     imports = ["."],
-    deps = [":pkg"],
+    deps = [
+        ":pkg",
+        "@com_github_ali5h_rules_pip//src:importprof",
+    ],
 )
 """.format(
-            entrypoint_prefix=ENTRYPOINT_PREFIX, script=script
+        entrypoint_prefix=ENTRYPOINT_PREFIX, script=script, main=main
+    )
+
+
+def _pip_constraint(constraint, package, directory):
+    """Writes the constraint of a package into a file of its own.
+
+    pip download and pip wheel with the legacy resolver fail on the
+    constraints of the other packages of a lockfile, and on constraints with
+    extras, e.g. celery[redis]==5.0 as written by pip-compile.
+
+    Args:
+        constraint: path to the requirements file
+        package: package name
+        directory: private directory the constraints file is written to
+    Returns:
+        str: path to the constraints file, None if the package is not
+            constrained
+    """
+    with open(constraint) as f:
+        lines = f.read().replace("\\\n", " ").splitlines()
+    name = _canonical_name(package)
+    pins = []
+    for line in lines:
+        match = _CONSTRAINT_RE.match(line)
+        if match and _canonical_name(match.group(1)) == name:
+            pins.append(match.group(1) + match.group(2) + "\n")
+    if not pins:
+        return None
+    path = os.path.join(directory, "constraints.txt")
+    with open(path, "w") as f:
+        f.write("".join(pins))
+    return path
+
+
+def generate(
+    package,
+    directory,
+    requirements,
+    constraint,
+    pip_args,
+    version=None,
+    extras=None,
+    overrides=None,
+    cache_dir=None,
+    build_file="BUILD",
+    precompile_pyc=False,
+    zipped=False,
+    namespace_style="pkgutil",
+    wheel=None,
+    dependencies=None,
+    shared=False,
+):
+    """Installs a package and generates the BUILD file of its repository.
+
+    Args:
+        package: package name
+        directory: repository directory
+        requirements: the pip_import repository to draw dependencies from
+        constraint: path to requirement file used for pip constraints
+        pip_args: extra pip args sent to pip
+        version: pinned version of the package, required for caching
+        extras: extras to generate library targets for
+        overrides: map from replacement label to requirement, see --override
+        cache_dir: directory of the wheel store, None to disable it
+        build_file: name of the generated BUILD file
+        precompile_pyc: ship hash based pycs of the python files in data
+        zipped: pack the pure python packages into a single archive
+        namespace_style: see _fix_namespace_packages
+        wheel: wheel file to install instead of looking the package up
+        dependencies: map from "" for the package and from each extra to the
+            requirements it depends on, instead of reading them from the wheel
+        shared: generate a repository without dependencies that pip_imports
+            of any python version share, see generate_wrapper
+    Returns:
+        bool: whether the repository was reused from the store
+    """
+    overrides = overrides or {}
+    if shared:
+        # the wrappers add the dependencies of every pip_import
+        requirements, extras, dependencies, overrides = "", None, {}, {}
+    wheel_key = tree_key = None
+    if cache_dir and wheel:
+        wheel_key = store.digest("wheel", _file_sha256(wheel))
+    elif cache_dir and version:
+        wheel_key = store.digest(
+            "wheel",
+            package.lower(),
+            version,
+            _interpreter_tag(),
+            _cache_pip_args(pip_args),
+            {name: os.environ.get(name) for name in REPRODUCIBLE_ENV},
+        )
+    if wheel_key:
+        tree_key = store.digest(
+            "tree",
+            wheel_key,
+            requirements,
+            sorted(extras or []),
+            overrides,
+            build_file,
+            precompile_pyc,
+            zipped,
+            namespace_style,
+            dependencies,
+            shared,
+            _generator_digest(),
         )
-        for script, val in get_entry_points(args.directory).items()
+        with tracing.span("store_lookup", kind="trees") as trace:
+            tree = store.lookup(cache_dir, "trees", tree_key)
+            trace["hit"] = bool(tree and _materialize(tree, directory))
+        if trace["hit"]:
+            return True
+
+    tmp = tempfile.mkdtemp()
+    try:
+        pip_constraint = _pip_constraint(constraint, package, tmp)
+        if pip_constraint:
+            pip_args = pip_args + ["-c", pip_constraint]
+
+        if wheel:
+            pkg = install_wheel(wheel, directory, namespace_style)
+        elif wheel_key:
+            pkg = _install_from_store(
+                cache_dir,
+                wheel_key,
+                package,
+                version,
+                directory,
+                pip_args,
+                namespace_style,
+            )
+        else:
+            pkg = install_package(
+                package, directory, pip_args, version, namespace_style
+            )
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if dependencies is None:
+        deps = dependency_map(pkg, extras)
+    else:
+        deps = {None: dependencies.get("", [])}
+        deps.update((extra, dependencies.get(extra, [])) for extra in extras or [])
+    extras_list = [
+        _extra_library(extra, ['requirement("%s")' % d for d in deps[extra]])
+        for extra in extras or []
     ]
+
+    mains = dict(
+        (script, write_entry_point(directory, script, module, attribute))
+        for script, (module, attribute) in sorted(get_entry_points(directory).items())
+    )
+    if shared:
+        # the binaries need the dependencies, the wrappers define them
+        entry_point_list = []
+        if mains:
+            entry_point_list.append(
+                "exports_files(%s)"
+                % _starlark_list(
+                    [json.dumps(main) for _, main in sorted(mains.items())], indent=0
+                )
+            )
+    else:
+        entry_point_list = [
+            _entry_point_binary(script, main) for script, main in sorted(mains.items())
+        ]
     entry_points_str = "\n".join(entry_point_list)
 
-    # we treat numpy in a special way, inject a rule for numpy headers
-    if args.package == "numpy":
-        extras_list.append(_get_numpy_headers(args.directory))
+    # clean up
+    _cleanup(directory, "__pycache__")
 
+    files = _label_files(installed_files(directory), keep_pyc=precompile_pyc)
+    if precompile_pyc:
+        with tracing.span("precompile") as trace:
+            compiled = precompile(
+                directory,
+                [f for f in files if f.endswith(".py") and not f.startswith("bin/")],
+            )
+            trace["files"] = len(compiled)
+        files = sorted(files + compiled)
+    dist_info_files = [f for f in files if f.split("/")[0].endswith(".dist-info")]
+    # import names can not take over the names of other targets
+    reserved = set(["pkg", "distinfo", "headers"] + list(extras or []))
+    names = top_level_names(directory, files) - reserved
+    zipped_names = set()
+    if zipped:
+        with tracing.span("zip_packages") as trace:
+            zipped_names, files = zip_packages(directory, files, names)
+            trace["bytes"] = (
+                os.path.getsize(os.path.join(directory, ZIP_NAME))
+                if zipped_names
+                else 0
+            )
+    with tracing.span("headers") as trace:
+        headers, includes = header_includes(files)
+        trace["files"] = len(headers)
+    if headers:
+        extras_list.append(_cc_headers(headers, includes))
     extras = "\n".join(extras_list)
-    # args.override looks like a list of replacement=requirement
-    overrides = dict(rep.split("=") for rep in args.override)
 
-    result = """
-package(default_visibility = ["//visibility:public"])
+    targets = import_targets(files, names - zipped_names)
+    for name in zipped_names:
+        targets[name] = ([ZIP_NAME], [])
+    claimed = set(f for target_files, _ in targets.values() for f in target_files)
+    unclaimed = [f for f in files if f not in claimed and f not in dist_info_files]
+    # files outside of any import package, like auditwheel's .libs directories
+    common = [f for f in unclaimed if f.split("/")[0] not in ("bin", "include")]
 
-load("{requirements}//:requirements.bzl", "requirement")
-
-py_library(
-    name = "pkg",
-    srcs = glob(["**/*.py"]),
-    data = glob(["**/*"], exclude = [
-        "**/*.py",
-        "**/*.pyc",
-        "**/* *",
-        "BUILD",
-        "WORKSPACE",
-        "__pycache__",
-    ]),
-    # This makes this directory a top-level in the python import
-    # search path for anything that depends on this.
-    imports = ["."],
-    deps = [
-        {dependencies}
-    ],
-)
+    requirement_deps = _requirement_deps(deps[None], overrides)
+    libraries = [
+        _py_library(
+            name,
+            sorted(target_files + common),
+            [json.dumps(":" + s) for s in subpackages] + requirement_deps,
+            extra_data=['":distinfo"'],
+        )
+        for name, (target_files, subpackages) in sorted(targets.items())
+    ]
 
+    result = """
+package(default_visibility = ["//visibility:public"])
+{load}
+{pkg}
 filegroup(
     name = "distinfo",
-    srcs = glob(["*.dist-info/**"]),
+    srcs = {distinfo},
 )
 
 {entry_points}
 
-{extras}""".format(
-        requirements=args.requirements,
-        dependencies=",\n        ".join(
-            [
-                '"%s"' % overrides[d] if d in overrides else 'requirement("%s")' % d
-                for d in dependencies(pkg)
-            ]
+{extras}
+{libraries}""".format(
+        load="" if shared else _load_requirement(requirements),
+        pkg=_py_library(
+            "pkg",
+            unclaimed,
+            [json.dumps(":" + name) for name in sorted(targets) if "." not in name]
+            + requirement_deps,
+            extra_data=['":distinfo"'],
         ),
+        distinfo=_starlark_list([json.dumps(f) for f in dist_info_files]),
         entry_points=entry_points_str,
         extras=extras,
+        libraries="".join(libraries),
     )
 
-    # clean up
-    _cleanup(args.directory, "__pycache__")
+    with tracing.span("write_build", files=len(files)):
+        with open(os.path.join(directory, build_file), "w") as f:
+            f.write(result)
+    if shared:
+        with open(os.path.join(directory, SHARED_TARGETS), "w") as f:
+            json.dump(
+                {
+                    "libraries": sorted(targets),
+                    "entry_points": mains,
+                    "headers": bool(headers),
+                },
+                f,
+            )
+
+    if tree_key:
+        with tracing.span("store_add"):
+            store.add(
+                cache_dir,
+                "trees",
+                tree_key,
+                directory,
+                info={"name": pkg.name, "version": pkg.version},
+            )
+    return False
+
+
+def generate_wrapper(
+    directory,
+    requirements,
+    shared_repo,
+    shared_directory,
+    extras=None,
+    overrides=None,
+    dependencies=None,
+):
+    """Generates the BUILD file of a repository wrapping a shared repository.
+
+    The shared repository holds the files of a pure python or abi3 wheel for
+    all python versions, the wrapper adds the dependencies of its pip_import.
+    Nothing is installed.
+
+    Args:
+        directory: repository directory
+        requirements: the pip_import repository to draw dependencies from
+        shared_repo: name of the shared repository, e.g. @pypi__3__six_1_16_0
+        shared_directory: directory of the shared repository
+        extras: extras to generate library targets for
+        overrides: map from replacement label to requirement, see --override
+        dependencies: see generate
+    """
+    overrides = overrides or {}
+    if dependencies is None:
+        dist_info = glob.glob(os.path.join(shared_directory, "*.dist-info"))[0]
+        with open(os.path.join(dist_info, "METADATA"), "rb") as f:
+            pkg = pkginfo.Distribution()
+            pkg.parse(f.read())
+        deps = dependency_map(pkg, extras)
+    else:
+        deps = {None: dependencies.get("", [])}
+        deps.update((extra, dependencies.get(extra, [])) for extra in extras or [])
+    with open(os.path.join(shared_directory, SHARED_TARGETS)) as f:
+        shared_targets = json.load(f)
+
+    requirement_deps = _requirement_deps(deps[None], overrides)
+    libraries = [
+        """
+py_library(
+    name = "{name}",
+    deps = {deps},
+)
+""".format(
+            name=name,
+            deps=_starlark_list(
+                [json.dumps("%s//:%s" % (shared_repo, name))] + requirement_deps
+            ),
+        )
+        for name in ["pkg"] + shared_targets["libraries"]
+    ]
+    result = """
+package(default_visibility = ["//visibility:public"])
+{load}
 
-    with open(os.path.join(args.directory, "BUILD"), "w") as f:
+alias(
+    name = "distinfo",
+    actual = "{shared_repo}//:distinfo",
+)
+{headers}{entry_points}
+{extras}
+{libraries}""".format(
+        load=_load_requirement(requirements),
+        shared_repo=shared_repo,
+        headers=(
+            '\nalias(\n    name = "headers",\n    actual = "%s//:headers",\n)\n'
+            % shared_repo
+            if shared_targets.get("headers")
+            else ""
+        ),
+        entry_points="".join(
+            _entry_point_binary(script, "%s//:%s" % (shared_repo, main))
+            for script, main in sorted(shared_targets["entry_points"].items())
+        ),
+        extras="\n".join(
+            _extra_library(extra, _requirement_deps(deps[extra], {}))
+            for extra in extras or []
+        ),
+        libraries="".join(libraries),
+    )
+    with open(os.path.join(directory, "BUILD"), "w") as f:
         f.write(result)
 
 
+def _generate_all(
+    manifest, pip_args, cache_dir, jobs, precompile_pyc=False, namespace_style="pkgutil"
+):
+    """Generates the repositories of all the packages in a manifest.
+
+    Args:
+        manifest: parsed manifest, see --manifest
+        pip_args: extra pip args sent to pip
+        cache_dir: directory of the wheel store, None to disable it
+        jobs: number of packages processed in parallel
+        precompile_pyc: ship hash based pycs of the python files in data
+        namespace_style: see _fix_namespace_packages
+    """
+
+    def _generate(entry):
+        if not os.path.isdir(entry["directory"]):
+            os.makedirs(entry["directory"])
+        with tracing.span(tracing.PACKAGE_SPAN, package=entry["package"]):
+            _generate_entry(entry)
+
+    def _generate_entry(entry):
+        generate(
+            entry["package"],
+            entry["directory"],
+            manifest["requirements"],
+            manifest["constraint"],
+            pip_args,
+            version=entry.get("version"),
+            extras=entry.get("extras"),
+            overrides=entry.get("overrides"),
+            cache_dir=cache_dir,
+            build_file=manifest.get("build_file", "BUILD"),
+            precompile_pyc=precompile_pyc,
+            zipped=entry.get("zipped", False),
+            namespace_style=namespace_style,
+            dependencies=entry.get("dependencies"),
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # list() re-raises the first failure
+        list(executor.map(_generate, manifest["packages"]))
+
+
+def main():
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(
+        description="Create py_library rule for a WHL file."
+    )
+    parser.add_argument(
+        "--package", action="store", help=("The package name. This is passed to pip.")
+    )
+    parser.add_argument(
+        "--requirements",
+        action="store",
+        help="The pip_import from which to draw dependencies.",
+    )
+    parser.add_argument(
+        "--directory",
+        action="store",
+        default=".",
+        help="The directory into which to expand things.",
+    )
+    parser.add_argument(
+        "--constraint",
+        help="path to requirement file used for pip constraints",
+    )
+    parser.add_argument(
+        "--extras",
+        action="append",
+        help="The set of extras for which to generate library targets.",
+    )
+    parser.add_argument(
+        "--override",
+        action="append",
+        default=[],
+        help="Specified to replace pip dependencies with bazel targets. Example: "
+        + "--override=@com_google_protobuf//:protobuf_python=protobuf",
+    )
+    parser.add_argument(
+        "--version",
+        action="store",
+        help="The pinned version of the package, required for caching.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        help="Directory of the wheel store shared by all whl_library fetches.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        action="store",
+        default="10G",
+        help="The store is pruned to this size after adding entries.",
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store",
+        help="A json file listing many packages to install in one go. It has "
+        + "requirements, constraint and build_file keys, and a list of packages "
+        + "with package, version, directory, extras, overrides, zipped and "
+        + "dependencies keys.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of packages of the manifest processed in parallel.",
+    )
+    parser.add_argument(
+        "--precompile",
+        action="store_true",
+        help="Byte-compile the package into hash based pycs and add them to "
+        + "the data of the generated targets.",
+    )
+    parser.add_argument(
+        "--zipped",
+        action="store_true",
+        help="Pack the pure python packages into %s, native and data files " % ZIP_NAME
+        + "stay extracted.",
+    )
+    parser.add_argument(
+        "--namespace-style",
+        choices=NAMESPACE_STYLES,
+        default="pkgutil",
+        help="pkgutil adds pkgutil style __init__.py files to namespace packages, "
+        + "pep420 keeps them implicit.",
+    )
+
+    parser.add_argument(
+        "--wheel",
+        action="store",
+        help="Install this wheel file, e.g. downloaded by bazel, instead of "
+        + "finding or building the wheel of --package. A wheel inside "
+        + "--directory is removed from it.",
+    )
+    parser.add_argument(
+        "--dependencies",
+        type=json.loads,
+        help='Json map from "" for the package and from each extra to the '
+        + "requirements it depends on, e.g. resolved by pip_import. The "
+        + "Requires-Dist of the wheel are used if missing.",
+    )
+    parser.add_argument(
+        "--compiler-cache",
+        action="store",
+        help="Wrap the compilers of sdist builds with this launcher, e.g. "
+        + "ccache or sccache.",
+    )
+    parser.add_argument(
+        "--build-jobs",
+        type=int,
+        default=0,
+        help="Number of parallel compile jobs of sdist builds.",
+    )
+    parser.add_argument(
+        "--build-slots",
+        type=int,
+        default=0,
+        help="Tokens of the pool shared by the sdist builds of all the "
+        + "processes of the machine, a build takes --build-jobs tokens or its "
+        + "--build-cost. 0 does not limit builds.",
+    )
+    parser.add_argument(
+        "--build-cost",
+        action="append",
+        default=[],
+        help="Tokens the build of a package takes, e.g. grpcio=8 for builds "
+        + "needing a lot of memory.",
+    )
+    parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="Generate a repository without dependencies, shared by the "
+        + "pip_imports of all python versions.",
+    )
+    parser.add_argument(
+        "--shared-repo",
+        action="store",
+        help="Only generate a wrapper adding the dependencies to this shared "
+        + "repository, e.g. @pypi__3__six_1_16_0, nothing is installed.",
+    )
+    parser.add_argument(
+        "--shared-directory",
+        action="store",
+        help="Directory of --shared-repo.",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        action="store",
+        help="Write a trace of the phases to this directory, see tracing.py.",
+    )
+    parser.add_argument(
+        "--index-proxy",
+        action="store_true",
+        help="Download through the local caching proxy of the indexes, "
+        + "started on demand and shared with the other fetches, see proxy.py.",
+    )
+
+    args, pip_args = parser.parse_known_args()
+    if args.shared_repo:
+        if not args.shared_directory:
+            parser.error("--shared-directory is required with --shared-repo")
+    elif not args.manifest and not args.constraint:
+        parser.error("--constraint is required without --manifest")
+
+    configure_reproducible_wheels()
+    tracing.start("whl.py", args.package or "manifest", args.trace_dir)
+
+    # args.override looks like a list of replacement=requirement
+    overrides = dict(rep.split("=") for rep in args.override)
+    cache_dir = args.cache_dir and os.path.expanduser(args.cache_dir)
+    configure_native_builds(args.compiler_cache, args.build_jobs, cache_dir)
+    if args.index_proxy:
+        proxy.configure(cache_dir)
+    if args.build_slots:
+        jobserver.configure(
+            jobserver.default_directory(),
+            args.build_slots,
+            jobserver.parse_costs(args.build_cost),
+            max(1, args.build_jobs),
+        )
+
+    if args.shared_repo:
+        generate_wrapper(
+            args.directory,
+            args.requirements,
+            args.shared_repo,
+            args.shared_directory,
+            extras=args.extras,
+            overrides=overrides,
+            dependencies=args.dependencies,
+        )
+    elif args.manifest:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        _generate_all(
+            manifest,
+            pip_args,
+            cache_dir,
+            args.jobs,
+            args.precompile,
+            args.namespace_style,
+        )
+    else:
+        wheel = args.wheel
+        tmp = tempfile.mkdtemp()
+        try:
+            if wheel and not _relpath(wheel, args.directory).startswith(".."):
+                # downloaded into the repository, it is not part of the package
+                wheel = shutil.move(wheel, tmp)
+                if not os.listdir(os.path.dirname(os.path.abspath(args.wheel))):
+                    os.rmdir(os.path.dirname(os.path.abspath(args.wheel)))
+            with tracing.span(tracing.PACKAGE_SPAN, package=args.package):
+                generate(
+                    args.package,
+                    args.directory,
+                    args.requirements,
+                    args.constraint,
+                    pip_args,
+                    version=args.version,
+                    extras=args.extras,
+                    overrides=overrides,
+                    cache_dir=cache_dir,
+                    precompile_pyc=args.precompile,
+                    zipped=args.zipped,
+                    namespace_style=args.namespace_style,
+                    wheel=wheel,
+                    dependencies=args.dependencies,
+                    shared=args.shared,
+                )
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if cache_dir:
+        store.maybe_prune(cache_dir, store.parse_size(args.cache_max_size))
+
+
 if __name__ == "__main__":
     main()
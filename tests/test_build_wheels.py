@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src import build_wheels
+from tests import wheels
+
+
+class BuildWheelsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        self.links = os.path.join(self.tmp, "links")
+        os.makedirs(self.wheelhouse)
+        os.makedirs(self.links)
+
+    def test_missing_wheels(self):
+        wheels.make_wheel(self.wheelhouse, "alpha", "1.0")
+        wheels.make_wheel(self.links, "beta", "1.0")
+        wheels.make_wheel(self.links, "gamma", "1.0", tag="cp27-cp27mu-linux_armv6l")
+        requirements = os.path.join(self.tmp, "requirements.txt")
+        with open(requirements, "w") as f:
+            f.write("alpha==1.0\nbeta==1.0\ngamma==1.0\nDelta_Pkg==2.0\n")
+        self.assertEqual(
+            build_wheels.missing_wheels(
+                requirements, self.wheelhouse, ["--find-links", self.links]
+            ),
+            [("Delta_Pkg", "2.0"), ("gamma", "1.0")],
+        )
+
+    def test_build_wheels(self):
+        wheels.make_wheel(self.links, "beta", "1.0")
+        built, failed = build_wheels.build_wheels(
+            [("beta", "1.0"), ("missing", "1.0")],
+            self.wheelhouse,
+            ["--no-index", "--find-links", self.links],
+            2,
+        )
+        self.assertEqual(
+            built, {"beta": os.path.join(self.wheelhouse, "beta-1.0-py3-none-any.whl")}
+        )
+        self.assertEqual(list(failed), ["missing"])
+        self.assertEqual(os.listdir(self.wheelhouse), ["beta-1.0-py3-none-any.whl"])
+
+
+if __name__ == "__main__":
+    unittest.main()
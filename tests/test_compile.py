@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from src import compile
+from tests import wheels
+
+
+class CompileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        self.cache = os.path.join(self.tmp, "cache")
+        self.requirements = os.path.join(self.tmp, "requirements.in")
+        self.output = os.path.join(self.tmp, "requirements.txt")
+        os.makedirs(self.wheelhouse)
+        wheels.make_wheel(self.wheelhouse, "alpha", "1.0", requires_dist=["beta"])
+        wheels.make_wheel(self.wheelhouse, "beta", "1.0")
+        wheels.make_wheel(self.wheelhouse, "gamma", "1.0")
+
+    def _compile(self, requirements):
+        with open(self.requirements, "w") as f:
+            f.write(requirements)
+        if os.path.exists(self.output):
+            os.remove(self.output)
+        compile.main(
+            [
+                "--resolution-cache",
+                self.cache,
+                "--quiet",
+                "--no-header",
+                "--no-annotate",
+                "--no-emit-find-links",
+                "--pip-args=--no-index",
+                "--find-links",
+                self.wheelhouse,
+                "--output-file",
+                self.output,
+                self.requirements,
+            ]
+        )
+        with open(self.output) as f:
+            return f.read()
+
+    def test_cached(self):
+        self.assertEqual(self._compile("alpha\n"), "alpha==1.0\nbeta==1.0\n")
+        with mock.patch.object(compile, "_resolve") as resolve:
+            self.assertEqual(self._compile("alpha\n"), "alpha==1.0\nbeta==1.0\n")
+            self.assertFalse(resolve.called)
+            # a new wheel in find-links invalidates the cache
+            wheels.make_wheel(self.wheelhouse, "beta", "2.0")
+            self._compile("alpha\n")
+            self.assertTrue(resolve.called)
+
+    def test_seeded(self):
+        self._compile("alpha\n")
+        wheels.make_wheel(self.wheelhouse, "beta", "2.0")
+        # beta keeps its pin, only gamma is resolved
+        self.assertEqual(
+            self._compile("alpha\ngamma\n"), "alpha==1.0\nbeta==1.0\ngamma==1.0\n"
+        )
+        self.assertEqual(self._compile("alpha\nbeta>1\n"), "alpha==1.0\nbeta==2.0\n")
+
+    def test_input_digests(self):
+        with open(os.path.join(self.tmp, "base.in"), "w") as f:
+            f.write("alpha\n")
+        with open(self.requirements, "w") as f:
+            f.write("-r base.in\n-c {}\ngamma\n".format(self.output))
+        with open(self.output, "w") as f:
+            f.write("gamma==1.0\n")
+        self.assertEqual(
+            sorted(compile.input_digests([self.requirements])),
+            sorted(
+                [
+                    self.requirements,
+                    os.path.join(self.tmp, "base.in"),
+                    self.output,
+                ]
+            ),
+        )
+
+    def test_remote_index_key_expires(self):
+        with open(self.requirements, "w") as f:
+            f.write("alpha\n")
+        params = compile.compile.cli.make_context(
+            "pip-compile", [self.requirements]
+        ).params
+        key = compile.resolution_key
+        # pip's default index
+        self.assertNotEqual(key(params, {}, now=0), key(params, {}, now=86400))
+        self.assertEqual(key(params, {}, now=0), key(params, {}, now=3600))
+        self.assertIsNone(key(params, {}, ttl=0))
+        local = {"PIP_INDEX_URL": "file://" + self.wheelhouse}
+        self.assertEqual(key(params, local, now=0), key(params, local, now=86400))
+
+
+if __name__ == "__main__":
+    unittest.main()
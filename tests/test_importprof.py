@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from src import importprof
+
+
+class ImportProfTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _module(self, path, content=""):
+        path = os.path.join(self.tmp, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_repository(self):
+        self.assertEqual(
+            importprof.repository(
+                "/runfiles/pypi__38__six_1_16_0/six.py".replace("/", os.sep)
+            ),
+            "pypi__38__six_1_16_0",
+        )
+        self.assertEqual(importprof.repository(None), "<stdlib>")
+        self.assertEqual(importprof.repository(json.__file__), "<stdlib>")
+        self.assertEqual(importprof.repository(__file__), "<workspace>")
+
+    def test_timer(self):
+        self._module("pypi__38__top_1_0/proftop/__init__.py", "import profdep\n")
+        self._module("pypi__38__dep_1_0/profdep.py", "import proftop.sub\n")
+        self._module("pypi__38__top_1_0/proftop/sub.py")
+        for repo in ("pypi__38__top_1_0", "pypi__38__dep_1_0"):
+            sys.path.insert(0, os.path.join(self.tmp, repo))
+            self.addCleanup(sys.path.remove, os.path.join(self.tmp, repo))
+
+        timer = importprof.install()
+        try:
+            import proftop
+        finally:
+            importprof.uninstall(timer)
+        timer.write(self.tmp)
+
+        with open(os.path.join(self.tmp, "importprof.json")) as f:
+            report = json.load(f)
+        self.assertEqual(
+            report["modules"]["profdep"]["repository"], "pypi__38__dep_1_0"
+        )
+        top = report["repositories"]["pypi__38__top_1_0"]
+        self.assertEqual(top["modules"], 2)
+        self.assertGreaterEqual(
+            top["cumulative_us"], report["modules"]["proftop"]["cumulative_us"]
+        )
+        with open(os.path.join(self.tmp, "importprof.folded")) as f:
+            stacks = [line.rsplit(" ", 1)[0] for line in f]
+        self.assertIn(
+            "proftop (pypi__38__top_1_0);profdep (pypi__38__dep_1_0);"
+            "proftop.sub (pypi__38__top_1_0)",
+            stacks,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src import index
+from tests import wheels
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        self.output = os.path.join(self.tmp, "simple")
+        os.makedirs(self.wheelhouse)
+
+    def test_project_name(self):
+        self.assertEqual(index.project_name("Foo_Bar-1.0-py3-none-any.whl"), "foo-bar")
+        self.assertEqual(
+            index.project_name("zope.interface-5.4.0.tar.gz"), "zope-interface"
+        )
+        self.assertIsNone(index.project_name("README"))
+
+    def test_build_index(self):
+        wheels.make_wheel(self.wheelhouse, "Alpha_Pkg", "1.0")
+        beta = wheels.make_wheel(self.wheelhouse, "beta", "1.0")
+        self.assertEqual(
+            index.build_index(self.wheelhouse, self.output), ["alpha-pkg", "beta"]
+        )
+        with open(os.path.join(self.output, "beta", "index.html")) as f:
+            page = f.read()
+        self.assertIn(
+            '<a href="file://{}#sha256={}">beta-1.0-py3-none-any.whl</a>'.format(
+                beta, index._sha256(beta)
+            ),
+            page,
+        )
+        with open(os.path.join(self.output, "index.html")) as f:
+            self.assertIn('<a href="alpha-pkg/">alpha-pkg</a>', f.read())
+
+        # only the page of the project with a new wheel is written again
+        wheels.make_wheel(self.wheelhouse, "beta", "2.0")
+        self.assertEqual(index.build_index(self.wheelhouse, self.output), ["beta"])
+        self.assertEqual(index.build_index(self.wheelhouse, self.output), [])
+
+        os.remove(os.path.join(self.wheelhouse, "Alpha_Pkg-1.0-py3-none-any.whl"))
+        self.assertEqual(index.build_index(self.wheelhouse, self.output), [])
+        self.assertFalse(os.path.exists(os.path.join(self.output, "alpha-pkg")))
+        with open(os.path.join(self.output, "index.html")) as f:
+            self.assertNotIn("alpha-pkg", f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
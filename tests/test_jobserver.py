@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import patch
+
+from src import jobserver
+
+
+class JobserverTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_tokens_all_or_nothing(self):
+        with jobserver.tokens(self.tmp, 3, 1):
+            # two slots are free, none stays locked by the failed attempt
+            self.assertEqual(jobserver._try_lock(self.tmp, 3, 3), [])
+            held = jobserver._try_lock(self.tmp, 3, 2)
+            self.assertEqual(len(held), 2)
+            jobserver._release(held)
+        held = jobserver._try_lock(self.tmp, 3, 3)
+        self.assertEqual(len(held), 3)
+        jobserver._release(held)
+
+    def test_shared_directory_refused(self):
+        self.assertIn(str(os.getuid()), jobserver.default_directory())
+        os.chmod(self.tmp, 0o777)
+        with self.assertRaises(RuntimeError):
+            with jobserver.tokens(self.tmp, 1, 1):
+                pass
+
+    def test_tokens_limit_concurrency(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def build():
+            with jobserver.tokens(self.tmp, 4, 2, poll=0.01):
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=build) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peak), 5)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_build_slots(self):
+        with patch.dict(os.environ, {}, clear=True):
+            with jobserver.build_slots("grpcio==1.0") as count:
+                self.assertEqual(count, 0)
+
+            jobserver.configure(
+                self.tmp, 8, jobserver.parse_costs(["GRPCio=6", "lxml=12"]), 2
+            )
+            with jobserver.build_slots("grpcio==1.0") as count:
+                self.assertEqual(count, 6)
+            with jobserver.build_slots("lxml") as count:
+                self.assertEqual(count, 8)
+            with jobserver.build_slots("six") as count:
+                self.assertEqual(count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
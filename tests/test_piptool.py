@@ -0,0 +1,359 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import mock
+
+from src import index, piptool
+from tests import wheels
+
+
+class ParsePinnedRequirementsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(textwrap.dedent(content))
+        return path
+
+    def test_compiled_file(self):
+        self._write("constraints.txt", "idna==3.3 --hash=sha256:ccc\n")
+        self._write("nested/more.txt", "six==1.16.0\n")
+        path = self._write(
+            "requirements.txt",
+            """\
+            # comment
+            --index-url https://pypi.org/simple
+            -c constraints.txt
+            attrs==21.4.0 \\
+                --hash=sha256:aaa \\
+                --hash=sha256:bbb
+                # via pytest
+            Flask[async, dotenv]==2.0.1 ; python_version >= "3.6"  # comment
+            zope.interface===5.4.0
+            -r nested/more.txt
+            """,
+        )
+        expected = [
+            ("Flask", "2.0.1", ("async", "dotenv")),
+            ("attrs", "21.4.0", ()),
+            ("idna", "3.3", ()),
+            ("six", "1.16.0", ()),
+            ("zope.interface", "5.4.0", ()),
+        ]
+        self.assertEqual(sorted(piptool.parse_pinned_requirements(path)), expected)
+        self.assertEqual(
+            [r[3] for r in sorted(piptool.pinned_requirements(path))],
+            [(), ("aaa", "bbb"), ("ccc",), (), ()],
+        )
+        self.assertEqual(
+            sorted(map(piptool.as_tuple, piptool.get_requirements(path))), expected
+        )
+
+    def test_options_with_values(self):
+        self._write("constraints.txt", "idna==3.3\n")
+        path = self._write(
+            "requirements.txt",
+            """\
+            --index-url https://host/simple?token=abc
+            --extra-index-url=https://other/simple
+            -c constraints.txt
+            six==1.16.0
+            """,
+        )
+        self.assertEqual(
+            sorted(piptool.parse_pinned_requirements(path)),
+            [("idna", "3.3", ()), ("six", "1.16.0", ())],
+        )
+
+    def test_not_pinned(self):
+        for line in ("six>=1.0", "six==1.*", "-e ./local", "six @ https://x/six.zip"):
+            path = self._write("requirements.txt", line + "\n")
+            with self.assertRaises(TypeError):
+                list(piptool.parse_pinned_requirements(path))
+
+
+class GenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _read(self, name):
+        with open(os.path.join(self.tmp, name)) as f:
+            return f.read()
+
+    def test_generated_files(self):
+        with open(os.path.join(self.tmp, "requirements.txt"), "w") as f:
+            f.write("requests[socks]==2.0\nsix==1.16.0\n")
+        argv = [
+            "piptool.py",
+            "--name=pip_deps",
+            "--input=%s" % os.path.join(self.tmp, "requirements.txt"),
+            "--output=%s" % os.path.join(self.tmp, "requirements.bzl"),
+            "--repo-prefix=pypi",
+            "--timeout=10",
+            "--quiet=True",
+            "--override=@six//:pkg=six",
+        ]
+        with mock.patch.object(sys, "argv", argv):
+            piptool.main()
+
+        repo = piptool.repository_name(
+            "pypi", "requests", "2.0", "%d%d" % sys.version_info[:2]
+        )
+        install = self._read(piptool.INSTALL_BZL)
+        self.assertIn(
+            '"%s": {"pkg": "requests", "version": "2.0", "extras": ["socks"], '
+            '"prebuilt": "", "zipped": False},' % repo,
+            install,
+        )
+        self.assertNotIn("six", install.split("_packages")[1])
+        self.assertIn("native.existing_rule(name) == None", install)
+        self.assertNotIn("native.existing_rules()", install)
+
+        mapping = self._read("mapping.bzl")
+        self.assertIn('"requests[socks]": "@%s//:socks"' % repo, mapping)
+        self.assertIn('"six": "@six//:pkg"', mapping)
+        # the mapping literal lives in mapping.bzl only
+        for name in ("BUILD", "requirements.bzl"):
+            self.assertIn('"//:mapping.bzl"', self._read(name))
+            self.assertNotIn("@six//:pkg", self._read(name))
+
+    def test_repeated_pins(self):
+        with open(os.path.join(self.tmp, "constraints.txt"), "w") as f:
+            f.write("Django==3.2.1\n")
+        with open(os.path.join(self.tmp, "more.txt"), "w") as f:
+            f.write("Django[bcrypt]==3.2.1\n")
+        with open(os.path.join(self.tmp, "requirements.txt"), "w") as f:
+            f.write("-c constraints.txt\n-r more.txt\nDjango==3.2.1\n")
+        argv = [
+            "piptool.py",
+            "--name=pip_deps",
+            "--input=%s" % os.path.join(self.tmp, "requirements.txt"),
+            "--output=%s" % os.path.join(self.tmp, "requirements.bzl"),
+            "--repo-prefix=pypi",
+            "--timeout=10",
+            "--quiet=True",
+        ]
+        with mock.patch.object(sys, "argv", argv):
+            piptool.main()
+
+        repo = piptool.repository_name(
+            "pypi", "Django", "3.2.1", "%d%d" % sys.version_info[:2]
+        )
+        install = self._read(piptool.INSTALL_BZL)
+        self.assertEqual(install.count('"%s"' % repo), 1)
+        self.assertIn('"extras": ["bcrypt"]', install)
+
+
+class ResolveWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_resolve_wheel(self):
+        wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        os.makedirs(wheelhouse)
+        wheel = wheels.make_wheel(wheelhouse, "alpha", "1.0")
+        wheels.make_wheel(wheelhouse, "alpha", "2.0")
+        wheels.make_wheel(wheelhouse, "alpha", "1.0", tag="cp27-cp27mu-linux_armv6l")
+        simple = os.path.join(self.tmp, "simple")
+        index.build_index(wheelhouse, simple)
+
+        pip_args = ["--index-url", index.index_url(simple)]
+        finder = piptool.wheel_finder(pip_args)
+        supported = piptool.whl.supported_tags(pip_args)
+        with open(wheel, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        expected = ("file://" + wheel, "alpha-1.0-py3-none-any.whl", sha256)
+        self.assertEqual(
+            piptool.resolve_wheel(finder, "alpha", "1.0", (), supported), expected
+        )
+        self.assertEqual(
+            piptool.resolve_wheel(finder, "alpha", "1.0", (sha256,), supported),
+            expected,
+        )
+        # the lockfile pins another artifact
+        self.assertIsNone(
+            piptool.resolve_wheel(finder, "alpha", "1.0", ("0" * 64,), supported)
+        )
+        self.assertIsNone(piptool.resolve_wheel(finder, "beta", "1.0", (), supported))
+
+    def test_index_url_drops_no_index(self):
+        wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        os.makedirs(wheelhouse)
+        wheels.make_wheel(wheelhouse, "alpha", "1.0")
+        simple = os.path.join(self.tmp, "simple")
+        index.build_index(wheelhouse, simple)
+        with open(os.path.join(self.tmp, "requirements.txt"), "w") as f:
+            f.write("alpha==1.0\n")
+        argv = [
+            "piptool.py",
+            "--name=pip_deps",
+            "--input=%s" % os.path.join(self.tmp, "requirements.txt"),
+            "--output=%s" % os.path.join(self.tmp, "requirements.bzl"),
+            "--repo-prefix=pypi",
+            "--timeout=10",
+            "--quiet=True",
+            "--index-url=%s" % index.index_url(simple),
+            "--resolve-urls",
+            "--no-index",
+        ]
+        with mock.patch.object(sys, "argv", argv):
+            piptool.main()
+
+        with open(os.path.join(self.tmp, piptool.INSTALL_BZL)) as f:
+            install = f.read()
+        self.assertIn('"filename": "alpha-1.0-py3-none-any.whl"', install)
+        self.assertIn('arg != "--no-index"', install)
+
+
+class SharedRepositoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_shared_repository_name(self):
+        name = piptool.shared_repository_name
+        self.assertEqual(
+            name("pypi", "six", "1.16.0", "six-1.16.0-py2.py3-none-any.whl"),
+            "pypi__3__six_1_16_0",
+        )
+        self.assertEqual(
+            name(
+                "pypi",
+                "cryptography",
+                "38.0.1",
+                "cryptography-38.0.1-cp36-abi3-manylinux_2_24_x86_64.whl",
+            ),
+            "pypi__3__cryptography_38_0_1__cp36_abi3_manylinux_2_24_x86_64",
+        )
+        self.assertNotEqual(
+            name(
+                "pypi",
+                "cryptography",
+                "38.0.1",
+                "cryptography-38.0.1-cp37-abi3-manylinux_2_24_x86_64.whl",
+            ),
+            "pypi__3__cryptography_38_0_1__cp36_abi3_manylinux_2_24_x86_64",
+        )
+        self.assertIsNone(
+            name("pypi", "grpcio", "1.0", "grpcio-1.0-cp38-cp38-manylinux1_x86_64.whl")
+        )
+
+    def test_generated_shared_repositories(self):
+        links = os.path.join(self.tmp, "links")
+        os.makedirs(links)
+        wheels.make_wheel(links, "six", "1.16.0")
+        wheels.make_wheel(links, "native", "1.0", tag=piptool.whl._interpreter_tag())
+        with open(os.path.join(self.tmp, "requirements.txt"), "w") as f:
+            f.write("native==1.0\nsix==1.16.0\n")
+        argv = [
+            "piptool.py",
+            "--name=pip_deps",
+            "--input=%s" % os.path.join(self.tmp, "requirements.txt"),
+            "--output=%s" % os.path.join(self.tmp, "requirements.bzl"),
+            "--repo-prefix=pypi",
+            "--timeout=10",
+            "--quiet=True",
+            "--share-wheels",
+            "--no-index",
+            "--find-links",
+            links,
+        ]
+        with mock.patch.object(sys, "argv", argv):
+            piptool.main()
+
+        with open(os.path.join(self.tmp, piptool.INSTALL_BZL)) as f:
+            install = f.read()
+        python_version = "%d%d" % sys.version_info[:2]
+        self.assertIn(
+            '"pypi__3__six_1_16_0": {"pkg": "six", "version": "1.16.0", "extras": [], '
+            '"prebuilt": "", "zipped": False, "shared": True, "precompile": False},',
+            install,
+        )
+        self.assertIn(
+            '"pypi__%s__six_1_16_0": {"pkg": "six", "version": "1.16.0", '
+            '"extras": [], "prebuilt": "", "zipped": False, '
+            '"shared_repo": "@pypi__3__six_1_16_0"},' % python_version,
+            install,
+        )
+        self.assertNotIn("pypi__3__native", install)
+        self.assertEqual(install.count('"shared_repo"'), 1)
+
+
+class DependencyGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _read(self, name):
+        with open(os.path.join(self.tmp, name)) as f:
+            return f.read()
+
+    def test_transitive_closure(self):
+        graph = {"a": ["b"], "b": ["a", "c[x]"], "c[x]": ["c", "d"]}
+        self.assertEqual(
+            piptool.transitive_closure(graph, "a"), ["b", "c", "c[x]", "d"]
+        )
+        self.assertEqual(piptool.transitive_closure(graph, "d"), [])
+
+    def test_generated_graph(self):
+        links = os.path.join(self.tmp, "links")
+        os.makedirs(links)
+        wheels.make_wheel(
+            links,
+            "Requests",
+            "2.0",
+            requires_dist=[
+                "idna",
+                'PySocks ; extra == "socks"',
+                'win-inet-pton ; sys_platform == "win32" and extra == "socks"',
+            ],
+        )
+        wheels.make_wheel(links, "idna", "3.3", requires_dist=["six"])
+        with open(os.path.join(self.tmp, "requirements.txt"), "w") as f:
+            f.write("Requests[socks]==2.0\nidna==3.3\npysocks==1.7\nsix==1.16.0\n")
+        argv = [
+            "piptool.py",
+            "--name=pip_deps",
+            "--input=%s" % os.path.join(self.tmp, "requirements.txt"),
+            "--output=%s" % os.path.join(self.tmp, "requirements.bzl"),
+            "--repo-prefix=pypi",
+            "--timeout=10",
+            "--quiet=True",
+            "--dependency-graph",
+            "--no-index",
+            "--find-links",
+            links,
+        ]
+        with mock.patch.object(sys, "argv", argv):
+            piptool.main()
+
+        mapping = self._read("mapping.bzl")
+        self.assertIn('"requests": ["idna"]', mapping)
+        self.assertIn('"requests[socks]": ["pysocks", "requests"]', mapping)
+        self.assertIn('"idna": ["six"]', mapping)
+        # no metadata for pysocks and six, whl_library finds their dependencies
+        self.assertNotIn('"six":', mapping.split("dependencies = ")[1])
+        self.assertIn("def transitive_requirements(name):", mapping)
+
+        install = self._read(piptool.INSTALL_BZL)
+        self.assertIn(
+            '"dependencies": {"": ["idna", "six"], "socks": ["idna", "pysocks", "six"]}',
+            install,
+        )
+        self.assertEqual(install.count('"dependencies"'), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
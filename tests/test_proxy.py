@@ -0,0 +1,149 @@
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from src import proxy, store, whl
+from tests.wheels import make_wheel
+
+
+class _Upstream(http.server.ThreadingHTTPServer):
+    """Stands in for PyPI, serves a directory and records the responses."""
+
+    def __init__(self, root):
+        self.responses = []
+        server = self
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super(Handler, self).__init__(*args, directory=root, **kwargs)
+
+            def log_request(self, code="-", size="-"):
+                server.responses.append((self.path, int(code)))
+
+        super(_Upstream, self).__init__(("127.0.0.1", 0), Handler)
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_address[1]
+
+
+class ProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        root = os.path.join(self.tmp, "upstream")
+        os.makedirs(os.path.join(root, "files"))
+        os.makedirs(os.path.join(root, "simple", "demo"))
+        wheel = make_wheel(
+            os.path.join(root, "files"), "demo", "1.0", files={"demo/__init__.py": ""}
+        )
+        with open(wheel, "rb") as f:
+            self.sha256 = hashlib.sha256(f.read()).hexdigest()
+        with open(os.path.join(root, "simple", "demo", "index.html"), "w") as f:
+            f.write(
+                '<a href="../../files/demo-1.0-py3-none-any.whl#sha256=%s">'
+                "demo-1.0-py3-none-any.whl</a>\n" % self.sha256
+            )
+
+        self.upstream = _Upstream(root)
+        self.index = "http://127.0.0.1:%d/simple" % _serve(self.upstream)
+        self.addCleanup(self.upstream.server_close)
+        self.cache_dir = os.path.join(self.tmp, "cache")
+        self.directory = os.path.join(self.cache_dir, "proxy")
+        self.server = proxy.Server(self.directory, self.cache_dir, max_age=0)
+        self.port = _serve(self.server)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _get(self, path, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port)
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def _rewrite(self, pip_args):
+        return proxy.rewrite_pip_args(pip_args, self.port, self.directory)
+
+    def test_rewrite_pip_args(self):
+        pip_args = self._rewrite(["--index-url", self.index, "--find-links", "/wheels"])
+        self.assertEqual(pip_args[2:], ["--find-links", "/wheels"])
+        self.assertEqual(proxy.upstream_url(pip_args[1]), self.index + "/")
+        self.assertEqual(proxy.upstream_url(self._rewrite([])[1]), proxy.DEFAULT_INDEX)
+        self.assertEqual(self._rewrite(["--no-index"]), ["--no-index"])
+        (attached,) = self._rewrite(["-i" + self.index])
+        self.assertEqual(proxy.upstream_url(attached[2:]), self.index + "/")
+        self.assertEqual(
+            proxy.registered_upstreams(self.directory),
+            set([self.index + "/", proxy.DEFAULT_INDEX]),
+        )
+
+    def test_relays_registered_upstreams_only(self):
+        other = "http://127.0.0.1:%d/internal/" % self.upstream.server_address[1]
+        page = "/index/%s/demo/" % proxy._encode(other)
+        self.assertEqual(self._get(page)[0], 403)
+        page = self._rewrite(["--index-url", self.index])[1] + "demo/"
+        self.assertEqual(self._get(page)[0], 200)
+        self.assertEqual(self._get(page, {"Host": "attacker.example"})[0], 403)
+        link = "/files/-/%s/demo.whl" % proxy._encode(other + "demo.whl")
+        self.assertEqual(self._get(link)[0], 403)
+        self.assertFalse([p for p, _ in self.upstream.responses if "internal" in p])
+
+    def test_download_through_proxy(self):
+        pip_args = self._rewrite(["--index-url", self.index])
+        download = os.path.join(self.tmp, "download")
+        os.makedirs(download)
+        wheel = whl.download_wheel("demo==1.0", download, pip_args)
+        self.assertEqual(os.path.basename(wheel), "demo-1.0-py3-none-any.whl")
+        self.assertIsNotNone(
+            store.lookup(self.cache_dir, "wheels", store.digest("wheel", self.sha256))
+        )
+
+        page = pip_args[1] + "demo/"
+        status, body = self._get(page)
+        self.assertEqual(status, 200)
+        self.assertIn(b'href="/files/%s/' % self.sha256.encode(), body)
+        # the page was revalidated, the file came from the store
+        self.assertEqual(self.upstream.responses[-1], ("/simple/demo/", 304))
+        self.assertEqual(
+            [path for path, _ in self.upstream.responses].count(
+                "/files/demo-1.0-py3-none-any.whl"
+            ),
+            1,
+        )
+
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        self.assertEqual(self._get(page), (200, body))
+        link = body.decode().split('href="')[1].split("#")[0]
+        status, content = self._get(link)
+        self.assertEqual(hashlib.sha256(content).hexdigest(), self.sha256)
+
+    def test_proxy_started_on_demand(self):
+        directory = os.path.join(self.tmp, "shared")
+        with patch.dict(os.environ):
+            proxy.configure(directory)
+            first = proxy.proxy_pip_args(["--index-url", self.index])
+            second = proxy.proxy_pip_args(["--index-url", self.index])
+        with open(os.path.join(directory, "proxy", "proxy.json")) as f:
+            state = json.load(f)
+        self.addCleanup(os.kill, state["pid"], signal.SIGTERM)
+        self.assertEqual(first, second)
+        self.assertIn("127.0.0.1:%d" % state["port"], first[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import pstats
+import shutil
+import tempfile
+import sys
+import unittest
+
+import mock
+
+from src import pytest_helper, pytest_profile
+
+
+class _Config(object):
+    def __init__(self, profile):
+        self.profile = profile
+
+    def getoption(self, name):
+        return self.profile
+
+
+class ProfilePluginTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_profile_name(self):
+        self.assertEqual(
+            pytest_profile.profile_name("tests/test_a.py::Test::test_b[x-1]"),
+            "tests_test_a.py_Test_test_b[x-1].prof",
+        )
+
+    def test_profile_tests(self):
+        plugin = pytest_profile.ProfilePlugin(self.tmp)
+        plugin.pytest_configure(_Config("test"))
+        plugin.pytest_sessionstart(None)
+        plugin.pytest_runtest_logstart("test_a.py::test_a", None)
+        sorted(range(100))
+        plugin.pytest_runtest_logfinish("test_a.py::test_a", None)
+        plugin.pytest_sessionfinish(None, 0)
+
+        path = os.path.join(self.tmp, "profiles", "test_a.py_test_a.prof")
+        self.assertTrue(pstats.Stats(path).total_calls > 0)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmp, pytest_profile.SESSION_PROFILE))
+        )
+
+    def test_plugin_only_with_option(self):
+        for args, profiled in (([], False), (["--rules-pip-profile=test"], True)):
+            with mock.patch.object(sys, "argv", ["pytest_helper.py"] + args):
+                with mock.patch.object(pytest_helper.pytest, "main") as main:
+                    pytest_helper.run()
+            plugins = main.call_args[1]["plugins"]
+            self.assertEqual(
+                any(type(p).__name__ == "ProfilePlugin" for p in plugins),
+                profiled,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from src import pytest_shard
+
+
+class _Item(object):
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+
+
+class _Config(object):
+    def __init__(self, durations):
+        self.durations = durations
+        self.deselected = []
+        self.hook = self
+
+    def getoption(self, name):
+        return self.durations
+
+    def pytest_deselected(self, items):
+        self.deselected.extend(items)
+
+
+class PartitionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_round_robin(self):
+        nodeids = ["t%d" % i for i in range(7)]
+        shards = [pytest_shard.partition(nodeids, i, 3) for i in range(3)]
+        self.assertEqual(shards[0], set(["t0", "t3", "t6"]))
+        self.assertEqual(set().union(*shards), set(nodeids))
+        self.assertEqual(sum(len(s) for s in shards), len(nodeids))
+
+    def test_durations(self):
+        durations = {"slow": 10.0, "a": 4.0, "b": 3.0, "c": 3.0}
+        nodeids = ["a", "b", "c", "slow", "new"]
+        shards = [pytest_shard.partition(nodeids, i, 2, durations) for i in range(2)]
+        # new counts as the average, 5s
+        self.assertEqual(shards[0], set(["slow", "c"]))
+        self.assertEqual(shards[1], set(["new", "a", "b"]))
+
+    def test_plugin(self):
+        path = os.path.join(self.tmp, "durations.json")
+        with open(path, "w") as f:
+            json.dump({"a": 1.0, "b": 5.0}, f)
+        status = os.path.join(self.tmp, "status")
+        plugin = pytest_shard.from_environment(
+            {
+                "TEST_SHARD_INDEX": "1",
+                "TEST_TOTAL_SHARDS": "2",
+                "TEST_SHARD_STATUS_FILE": status,
+            }
+        )
+        config = _Config([path])
+        items = [_Item("a"), _Item("b"), _Item("c")]
+
+        plugin.pytest_configure(config)
+        plugin.pytest_collection_modifyitems(None, config, items)
+
+        self.assertTrue(os.path.exists(status))
+        self.assertEqual([item.nodeid for item in items], ["a", "c"])
+        self.assertEqual([item.nodeid for item in config.deselected], ["b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
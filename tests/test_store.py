@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from src import store
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def _tree(self, files):
+        directory = tempfile.mkdtemp(dir=self.root)
+        for path, content in files.items():
+            path = os.path.join(directory, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(content)
+        return directory
+
+    def test_digest_is_stable(self):
+        self.assertEqual(
+            store.digest("a", {"x": 1, "y": 2}), store.digest("a", {"y": 2, "x": 1})
+        )
+        self.assertNotEqual(store.digest("a", 1), store.digest("a", 2))
+
+    def test_parse_size(self):
+        self.assertEqual(store.parse_size("10"), 10)
+        self.assertEqual(store.parse_size("2K"), 2048)
+        self.assertEqual(store.parse_size("1GiB"), 1 << 30)
+        self.assertRaises(ValueError, store.parse_size, "lots")
+
+    def test_add_and_materialize_tree(self):
+        cache = os.path.join(self.root, "cache")
+        src = self._tree({"pkg/__init__.py": "", "BUILD": "# build"})
+        self.assertIsNone(store.lookup(cache, "trees", "k"))
+
+        store.add(cache, "trees", "k", src, info={"name": "pkg"})
+        tree = store.lookup(cache, "trees", "k")
+        dst = os.path.join(self.root, "dst")
+        store.materialize(tree, dst)
+
+        self.assertTrue(os.path.exists(os.path.join(dst, "pkg", "__init__.py")))
+        with open(os.path.join(dst, "BUILD")) as f:
+            self.assertEqual(f.read(), "# build")
+
+    def test_add_file(self):
+        cache = os.path.join(self.root, "cache")
+        src = self._tree({"demo-1.0-py3-none-any.whl": "zip"})
+        store.add(cache, "wheels", "w", os.path.join(src, "demo-1.0-py3-none-any.whl"))
+        self.assertEqual(
+            os.listdir(store.lookup(cache, "wheels", "w")),
+            ["demo-1.0-py3-none-any.whl"],
+        )
+
+    def test_prune_evicts_least_recently_used(self):
+        cache = os.path.join(self.root, "cache")
+        for key in ("stale", "fresh"):
+            store.add(cache, "trees", key, self._tree({"f": "x" * 100}))
+        past = time.time() - 100
+        os.utime(
+            os.path.join(store.lookup(cache, "trees", "stale"), "..", "entry.json"),
+            (past, past),
+        )
+
+        removed = store.prune(cache, 150)
+
+        self.assertEqual([e["key"] for e in removed], ["stale"])
+        self.assertIsNone(store.lookup(cache, "trees", "stale"))
+        self.assertIsNotNone(store.lookup(cache, "trees", "fresh"))
+
+    def test_maybe_prune_rate_limited(self):
+        cache = os.path.join(self.root, "cache")
+        store.add(cache, "trees", "a", self._tree({"f": "x" * 100}))
+        self.assertEqual(len(store.maybe_prune(cache, 1000)), 0)
+        store.add(cache, "trees", "b", self._tree({"f": "x" * 100}))
+        # scanned a moment ago
+        self.assertEqual(store.maybe_prune(cache, 0), [])
+        self.assertEqual(len(store.maybe_prune(cache, 0, interval=0)), 2)
+
+    def test_add_reraises_unless_stored(self):
+        cache = os.path.join(self.root, "cache")
+        with mock.patch.object(store.os, "rename", side_effect=OSError("full")):
+            with self.assertRaises(OSError):
+                store.add(cache, "trees", "a", self._tree({"f": "x"}))
+        path = store.add(cache, "trees", "a", self._tree({"f": "x"}))
+        self.assertEqual(store.add(cache, "trees", "a", self._tree({"f": "y"})), path)
+
+
+if __name__ == "__main__":
+    unittest.main()
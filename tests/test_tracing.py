@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from src import tracing, whl
+from tests.wheels import make_wheel
+
+
+class TracingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_span_without_trace(self):
+        with tracing.span("download", bytes=1) as args:
+            args["files"] = 2
+        self.assertEqual(args, {"bytes": 1, "files": 2})
+
+    def test_write_and_summary(self):
+        trace = tracing.Trace("whl.py", "zope.interface")
+        with trace.span(tracing.PACKAGE_SPAN, package="zope.interface"):
+            with trace.span("download") as args:
+                args["bytes"] = 10
+            with trace.span("download", bytes=5):
+                pass
+        path = trace.write(os.path.join(self.tmp, "traces"))
+        self.assertEqual(
+            os.path.basename(path), "whl.py-zope.interface-%d.trace.json" % os.getpid()
+        )
+
+        with open(path.replace(".trace.json", ".summary.json")) as f:
+            summary = json.load(f)
+        self.assertEqual(summary["phases"]["download"]["count"], 2)
+        self.assertEqual(summary["phases"]["download"]["bytes"], 15)
+
+        events = tracing.load(os.path.join(self.tmp, "traces"))
+        self.assertEqual(events[0]["ph"], "M")
+        (result,) = tracing.slowest_packages(events, 10)
+        self.assertEqual(result[1], "zope.interface")
+        self.assertEqual(sorted(result[2]), ["download"])
+
+    def test_slowest_packages(self):
+        def event(name, ts, dur, tid=1, **args):
+            return {
+                "name": name,
+                "ph": "X",
+                "ts": ts,
+                "dur": dur,
+                "pid": 1,
+                "tid": tid,
+                "args": args,
+            }
+
+        events = [
+            event("generate", 0, 3000000, package="grpcio"),
+            event("build_sdist", 1000000, 2000000),
+            event("generate", 0, 1000000, tid=2, package="six"),
+            event("download", 0, 500000, tid=2),
+        ]
+        self.assertEqual(
+            tracing.slowest_packages(events, 1),
+            [(3.0, "grpcio", {"build_sdist": 2.0})],
+        )
+
+    def test_generate_phases(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo==1.0\n")
+        wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        os.makedirs(wheelhouse)
+        make_wheel(wheelhouse, "demo", "1.0", files={"demo/__init__.py": ""})
+        trace = tracing.Trace("whl.py", "demo")
+        with patch.object(whl.tracing, "_trace", trace):
+            whl.generate(
+                "demo",
+                os.path.join(self.tmp, "demo"),
+                "@pip",
+                constraint,
+                ["--find-links", wheelhouse],
+                version="1.0",
+                cache_dir=os.path.join(self.tmp, "cache"),
+            )
+        phases = trace.summary()["phases"]
+        self.assertGreater(phases["install_wheel"]["files"], 0)
+        self.assertGreater(phases["install_wheel"]["bytes"], 0)
+        self.assertIn("store_add", phases)
+        self.assertIn("write_build", phases)
+
+
+if __name__ == "__main__":
+    unittest.main()
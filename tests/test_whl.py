@@ -13,12 +13,18 @@
 # limitations under the License.
 
 import os
+import shutil
+import sys
+import tempfile
 import unittest
+import zipfile
 
 import pkginfo
+from installer.exceptions import InvalidWheelSource
 from mock import patch
 
 from src import whl
+from tests.wheels import make_wheel
 
 
 def TestData(name):
@@ -123,6 +129,529 @@ class WheelTest(unittest.TestCase):
         )
         self.assertEqual(set(whl.dependencies(td)), set([]))
 
+    def test_mock_whl_dependency_map(self):
+        td = pkginfo.Wheel(TestData("mock_whl/file/mock-2.0.0-py2.py3-none-any.whl"))
+        self.assertEqual(
+            whl.dependency_map(
+                td, ["docs", "test"], environment={"python_version": "3.0"}
+            ),
+            {
+                None: ["funcsigs", "pbr", "six"],
+                "docs": ["Pygments", "jinja2", "sphinx"],
+                "test": ["unittest2"],
+            },
+        )
+
+    def test_google_cloud_language_whl_environment(self):
+        td = pkginfo.Wheel(
+            TestData(
+                "google_cloud_language_whl/file/google_cloud_language-0.29.0-py2.py3-none-any.whl"
+            )
+        )
+        self.assertIn(
+            "enum34",
+            whl.dependency_map(td, environment={"python_version": "2.7"})[None],
+        )
+        self.assertNotIn(
+            "enum34",
+            whl.dependency_map(td, environment={"python_version": "3.4"})[None],
+        )
+
+
+class InstallTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.wheelhouse = os.path.join(self.tmp, "wheelhouse")
+        self.directory = os.path.join(self.tmp, "repo")
+        os.makedirs(self.wheelhouse)
+        os.makedirs(self.directory)
+
+    def test_install_from_pruned_store_entry(self):
+        make_wheel(self.wheelhouse, "demo", "1.0", files={"demo/__init__.py": ""})
+        cache = os.path.join(self.tmp, "cache")
+        # an entry whose wheel was removed by a concurrent prune
+        empty = os.path.join(self.tmp, "empty")
+        os.makedirs(empty)
+        whl.store.add(cache, "wheels", "k", empty)
+        pkg = whl._install_from_store(
+            cache, "k", "demo", "1.0", self.directory, ["-f", self.wheelhouse]
+        )
+        self.assertEqual(pkg.name, "demo")
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "demo")))
+
+    def test_find_wheel_prefers_best_tag(self):
+        make_wheel(self.wheelhouse, "demo", "1.0", tag="py2.py3-none-any")
+        specific = make_wheel(
+            self.wheelhouse, "demo", "1.0", tag="cp38-cp38-linux_x86_64"
+        )
+        make_wheel(self.wheelhouse, "demo", "2.0", tag="cp38-cp38-linux_x86_64")
+        supported = whl.supported_tags(
+            ["--platform", "linux_x86_64", "--python-version", "3.8"]
+        )
+        self.assertEqual(
+            whl.find_wheel("Demo", "1.0.0", [self.wheelhouse], supported), specific
+        )
+
+    def test_find_wheel_missing(self):
+        make_wheel(self.wheelhouse, "demo", "1.0", tag="cp38-cp38-win32")
+        supported = whl.supported_tags(
+            ["--platform", "linux_x86_64", "--python-version", "3.8"]
+        )
+        self.assertIsNone(
+            whl.find_wheel("demo", "1.0", ["file://" + self.wheelhouse], supported)
+        )
+
+    def test_install_wheel(self):
+        wheel = make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={"demo/__init__.py": "", "demo/data/x.txt": "x"},
+            dist_info_files={
+                "entry_points.txt": "[console_scripts]\ndemo = demo:main\n"
+            },
+        )
+        pkg = whl.install_wheel(wheel, self.directory)
+        self.assertEqual(pkg.name, "demo")
+        for path in ("demo/__init__.py", "demo/data/x.txt", "bin/demo"):
+            self.assertTrue(os.path.exists(os.path.join(self.directory, path)), path)
+        self.assertEqual(
+            whl.get_entry_points(self.directory), {"demo": ("demo", "main")}
+        )
+
+    def test_install_wheel_checks_record(self):
+        wheel = make_wheel(self.wheelhouse, "demo", "1.0", files={"demo.py": "a = 1"})
+        tampered = os.path.join(self.tmp, os.path.basename(wheel))
+        with zipfile.ZipFile(wheel) as src, zipfile.ZipFile(tampered, "w") as dst:
+            for item in src.infolist():
+                data = src.read(item)
+                dst.writestr(item, b"a = 2" if item.filename == "demo.py" else data)
+        self.assertRaises(
+            InvalidWheelSource, whl.install_wheel, tampered, self.directory
+        )
+
+    def test_install_package_from_find_links(self):
+        make_wheel(self.wheelhouse, "demo", "1.0", files={"demo.py": ""})
+        with patch.object(whl, "download_wheel") as download:
+            pkg = whl.install_package(
+                "demo", self.directory, ["--find-links", self.wheelhouse], "1.0"
+            )
+            self.assertFalse(download.called)
+        self.assertEqual(pkg.version, "1.0")
+
+    def test_generate_all(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("a==1.0\nb==2.0\n")
+        make_wheel(self.wheelhouse, "a", "1.0", files={"a.py": ""}, requires_dist=["b"])
+        make_wheel(self.wheelhouse, "b", "2.0", files={"b.py": ""})
+        manifest = {
+            "requirements": "@pip",
+            "constraint": constraint,
+            "build_file": "BUILD.whl",
+            "packages": [
+                {
+                    "package": name,
+                    "version": version,
+                    "directory": os.path.join(self.directory, name),
+                }
+                for name, version in (("a", "1.0"), ("b", "2.0"))
+            ],
+        }
+        whl._generate_all(manifest, ["--find-links", self.wheelhouse], None, 2)
+        with open(os.path.join(self.directory, "a", "BUILD.whl")) as f:
+            self.assertIn('requirement("b")', f.read())
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "b", "b.py")))
+
+    def test_installed_files(self):
+        wheel = make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={"ns/demo/__init__.py": ""},
+            dist_info_files={
+                "entry_points.txt": "[console_scripts]\ndemo = ns.demo:main\n"
+            },
+        )
+        whl.install_wheel(wheel, self.directory)
+        files = whl.installed_files(self.directory)
+        self.assertIn("bin/demo", files)
+        # created by the namespace package fix
+        self.assertIn("ns/__init__.py", files)
+        self.assertIn("ns/demo/__init__.py", files)
+
+    def test_namespace_packages(self):
+        wheel = make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={
+                "ns/sub/demo/__init__.py": "",
+                "ns/sub/demo/data/x.json": "{}",
+                "ns/sub/demo/tools/run.py": "",
+            },
+            dist_info_files={"top_level.txt": "ns\n"},
+        )
+        whl.install_wheel(wheel, self.directory)
+        files = whl.installed_files(self.directory)
+        self.assertIn("ns/__init__.py", files)
+        self.assertIn("ns/sub/__init__.py", files)
+        # not a namespace package, only a directory in a regular package
+        self.assertNotIn("ns/sub/demo/data/__init__.py", files)
+        self.assertNotIn("ns/sub/demo/tools/__init__.py", files)
+        self.assertNotIn("__init__.py", files)
+
+    def test_namespace_packages_pep420(self):
+        wheel = make_wheel(
+            self.wheelhouse, "demo", "1.0", files={"ns/demo/__init__.py": ""}
+        )
+        whl.install_wheel(wheel, self.directory, namespace_style="pep420")
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "ns/__init__.py")))
+
+    def test_import_targets(self):
+        files = [
+            "BUILD",
+            "bin/tool",
+            "boto/__init__.py",
+            "boto/client.py",
+            "boto/data/__init__.py",
+            "boto/data/s3.json",
+            "boto/docs/index.html",
+            "boto/skip/BUILD",
+            "boto/skip/x.py",
+            "boto/with space.py",
+            "six.py",
+            "six.pyc",
+        ]
+        files = whl._label_files(files)
+        self.assertEqual(
+            whl.import_targets(files, set(["boto", "six"])),
+            {
+                "boto": (
+                    ["boto/__init__.py", "boto/client.py"],
+                    ["boto.data", "boto.docs"],
+                ),
+                "boto.data": (
+                    [
+                        "boto/__init__.py",
+                        "boto/client.py",
+                        "boto/data/__init__.py",
+                        "boto/data/s3.json",
+                    ],
+                    [],
+                ),
+                "boto.docs": (
+                    ["boto/__init__.py", "boto/client.py", "boto/docs/index.html"],
+                    [],
+                ),
+                "six": (["six.py"], []),
+            },
+        )
+
+    def test_generate_explicit_files(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo==1.0\n")
+        make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={"demo/__init__.py": "", "demo/data/x.json": "{}"},
+            dist_info_files={"top_level.txt": "demo\n"},
+        )
+        whl.generate(
+            "demo",
+            self.directory,
+            "@pip",
+            constraint,
+            ["--find-links", self.wheelhouse],
+            version="1.0",
+        )
+        with open(os.path.join(self.directory, "BUILD")) as f:
+            build = f.read()
+        self.assertNotIn("glob(", build)
+        self.assertIn('name = "demo.data"', build)
+        self.assertIn('"demo/data/x.json"', build)
+
+    def test_pip_constraint(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write(
+                "# via pip-compile\n"
+                "Celery[redis,sqs]==5.0 \\\n    --hash=sha256:ab\n"
+                "six==1.16.0  # via celery\n"
+            )
+        private = os.path.join(self.tmp, "private")
+        os.makedirs(private)
+        path = whl._pip_constraint(constraint, "celery", private)
+        self.assertEqual(os.path.dirname(path), private)
+        with open(path) as f:
+            self.assertEqual(f.read(), "Celery==5.0      --hash=sha256:ab\n")
+        self.assertIsNone(whl._pip_constraint(constraint, "kombu", private))
+
+    def test_generate_passes_own_pin(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo[fast]==1.0\nsix==1.16.0\n")
+        wheel = make_wheel(
+            self.wheelhouse, "demo", "1.0", files={"demo/__init__.py": ""}
+        )
+        constraints = []
+
+        def download_wheel(pkg, directory, pip_args, build_times=None):
+            path = pip_args[pip_args.index("-c") + 1]
+            with open(path) as f:
+                constraints.append((path, f.read()))
+            return wheel
+
+        with patch.object(whl, "download_wheel", side_effect=download_wheel):
+            whl.generate("demo", self.directory, "@pip", constraint, [], version="1.0")
+        ((path, content),) = constraints
+        self.assertEqual(content, "demo==1.0\n")
+        # the file is private to the fetch and removed with it
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_generate_given_dependencies(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo==1.0\n")
+        make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={"demo/__init__.py": ""},
+            requires_dist=["six"],
+        )
+        whl.generate(
+            "demo",
+            self.directory,
+            "@pip",
+            constraint,
+            ["--find-links", self.wheelhouse],
+            version="1.0",
+            extras=["fast"],
+            dependencies={"": ["idna", "six"], "fast": ["cython"]},
+        )
+        with open(os.path.join(self.directory, "BUILD")) as f:
+            build = f.read()
+        self.assertIn('requirement("idna")', build)
+        self.assertIn('":pkg",requirement("cython")', build)
+
+    def test_generate_shared(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo==1.0\n")
+        make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={"demo/__init__.py": "", "demo/sub/__init__.py": ""},
+            requires_dist=["six", 'pysocks ; extra == "socks"'],
+            dist_info_files={
+                "top_level.txt": "demo\n",
+                "entry_points.txt": "[console_scripts]\ndemo = demo:main\n",
+            },
+        )
+        whl.generate(
+            "demo",
+            self.directory,
+            "@pip",
+            constraint,
+            ["--find-links", self.wheelhouse],
+            version="1.0",
+            shared=True,
+        )
+        with open(os.path.join(self.directory, "BUILD")) as f:
+            build = f.read()
+        self.assertNotIn("requirement(", build)
+        self.assertIn('exports_files([\n    "bin/bin-demo.py",\n])', build)
+
+        wrapper = os.path.join(self.tmp, "wrapper")
+        os.makedirs(wrapper)
+        whl.generate_wrapper(
+            wrapper, "@pip", "@shared", self.directory, extras=["socks"]
+        )
+        with open(os.path.join(wrapper, "BUILD")) as f:
+            build = f.read()
+        self.assertIn('load("@pip//:mapping.bzl", "requirement")', build)
+        self.assertIn(
+            'name = "pkg",\n    deps = [\n        "@shared//:pkg",\n'
+            '        requirement("six"),',
+            build,
+        )
+        self.assertIn('"@shared//:demo.sub",', build)
+        self.assertIn('main = "@shared//:bin/bin-demo.py"', build)
+        self.assertIn('":pkg",requirement("pysocks")', build)
+
+    def test_header_includes(self):
+        self.assertEqual(
+            whl.header_includes(
+                [
+                    "numpy/__init__.py",
+                    "numpy/core/include/numpy/arrayobject.h",
+                    "torch/include/torch/csrc/api/include/torch/torch.h",
+                    "include/python/demo/demo.hpp",
+                ]
+            ),
+            (
+                [
+                    "include/python/demo/demo.hpp",
+                    "numpy/core/include/numpy/arrayobject.h",
+                    "torch/include/torch/csrc/api/include/torch/torch.h",
+                ],
+                [
+                    "include",
+                    "include/python",
+                    "numpy/core/include",
+                    "torch/include",
+                    "torch/include/torch/csrc/api/include",
+                ],
+            ),
+        )
+        self.assertEqual(
+            whl.header_includes(["demo/__init__.py", "demo/demo.h"]),
+            (["demo/demo.h"], ["."]),
+        )
+        self.assertEqual(whl.header_includes(["demo/__init__.py"]), ([], []))
+
+    def test_generate_headers(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo==1.0\n")
+        make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={
+                "demo/__init__.py": "",
+                "demo/include/demo/demo.h": "int demo();\n",
+            },
+        )
+        whl.generate(
+            "demo",
+            self.directory,
+            "@pip",
+            constraint,
+            ["--find-links", self.wheelhouse],
+            version="1.0",
+            shared=True,
+        )
+        with open(os.path.join(self.directory, "BUILD")) as f:
+            build = f.read()
+        self.assertIn(
+            'cc_library(\n    name = "headers",\n'
+            '    hdrs = [\n        "demo/include/demo/demo.h",\n    ],\n'
+            '    includes = [\n        "demo/include",\n    ],\n)',
+            build,
+        )
+
+        wrapper = os.path.join(self.tmp, "wrapper")
+        os.makedirs(wrapper)
+        whl.generate_wrapper(wrapper, "@pip", "@shared", self.directory)
+        with open(os.path.join(wrapper, "BUILD")) as f:
+            self.assertIn('actual = "@shared//:headers"', f.read())
+
+    def test_configure_native_builds(self):
+        bin_dir = os.path.join(self.tmp, "bin")
+        os.makedirs(bin_dir)
+        launcher = os.path.join(bin_dir, "ccache")
+        with open(launcher, "w") as f:
+            f.write("#!/bin/sh\n")
+        os.chmod(launcher, 0o755)
+        environ = {"PATH": bin_dir, "CC": "gcc -pthread", "MAX_JOBS": "2"}
+        with patch.dict(os.environ, environ, clear=True):
+            whl.configure_native_builds("ccache", 8, self.tmp)
+            self.assertEqual(os.environ["CC"], launcher + " gcc -pthread")
+            self.assertTrue(os.environ["CXX"].startswith(launcher + " "))
+            self.assertEqual(os.environ["CCACHE_DIR"], os.path.join(self.tmp, "ccache"))
+            self.assertIn("CCACHE_BASEDIR", os.environ)
+            # set by the user
+            self.assertEqual(os.environ["MAX_JOBS"], "2")
+            self.assertEqual(os.environ["MAKEFLAGS"], "-j8")
+            config = os.environ["DIST_EXTRA_CONFIG"]
+            with open(config) as f:
+                self.assertEqual(f.read(), "[build_ext]\nparallel = 8\n")
+            # other users can not plant options in it
+            self.assertEqual(os.stat(os.path.dirname(config)).st_mode & 0o077, 0)
+
+            # wrapping twice keeps a single launcher
+            whl.configure_native_builds("ccache", 8, self.tmp)
+            self.assertEqual(os.environ["CC"], launcher + " gcc -pthread")
+
+    def test_precompile(self):
+        wheel = make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={"demo/__init__.py": "X = 1\n", "demo/py2.py": "print 'x'\n"},
+        )
+        whl.install_wheel(wheel, self.directory)
+        compiled = whl.precompile(self.directory, ["demo/__init__.py", "demo/py2.py"])
+
+        self.assertEqual(len(compiled), 1)
+        self.assertIn(compiled[0], whl.installed_files(self.directory))
+        with open(os.path.join(self.directory, compiled[0]), "rb") as f:
+            header = f.read(16)
+        # flags of a checked hash based pyc
+        self.assertEqual(header[4:8], b"\x03\x00\x00\x00")
+
+    def test_generate_zipped(self):
+        constraint = os.path.join(self.tmp, "requirements.txt")
+        with open(constraint, "w") as f:
+            f.write("demo==1.0\n")
+        make_wheel(
+            self.wheelhouse,
+            "demo",
+            "1.0",
+            files={
+                "zipdemo/__init__.py": "",
+                "zipdemo/sub/__init__.py": "X = 1\n",
+                "single.py": "",
+                "native/__init__.py": "",
+                "native/ext.so": "",
+                "withdata/__init__.py": "",
+                "withdata/data.json": "{}",
+            },
+            dist_info_files={"top_level.txt": "native\nsingle\nwithdata\nzipdemo\n"},
+        )
+        whl.generate(
+            "demo",
+            self.directory,
+            "@pip",
+            constraint,
+            ["--find-links", self.wheelhouse],
+            version="1.0",
+            precompile_pyc=True,
+            zipped=True,
+        )
+
+        archive = os.path.join(self.directory, whl.ZIP_NAME)
+        with zipfile.ZipFile(archive) as z:
+            self.assertEqual(
+                sorted(z.namelist()),
+                [
+                    "single.py",
+                    "single.pyc",
+                    "zipdemo/__init__.py",
+                    "zipdemo/__init__.pyc",
+                    "zipdemo/sub/__init__.py",
+                    "zipdemo/sub/__init__.pyc",
+                ],
+            )
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "zipdemo")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "native")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "withdata")))
+        with open(os.path.join(self.directory, "BUILD")) as f:
+            self.assertIn('imports = [".", "%s"]' % whl.ZIP_NAME, f.read())
+
+        sys.path.insert(0, archive)
+        self.addCleanup(sys.path.remove, archive)
+        from zipdemo import sub
+
+        self.assertEqual(sub.X, 1)
+        self.assertTrue(sub.__file__.startswith(archive))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,60 @@
+"""helpers to create wheel files for tests"""
+import base64
+import hashlib
+import os
+import zipfile
+
+
+def _record_hash(data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    return "sha256=" + digest.rstrip(b"=").decode()
+
+
+def make_wheel(
+    directory,
+    name,
+    version,
+    files=None,
+    requires_dist=(),
+    tag="py3-none-any",
+    dist_info_files=None,
+):
+    """Writes a wheel file.
+
+    Args:
+        directory: directory to write the wheel into
+        name: distribution name
+        version: distribution version
+        files: map from path in the wheel to content
+        requires_dist: Requires-Dist lines of the METADATA
+        tag: compatibility tag of the wheel
+        dist_info_files: extra files in the dist-info directory
+    Returns:
+        str: path to the wheel file
+    """
+    dist_info = "{}-{}.dist-info".format(name, version)
+    metadata = "Metadata-Version: 2.1\nName: {}\nVersion: {}\n".format(name, version)
+    metadata += "".join("Requires-Dist: %s\n" % r for r in requires_dist)
+    contents = dict(files or {})
+    contents[dist_info + "/METADATA"] = metadata
+    purelib = "true" if tag.endswith("-none-any") else "false"
+    contents[dist_info + "/WHEEL"] = (
+        "Wheel-Version: 1.0\nGenerator: tests\n"
+        "Root-Is-Purelib: {}\nTag: {}\n".format(purelib, tag)
+    )
+    for path, content in (dist_info_files or {}).items():
+        contents[dist_info + "/" + path] = content
+
+    record = []
+    path = os.path.join(directory, "{}-{}-{}.whl".format(name, version, tag))
+    with zipfile.ZipFile(path, "w") as whl:
+        for filename, content in sorted(contents.items()):
+            if not isinstance(content, bytes):
+                content = content.encode("utf-8")
+            whl.writestr(filename, content)
+            record.append(
+                "%s,%s,%d\n" % (filename, _record_hash(content), len(content))
+            )
+        record.append(dist_info + "/RECORD,,\n")
+        whl.writestr(dist_info + "/RECORD", "".join(record))
+    return path